@@ -1,6 +1,25 @@
 from flask import Flask
-from app.config import load_configurations, configure_logging
+from app.config import load_configurations, configure_logging, log_stats
 from .views import webhook_blueprint
+from .services import openai_service
+from .services.admission import admission
+from .services.answer_cache import answer_cache
+from .services.audio_pipeline import audio_pipeline
+from .services.backends import reply_router
+from .services.coalescer import coalescer
+from .services.conversation_store import conversation_store
+from .services.dedup import deduplicator
+from .services.graph_api import graph_client
+from .services.ingress import ingress
+from .services.job_queue import job_queue
+from .services.knowledge_index import knowledge_index
+from .services.metrics import metrics
+from .services.outbound import outbound
+from .services.outbox import outbox
+from .services.profiler import profiler
+from .services.status_sink import status_sink
+from .services.thread_rotation import thread_rotator
+from .services.thread_store import thread_store
 
 
 def create_app():
@@ -8,9 +27,80 @@ def create_app():
 
     # Load configurations and logging settings
     load_configurations(app)
-    configure_logging()
+    configure_logging(app.config)
+
+    # Model names and run polling of the OpenAI calls
+    openai_service.init_app(app)
+
+    # Precomputed signature key and JSON decoder for incoming webhooks
+    ingress.init_app(app)
+
+    # Background worker pool for webhook processing
+    job_queue.init_app(app)
+
+    # Drop webhook retries for messages that were already processed
+    deduplicator.init_app(app)
+
+    # Persistent wa_id -> OpenAI thread mapping
+    thread_store.init_app(app)
+
+    # Background rotation of long or idle threads (off unless a THREAD_ROTATE_* limit is set)
+    thread_rotator.init_app(app)
+
+    # Pooled HTTP client for all Graph API calls
+    graph_client.init_app(app)
+
+    # Durable journal of outgoing messages; must be set up before the send queue starts its drainer
+    outbox.init_app(app)
+
+    # Rate-limited outbound send queue
+    outbound.init_app(app)
+
+    # Cap concurrent assistant runs and shed load while the backend is slow or failing
+    admission.init_app(app)
+
+    # Debounce rapid-fire messages from the same user into one assistant run
+    coalescer.init_app(app)
+
+    # Answer cache for repeated FAQ questions
+    answer_cache.init_app(app)
+
+    # Local BM25 index over the knowledge base for the fast-answer tier
+    knowledge_index.init_app(app)
+
+    # Delivery statuses, written to SQLite in batches
+    status_sink.init_app(app)
+
+    # Voice notes: streaming download, transcription pool and transcript cache
+    audio_pipeline.init_app(app)
+
+    # Locally kept chat history for the single-call "conversation" backend
+    conversation_store.init_app(app)
+
+    # Reply backend chain with per-backend deadlines, fallback and optional hedging
+    reply_router.init_app(app)
+
+    # Per-stage latency histograms and service gauges on /metrics
+    metrics.init_app(app)
+    metrics.register("job_queue", job_queue.stats)
+    metrics.register("outbound", outbound.stats.snapshot)
+    metrics.register("outbound_queue", outbound.queue_stats)
+    metrics.register("outbox", outbox.stats)
+    metrics.register("thread_store", thread_store.stats)
+    metrics.register("answer_cache", answer_cache.stats)
+    metrics.register("coalescer", coalescer.stats)
+    metrics.register("transcripts", audio_pipeline.stats)
+    metrics.register("status_sink", status_sink.stats)
+    metrics.register("admission", admission.stats)
+    metrics.register("replies", reply_router.stats)
+    metrics.register("conversations", conversation_store.stats)
+    metrics.register("thread_rotation", thread_rotator.stats)
+    metrics.register("logging", log_stats)
 
     # Import and register blueprints, if any
     app.register_blueprint(webhook_blueprint)
 
+    # Opt-in profiling wraps the registered webhook view; nothing is wrapped when it is off
+    profiler.init_app(app)
+
     return app
@@ -0,0 +1,273 @@
+import asyncio
+import hashlib
+import logging
+import tempfile
+
+from aiohttp import ClientError, web
+
+from app import create_app
+from .services import openai_service
+from .services.audio_pipeline import audio_pipeline, AudioDownloadError, AudioTooLargeError, TranscriptionError
+from .services.backends import reply_router, ReplyRequest
+from .services.graph_api import async_graph_client, GraphAPIError
+from .services.ingress import ingress, STATUS
+from .services.metrics import metrics
+from .utils.whatsapp_utils import iter_webhook_events
+from .views import (
+    TRANSCRIPTION_ERRORS,
+    cached_reply,
+    drop_duplicates,
+    handle_call,
+    handle_status,
+    reply_text,
+    send_reply,
+    transcription_error_text,
+)
+
+# --- asyncio-Webhook-Server: dieselbe Signaturprüfung und Nachrichtenlogik wie views.py,
+# aber Medien-Download, Transkription und OpenAI-Aufrufe sind nicht blockierend. Ein Prozess
+# kann so hunderte Gespräche gleichzeitig offen halten. Anrufe, Antwort-Cache, Auswertung der
+# Backend-Antwort und Versand über den Outbound-Scheduler sind dieselben Funktionen wie in views.py.
+
+FLASK_APP = web.AppKey("flask_app")
+PROCESSOR = web.AppKey("processor")
+
+# Dedup, Outbox und Thread-Store sind synchron und können auf SQLite warten (Checkpoint,
+# busy timeout bis 5 s). Diese Aufrufe laufen deshalb mit asyncio.to_thread im Threadpool,
+# damit ein langsamer Schreibzugriff nicht alle anderen Verbindungen des Event-Loops anhält.
+
+# Einstellungen, die nur der Flask-Server kennt; beim Start wird gewarnt, wenn eine davon gesetzt ist
+IGNORED_SETTINGS = {
+    "COALESCE_WINDOW_SECONDS": "Nachrichten eines Absenders werden einzeln beantwortet",
+    "ASSISTANT_STREAMING": "Antworten werden erst nach dem Run gesendet",
+    "ASYNC_PROCESSING": "Events laufen immer als Tasks im Event-Loop",
+}
+
+
+class KeyedLocks:
+    """
+    One asyncio.Lock per key, dropped again once nobody holds or waits for it.
+    Keeps the messages of one wa_id in order while other users run in parallel.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    async def __call__(self, key, coro):
+        lock, users = self._locks.get(key, (asyncio.Lock(), 0))
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                return await coro
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+
+class AsyncWebhookProcessor:
+    def __init__(self, config):
+        self.config = config
+        self.lanes = KeyedLocks()
+        self.inflight = asyncio.Semaphore(config["ASYNC_MAX_INFLIGHT"])
+        self.transcriptions = asyncio.Semaphore(config["TRANSCRIPTION_CONCURRENCY"])
+        self.tasks = set()
+
+    def spawn(self, event):
+        task = asyncio.create_task(self.process_event(event))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def process_event(self, event):
+        async with self.inflight:
+            try:
+                if event.kind == "call":
+                    await self.handle_call(event.value, event.item)
+                elif event.kind == "status":
+                    handle_status(event.value, event.item)
+                else:
+                    await self.lanes(
+                        event.item.get("from"),
+                        self.handle_incoming_message(event.value, event.item),
+                    )
+            except Exception as e:
+                logging.exception(f"Ein unerwarteter Fehler ist aufgetreten: {e}")
+
+    async def handle_call(self, value, call):
+        await asyncio.to_thread(handle_call, value, call)
+
+    async def send_reply(self, phone_number_id, to, text):
+        # Outbox-Journal und Übergabe an den Outbound-Scheduler können auf SQLite warten
+        await asyncio.to_thread(send_reply, phone_number_id, to, text)
+
+    async def transcribe(self, media_id):
+        cached = audio_pipeline.cache.get(f"media:{media_id}")
+        if cached is not None:
+            return cached
+
+        async with self.transcriptions:
+            started = asyncio.get_running_loop().time()
+            url = await async_graph_client.get_media_url(media_id)
+            digest = hashlib.sha256()
+            size = 0
+            with tempfile.SpooledTemporaryFile(max_size=self.config["AUDIO_SPOOL_BYTES"]) as audio_file:
+                try:
+                    response = await async_graph_client.download_media(url)
+                    async with response:
+                        async for chunk in response.content.iter_chunked(64 * 1024):
+                            size += len(chunk)
+                            if size > self.config["AUDIO_MAX_BYTES"]:
+                                raise AudioTooLargeError(
+                                    f"Voice note {media_id} exceeds {self.config['AUDIO_MAX_BYTES']} bytes"
+                                )
+                            digest.update(chunk)
+                            audio_file.write(chunk)
+                except (GraphAPIError, ClientError, asyncio.TimeoutError) as e:
+                    raise AudioDownloadError(f"Download of {media_id} failed: {e}") from e
+                audio_file.seek(0)
+                metrics.observe("media", "audio", asyncio.get_running_loop().time() - started)
+
+                content_key = f"sha256:{digest.hexdigest()}"
+                transcript = audio_pipeline.cache.get(content_key)
+                if transcript is None:
+                    try:
+                        with metrics.time("whisper", "audio"):
+                            transcript = await openai_service.transcribe_async(
+                                audio_file, model=self.config["TRANSCRIPTION_MODEL"]
+                            )
+                    except Exception as e:
+                        raise TranscriptionError(str(e)) from e
+                    audio_pipeline.cache.put(content_key, transcript)
+
+        audio_pipeline.cache.put(f"media:{media_id}", transcript)
+        return transcript
+
+    async def handle_incoming_message(self, value, message_body):
+        from_number = message_body["from"]
+        message_type = message_body["type"]
+        metrics.count("events", message_type)
+
+        if message_type == "text":
+            incoming_message_text = message_body["text"]["body"]
+        elif message_type == "audio":
+            audio_media_id = message_body["audio"]["id"]
+            logging.info(f"Sprachnachricht empfangen mit Media ID: {audio_media_id}")
+            try:
+                incoming_message_text = await self.transcribe(audio_media_id)
+                logging.info(f"Transkribierte Sprachnachricht: {incoming_message_text}")
+            except TRANSCRIPTION_ERRORS as e:
+                incoming_message_text = transcription_error_text(e)
+        else:
+            logging.info(f"Nachrichtentyp '{message_type}' wird noch nicht unterstützt.")
+            return
+
+        if not incoming_message_text:
+            logging.info("Nachricht ohne Textinhalt verarbeitet (z.B. eine leere Audionachricht).")
+            return
+
+        phone_number_id = value["metadata"]["phone_number_id"]
+        text = await self.generate_reply(from_number, incoming_message_text, message_type)
+        await self.send_reply(phone_number_id, from_number, text)
+
+    async def generate_reply(self, from_number, incoming_message_text, message_type="text"):
+        cached = cached_reply(incoming_message_text, message_type)
+        if cached is not None:
+            return cached
+
+        # Dieselbe Backend-Kette wie views.py; abgelaufene Backend-Aufrufe werden hier abgebrochen
+        reply_request = ReplyRequest(from_number, incoming_message_text, message_type)
+        reply = await reply_router.reply_async(reply_request)
+        return reply_text(reply, reply_request, self.config)
+
+
+async def webhook_get(request):
+    config = request.app[FLASK_APP].config
+    mode = request.query.get("hub.mode")
+    token = request.query.get("hub.verify_token")
+    challenge = request.query.get("hub.challenge")
+
+    if mode and token:
+        if mode == "subscribe" and token == config["VERIFY_TOKEN"]:
+            logging.info("WEBHOOK_VERIFIED")
+            return web.Response(text=challenge or "")
+        logging.info("VERIFICATION_FAILED")
+        return web.json_response({"status": "error", "message": "Verifizierung fehlgeschlagen"}, status=403)
+    logging.info("FEHLENDE_PARAMETER")
+    return web.json_response({"status": "error", "message": "Fehlende Parameter"}, status=400)
+
+
+async def webhook_post(request):
+    raw_payload_bytes = await request.read()
+    with metrics.time("signature", "webhook"):
+        valid = ingress.verify(raw_payload_bytes, request.headers.get("X-Hub-Signature-256", ""))
+    if not valid:
+        logging.info("Signature verification failed! (Calculated mismatch)")
+        return web.json_response({"status": "error", "message": "Invalid signature"}, status=403)
+
+    with metrics.time("parse", "webhook"):
+        body = ingress.parse(raw_payload_bytes)
+    if not body:
+        logging.info("Leerer oder ungültiger JSON-Body empfangen.")
+        return web.json_response({"status": "ok", "message": "No valid JSON body"})
+
+    # Reine Statusupdates werden direkt im Handler erledigt, ohne Tasks anzulegen
+    if ingress.classify(raw_payload_bytes) == STATUS:
+        for event in iter_webhook_events(body):
+            handle_status(event.value, event.item)
+        return web.json_response({"status": "ok"})
+
+    events, duplicates = await asyncio.to_thread(drop_duplicates, body)
+    if not events:
+        if duplicates:
+            return web.json_response({"status": "ok", "message": "Duplicate message"})
+        logging.info("Request ist kein gültiges WhatsApp API-Ereignis.")
+        return web.json_response(
+            {"status": "error", "message": "Kein gültiges WhatsApp API-Ereignis"}, status=404
+        )
+
+    # Sofort bestätigen; die Verarbeitung läuft als Tasks im Event-Loop weiter
+    processor = request.app[PROCESSOR]
+    for event in events:
+        processor.spawn(event)
+    return web.json_response({"status": "ok"})
+
+
+async def metrics_get(request):
+    if not metrics.authorized(request.remote, request.headers):
+        return web.Response(text="forbidden\n", status=403)
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+async def _on_startup(app):
+    await async_graph_client.start()
+    app[PROCESSOR] = AsyncWebhookProcessor(app[FLASK_APP].config)
+
+
+async def _on_cleanup(app):
+    tasks = app[PROCESSOR].tasks
+    if tasks:
+        await asyncio.wait(tasks, timeout=30)
+    await async_graph_client.close()
+
+
+def create_async_app():
+    """
+    Build the aiohttp application. Configuration and the shared services
+    (dedup, thread store, caches, knowledge index) are set up by the same
+    create_app() as the Flask server.
+    """
+    flask_app = create_app()
+    for setting, effect in IGNORED_SETTINGS.items():
+        if flask_app.config.get(setting):
+            logging.warning(f"{setting} wird vom asyncio-Server ignoriert: {effect}.")
+    app = web.Application()
+    app[FLASK_APP] = flask_app
+    app.router.add_get("/webhook", webhook_get)
+    app.router.add_post("/webhook", webhook_post)
+    if metrics.enabled:
+        app.router.add_get("/metrics", metrics_get)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
@@ -1,7 +1,39 @@
+import atexit
 import sys
 import os
+import queue
 from dotenv import load_dotenv
 import logging
+import logging.handlers
+
+from app.utils.logging_utils import DroppingQueueHandler, JsonFormatter, SamplingFilter, TruncatingFilter
+
+_log_listener = None
+_log_handler = None
+
+# Local state (SQLite databases, profiles) goes here unless DATA_DIR or a per-file path is set
+DEFAULT_DATA_DIR = "var"
+
+
+def _get_bool(name, default=False):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _get_int(name, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return int(value)
+
+
+def data_path(name):
+    """
+    Default location of a local state file: name inside DATA_DIR.
+    """
+    return os.path.join(os.getenv("DATA_DIR") or DEFAULT_DATA_DIR, name)
 
 
 def load_configurations(app):
@@ -15,10 +47,264 @@ def load_configurations(app):
     app.config["PHONE_NUMBER_ID"] = os.getenv("PHONE_NUMBER_ID")
     app.config["VERIFY_TOKEN"] = os.getenv("VERIFY_TOKEN")
 
+    # Directory for the SQLite databases and profile dumps below; each path can still be set on its own
+    app.config["DATA_DIR"] = os.getenv("DATA_DIR") or DEFAULT_DATA_DIR
+
+    # Background processing: acknowledge webhooks immediately and hand the
+    # event to a pool of worker threads. WORKER_COUNT is also the global limit
+    # for concurrently processed users; each wa_id is processed in order.
+    app.config["ASYNC_PROCESSING"] = _get_bool("ASYNC_PROCESSING", False)
+    app.config["WORKER_COUNT"] = _get_int("WORKER_COUNT", 4)
+    app.config["JOB_QUEUE_SIZE"] = _get_int("JOB_QUEUE_SIZE", 100)
+
+    # Message-ID deduplication of retried webhook deliveries. Set DEDUP_DB_PATH
+    # to share seen IDs between gunicorn workers via SQLite.
+    app.config["DEDUP_ENABLED"] = _get_bool("DEDUP_ENABLED", True)
+    app.config["DEDUP_TTL_SECONDS"] = _get_int("DEDUP_TTL_SECONDS", 86400)
+    app.config["DEDUP_MAX_ENTRIES"] = _get_int("DEDUP_MAX_ENTRIES", 10000)
+    app.config["DEDUP_DB_PATH"] = os.getenv("DEDUP_DB_PATH", "")
+
+    # Conversation threads (wa_id -> OpenAI thread), SQLite with an LRU read cache
+    app.config["THREADS_DB_PATH"] = os.getenv("THREADS_DB_PATH") or data_path("threads.sqlite3")
+    app.config["THREAD_CACHE_SIZE"] = _get_int("THREAD_CACHE_SIZE", 1024)
+
+    # Thread rotation: a background task moves users to a fresh thread (opening with a
+    # summary of the old one) after THREAD_ROTATE_MESSAGES messages, THREAD_ROTATE_TOKENS
+    # estimated tokens or THREAD_ROTATE_IDLE_SECONDS without messages (0 disables each)
+    app.config["THREAD_ROTATE_MESSAGES"] = _get_int("THREAD_ROTATE_MESSAGES", 0)
+    app.config["THREAD_ROTATE_TOKENS"] = _get_int("THREAD_ROTATE_TOKENS", 0)
+    app.config["THREAD_ROTATE_IDLE_SECONDS"] = _get_int("THREAD_ROTATE_IDLE_SECONDS", 0)
+    app.config["THREAD_ROTATE_INTERVAL"] = float(os.getenv("THREAD_ROTATE_INTERVAL") or 60.0)
+
+    # Graph API client: one keep-alive connection pool shared by all calls
+    app.config["WHATSAPP_TOKEN"] = os.getenv("WHATSAPP_TOKEN") or app.config["ACCESS_TOKEN"]
+    app.config["GRAPH_API_VERSION"] = (
+        os.getenv("GRAPH_API_VERSION") or app.config["VERSION"] or "v17.0"
+    )
+    app.config["GRAPH_API_BASE_URL"] = os.getenv(
+        "GRAPH_API_BASE_URL", "https://graph.facebook.com"
+    )
+    app.config["GRAPH_POOL_SIZE"] = _get_int("GRAPH_POOL_SIZE", 10)
+    app.config["GRAPH_CONNECT_TIMEOUT"] = float(os.getenv("GRAPH_CONNECT_TIMEOUT") or 3.05)
+    app.config["GRAPH_READ_TIMEOUT"] = float(os.getenv("GRAPH_READ_TIMEOUT") or 10)
+
+    # Outbound send scheduler: token bucket per sending phone number, ordered
+    # delivery per recipient, retries with backoff on 429/5xx
+    app.config["SEND_RATE_PER_SECOND"] = float(os.getenv("SEND_RATE_PER_SECOND") or 20)
+    app.config["SEND_BURST"] = _get_int("SEND_BURST", 20)
+    app.config["SEND_MAX_RETRIES"] = _get_int("SEND_MAX_RETRIES", 3)
+    app.config["SEND_BACKOFF_SECONDS"] = float(os.getenv("SEND_BACKOFF_SECONDS") or 0.5)
+    app.config["SEND_WORKER_COUNT"] = _get_int("SEND_WORKER_COUNT", 4)
+    app.config["SEND_QUEUE_SIZE"] = _get_int("SEND_QUEUE_SIZE", 1000)
+
+    # Durable outbox: every outgoing message is journaled to SQLite before it is
+    # sent; failed or interrupted sends are replayed by a background drainer with
+    # backoff. Each open entry is leased to the process sending it, which renews the
+    # lease; entries of a process that stopped renewing for OUTBOX_REPLAY_AFTER
+    # seconds are taken over by another one. Empty OUTBOX_DB_PATH disables it.
+    app.config["OUTBOX_DB_PATH"] = os.getenv("OUTBOX_DB_PATH", data_path("outbox.sqlite3"))
+    app.config["OUTBOX_DRAIN_INTERVAL"] = float(os.getenv("OUTBOX_DRAIN_INTERVAL") or 5.0)
+    app.config["OUTBOX_BATCH_SIZE"] = _get_int("OUTBOX_BATCH_SIZE", 100)
+    app.config["OUTBOX_MAX_ATTEMPTS"] = _get_int("OUTBOX_MAX_ATTEMPTS", 10)
+    app.config["OUTBOX_BACKOFF_SECONDS"] = float(os.getenv("OUTBOX_BACKOFF_SECONDS") or 5.0)
+    app.config["OUTBOX_REPLAY_AFTER"] = float(os.getenv("OUTBOX_REPLAY_AFTER") or 30.0)
+    app.config["OUTBOX_RETENTION_SECONDS"] = _get_int("OUTBOX_RETENTION_SECONDS", 7 * 86400)
+
+    # Admission control for the assistant stage: at most ADMISSION_MAX_INFLIGHT runs at
+    # once, ADMISSION_MAX_WAITING more wait up to ADMISSION_MAX_WAIT_SECONDS; everyone
+    # else is handed to the next reply backend, or gets BUSY_REPLY_TEXT right away.
+    # After BREAKER_FAILURE_THRESHOLD failed or timed-out runs in a row the breaker
+    # skips the assistant for BREAKER_RESET_SECONDS. ADMISSION_MAX_INFLIGHT=0 disables both.
+    app.config["ADMISSION_MAX_INFLIGHT"] = _get_int("ADMISSION_MAX_INFLIGHT", 8)
+    app.config["ADMISSION_MAX_WAITING"] = _get_int("ADMISSION_MAX_WAITING", 32)
+    app.config["ADMISSION_MAX_WAIT_SECONDS"] = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS") or 10.0)
+    app.config["BREAKER_FAILURE_THRESHOLD"] = _get_int("BREAKER_FAILURE_THRESHOLD", 5)
+    app.config["BREAKER_RESET_SECONDS"] = float(os.getenv("BREAKER_RESET_SECONDS") or 30.0)
+    app.config["BUSY_REPLY_TEXT"] = os.getenv("BUSY_REPLY_TEXT") or (
+        "Gerade ist bei mir sehr viel los. Bitte schreib mir in ein paar Minuten noch einmal, "
+        "dann kümmere ich mich um dein Anliegen. 🙏"
+    )
+
+    # Stream assistant output and send each [NL] part as soon as it is complete
+    # (falls back to the polling path if the stream fails before the first part)
+    app.config["ASSISTANT_STREAMING"] = _get_bool("ASSISTANT_STREAMING", False)
+
+    # Assistant run polling: a fast first check, then exponential backoff up to
+    # RUN_POLL_MAX; runs still pending after RUN_TIMEOUT are cancelled
+    app.config["RUN_POLL_INITIAL"] = float(os.getenv("RUN_POLL_INITIAL") or 0.2)
+    app.config["RUN_POLL_MAX"] = float(os.getenv("RUN_POLL_MAX") or 2.0)
+    app.config["RUN_TIMEOUT"] = float(os.getenv("RUN_TIMEOUT") or 60)
+
+    # Coalesce messages a user sends within this window into one assistant run
+    # (0 disables). The window restarts with every message, but a batch is
+    # flushed at the latest COALESCE_MAX_DELAY_SECONDS after its first message.
+    app.config["COALESCE_WINDOW_SECONDS"] = float(os.getenv("COALESCE_WINDOW_SECONDS") or 0)
+    app.config["COALESCE_MAX_DELAY_SECONDS"] = float(os.getenv("COALESCE_MAX_DELAY_SECONDS") or 0)
 
-def configure_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        stream=sys.stdout,
+    # The assistant's knowledge base; changes to it invalidate cached answers
+    app.config["KNOWLEDGE_FILE"] = os.getenv("KNOWLEDGE_FILE", "data/airbnb-faq.pdf")
+
+    # Answer cache keyed on the normalized question, shared by all users, so it only
+    # stores replies of context-free backends (faq, chat, echo), never assistant or
+    # conversation replies. ANSWER_CACHE_SIMILARITY > 0 also serves near-duplicates
+    # with at least that cosine similarity.
+    app.config["ANSWER_CACHE_ENABLED"] = _get_bool("ANSWER_CACHE_ENABLED", False)
+    app.config["ANSWER_CACHE_TTL"] = _get_int("ANSWER_CACHE_TTL", 86400)
+    app.config["ANSWER_CACHE_SIZE"] = _get_int("ANSWER_CACHE_SIZE", 500)
+    app.config["ANSWER_CACHE_SIMILARITY"] = float(os.getenv("ANSWER_CACHE_SIMILARITY") or 0)
+
+    # Fast-answer tier: questions that match the local knowledge index with at
+    # least KNOWLEDGE_MIN_CONFIDENCE are answered by FAST_ANSWER_MODEL from the
+    # matched passages. Build the index with start/build_knowledge_index.py;
+    # KNOWLEDGE_FILE is checked every KNOWLEDGE_CHECK_INTERVAL seconds (0: only at
+    # startup) and re-indexed in the background when it changed. Confidence is
+    # scaled down for matches on fewer than KNOWLEDGE_MIN_MATCHED_TERMS words
+    # (stopwords and fillers like "yes" don't count).
+    app.config["KNOWLEDGE_FAST_TIER"] = _get_bool("KNOWLEDGE_FAST_TIER", False)
+    app.config["KNOWLEDGE_INDEX_DIR"] = os.getenv("KNOWLEDGE_INDEX_DIR", "data/index")
+    app.config["KNOWLEDGE_MIN_CONFIDENCE"] = float(os.getenv("KNOWLEDGE_MIN_CONFIDENCE") or 0.75)
+    app.config["KNOWLEDGE_MIN_MATCHED_TERMS"] = _get_int("KNOWLEDGE_MIN_MATCHED_TERMS", 2)
+    app.config["KNOWLEDGE_CHECK_INTERVAL"] = float(os.getenv("KNOWLEDGE_CHECK_INTERVAL") or 60)
+    app.config["FAST_ANSWER_MODEL"] = os.getenv("FAST_ANSWER_MODEL") or "gpt-4o-mini"
+
+    # Reply backends, tried in order until one answers: assistants (OpenAI Assistant
+    # thread), conversation (Chat Completions with locally kept history), chat (one
+    # Chat Completions call without history), faq (the knowledge index above), echo
+    # (uppercase echo for testing). REPLY_TIMEOUTS sets per-backend deadlines
+    # ("assistants=60,chat=15"). With REPLY_HEDGE_PERCENTILE (e.g. 0.95) a call still
+    # running after that percentile of its backend's recent latencies also starts
+    # the next backend, and the first answer wins.
+    app.config["REPLY_BACKENDS"] = os.getenv("REPLY_BACKENDS") or (
+        "faq,assistants" if app.config["KNOWLEDGE_FAST_TIER"] else "assistants"
     )
+    app.config["REPLY_TIMEOUTS"] = os.getenv("REPLY_TIMEOUTS", "")
+    app.config["REPLY_HEDGE_PERCENTILE"] = float(os.getenv("REPLY_HEDGE_PERCENTILE") or 0)
+    app.config["REPLY_POOL_SIZE"] = _get_int("REPLY_POOL_SIZE", 16)
+    # Model of the chat and conversation backends
+    app.config["CHAT_MODEL"] = os.getenv("CHAT_MODEL") or app.config["FAST_ANSWER_MODEL"]
+
+    # Local conversation history for the "conversation" backend: per-user messages in
+    # SQLite, prompts held to CONVERSATION_TOKEN_BUDGET tokens of history; older messages
+    # are summarized in the background (CONVERSATION_SUMMARIZE) or just dropped
+    app.config["CONVERSATION_DB_PATH"] = os.getenv("CONVERSATION_DB_PATH") or data_path("conversations.sqlite3")
+    app.config["CONVERSATION_TOKEN_BUDGET"] = _get_int("CONVERSATION_TOKEN_BUDGET", 2000)
+    app.config["CONVERSATION_SUMMARIZE"] = _get_bool("CONVERSATION_SUMMARIZE", True)
+    app.config["CONVERSATION_CACHE_SIZE"] = _get_int("CONVERSATION_CACHE_SIZE", 1024)
+    # Messages and summaries older than this are deleted (0 keeps them forever)
+    app.config["CONVERSATION_RETENTION_SECONDS"] = _get_int("CONVERSATION_RETENTION_SECONDS", 30 * 86400)
+    # The faq backend answers from the knowledge index, so it has to be loaded
+    if "faq" in (name.strip() for name in app.config["REPLY_BACKENDS"].split(",")):
+        app.config["KNOWLEDGE_FAST_TIER"] = True
+
+    # Voice notes are streamed into a temp file (in memory up to AUDIO_SPOOL_BYTES)
+    # and rejected above AUDIO_MAX_BYTES; at most TRANSCRIPTION_CONCURRENCY are
+    # downloaded and transcribed at once
+    app.config["AUDIO_MAX_BYTES"] = _get_int("AUDIO_MAX_BYTES", 16 * 1024 * 1024)
+    app.config["AUDIO_SPOOL_BYTES"] = _get_int("AUDIO_SPOOL_BYTES", 1024 * 1024)
+    app.config["TRANSCRIPTION_CONCURRENCY"] = _get_int("TRANSCRIPTION_CONCURRENCY", 2)
+    app.config["TRANSCRIPTION_MODEL"] = os.getenv("TRANSCRIPTION_MODEL", "whisper-1")
+    app.config["TRANSCRIPT_CACHE_SIZE"] = _get_int("TRANSCRIPT_CACHE_SIZE", 500)
+    app.config["TRANSCRIPT_CACHE_TTL"] = _get_int("TRANSCRIPT_CACHE_TTL", 86400)
+
+    # asyncio server (run_async.py): maximum number of events processed at once
+    app.config["ASYNC_MAX_INFLIGHT"] = _get_int("ASYNC_MAX_INFLIGHT", 500)
+
+    # Delivery status tracking (sent/delivered/read/failed per message); empty path disables it
+    app.config["STATUS_DB_PATH"] = os.getenv("STATUS_DB_PATH", data_path("statuses.sqlite3"))
+    app.config["STATUS_FLUSH_INTERVAL"] = float(os.getenv("STATUS_FLUSH_INTERVAL") or 5.0)
+    app.config["STATUS_BATCH_SIZE"] = _get_int("STATUS_BATCH_SIZE", 500)
+    app.config["STATUS_BUFFER_MAX"] = _get_int("STATUS_BUFFER_MAX", 10000)
+
+    # /metrics endpoint; with METRICS_TOKEN set it requires "Authorization: Bearer <token>",
+    # without it only direct requests from localhost are answered (not via a proxy or ngrok)
+    app.config["METRICS_ENABLED"] = _get_bool("METRICS_ENABLED", True)
+    app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN", "")
+
+    # Opt-in request profiling: PROFILE_SAMPLE_RATE of requests (with PROFILING_ENABLED) and every
+    # request with the "X-Profile-Token: <PROFILE_ADMIN_TOKEN>" header; dumps go to PROFILE_DIR
+    app.config["PROFILING_ENABLED"] = _get_bool("PROFILING_ENABLED", False)
+    app.config["PROFILE_ADMIN_TOKEN"] = os.getenv("PROFILE_ADMIN_TOKEN", "")
+    app.config["PROFILE_SAMPLE_RATE"] = float(os.getenv("PROFILE_SAMPLE_RATE") or 0.01)
+    app.config["PROFILE_MODE"] = os.getenv("PROFILE_MODE") or "sampling"
+    app.config["PROFILE_INTERVAL"] = float(os.getenv("PROFILE_INTERVAL") or 0.005)
+    app.config["PROFILE_DIR"] = os.getenv("PROFILE_DIR") or data_path("profiles")
+    app.config["PROFILE_KEEP"] = _get_int("PROFILE_KEEP", 200)
+
+    # Webhook ingress: parse bodies with orjson when it is installed
+    app.config["INGRESS_FAST_JSON"] = _get_bool("INGRESS_FAST_JSON", True)
+
+    # Logging: async queue writer, "text" or "json" records, messages cut to LOG_MAX_FIELD_LENGTH
+    # characters (0 = no limit) and 1 in LOG_SAMPLE_EVERY repetitive events (status updates, sends)
+    app.config["LOG_LEVEL"] = os.getenv("LOG_LEVEL", "INFO").upper()
+    app.config["LOG_ASYNC"] = _get_bool("LOG_ASYNC", True)
+    app.config["LOG_QUEUE_SIZE"] = _get_int("LOG_QUEUE_SIZE", 10000)
+    app.config["LOG_FORMAT"] = os.getenv("LOG_FORMAT", "text").lower()
+    app.config["LOG_MAX_FIELD_LENGTH"] = _get_int("LOG_MAX_FIELD_LENGTH", 1000)
+    app.config["LOG_SAMPLE_EVERY"] = _get_int("LOG_SAMPLE_EVERY", 1)
+
+
+def _stop_log_listener():
+    global _log_listener, _log_handler
+    if _log_listener is not None:
+        _log_listener.stop()
+        if _log_handler.dropped:
+            # The queue is gone; report the loss straight to the output handlers
+            record = logging.makeLogRecord({
+                "name": __name__,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"{_log_handler.dropped} log records were dropped because the log queue was full",
+            })
+            for handler in _log_listener.handlers:
+                handler.handle(record)
+        _log_listener = None
+        _log_handler = None
+
+
+def log_stats():
+    """
+    Queue depth and dropped records of the LOG_ASYNC handler, for /metrics.
+    """
+    if _log_handler is None:
+        return {"queued": 0, "queue_size": 0, "dropped": 0}
+    return _log_handler.stats()
+
+
+# Flush queued records on shutdown
+atexit.register(_stop_log_listener)
+
+
+def configure_logging(config=None):
+    """
+    Set up the root logger. With LOG_ASYNC, callers only put records on a
+    bounded queue and a QueueListener thread formats and writes them; records
+    are dropped rather than blocking when the queue is full.
+    """
+    global _log_listener, _log_handler
+    config = config or {}
+    level = config.get("LOG_LEVEL", "INFO")
+    if config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    filters = [
+        SamplingFilter(config.get("LOG_SAMPLE_EVERY", 1)),
+        TruncatingFilter(config.get("LOG_MAX_FIELD_LENGTH", 0)),
+    ]
+
+    # create_app may run more than once per process (tests, bench); replace our handlers
+    _stop_log_listener()
+
+    if config.get("LOG_ASYNC"):
+        handler = _log_handler = DroppingQueueHandler(queue.Queue(config.get("LOG_QUEUE_SIZE", 10000)))
+        _log_listener = logging.handlers.QueueListener(handler.queue, stream_handler)
+        _log_listener.start()
+    else:
+        handler = stream_handler
+    for log_filter in filters:
+        handler.addFilter(log_filter)
+
+    logging.basicConfig(level=level, handlers=[handler], force=True)
@@ -1,30 +1,8 @@
-import json
 import logging
-import hmac
-import hashlib
 from functools import wraps
-from flask import current_app, request, jsonify
-
-def validate_signature(raw_payload_string, signature):
-    """
-    Validate the incoming raw payload string's signature against our expected signature.
-    WhatsApp signs the raw JSON string directly.
-    """
-    # Zuerst den rohen Payload-String in Bytes umwandeln, wie WhatsApp ihn gesendet hat
-    raw_payload_bytes = raw_payload_string.encode("utf-8") # WICHTIG: Hier utf-8 verwenden
-
-    app_secret_bytes = bytes(current_app.config["APP_SECRET"], "latin-1") # Dein App-Geheimnis in Bytes
-
-    # Die erwartete Signatur vom rohen Payload berechnen
-    expected_signature = hmac.new(
-        app_secret_bytes,
-        msg=raw_payload_bytes, # Hier die rohen Bytes verwenden
-        digestmod=hashlib.sha256
-    ).hexdigest()
-
-    # Signaturen vergleichen
-    return hmac.compare_digest(expected_signature, signature)
-
+from flask import request, jsonify
+from ..services.ingress import ingress
+from ..services.metrics import metrics
 
 def signature_required(f):
     """
@@ -32,21 +10,16 @@ def signature_required(f):
     """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # WhatsApp sendet die Signatur im Header als "sha256=xxx". Wir schneiden "sha256=" ab.
-        received_signature = request.headers.get("X-Hub-Signature-256", "")[7:]
-
-        # Den rohen Payload-Body als String dekodieren, um ihn an validate_signature zu übergeben.
-        # request.data ist bereits bytes, wir müssen es dekodieren, um es als string zu übergeben
-        raw_payload_string = request.data.decode("utf-8")
-
-        # Die Signatur mit dem rohen Payload-String validieren
-        if not validate_signature(raw_payload_string, received_signature):
+        # WhatsApp sendet die Signatur im Header als "sha256=xxx".
+        # Geprüft werden die rohen Bytes des Bodies mit dem beim Start vorberechneten HMAC-Schlüssel;
+        # get_data() speichert sie zwischen, die umwickelte Funktion liest sie ohne Kopie erneut.
+        received_signature = request.headers.get("X-Hub-Signature-256", "")
+        with metrics.time("signature", "webhook"):
+            valid = ingress.verify(request.get_data(cache=True), received_signature)
+        if not valid:
             logging.info("Signature verification failed! (Calculated mismatch)")
             return jsonify({"status": "error", "message": "Invalid signature"}), 403
 
-        # Wenn die Signatur gültig ist, die ursprüngliche Funktion ausführen.
-        # Der request.data und request.json (falls Content-Type application/json ist)
-        # sind immer noch für die umwickelte Funktion (handle_message) verfügbar.
         return f(*args, **kwargs)
 
     return decorated_function
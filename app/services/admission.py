@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class Overloaded(Exception):
+    """
+    Raised when a call is not admitted. `reason` is "circuit_open",
+    "queue_full" or "wait_timeout".
+    """
+
+    def __init__(self, reason):
+        super().__init__(f"Assistant backend overloaded ({reason})")
+        self.reason = reason
+
+
+class Ticket:
+    """
+    Handed out for an admitted call. Calls that return a fallback instead of
+    raising mark themselves with fail() so the circuit breaker sees them.
+    """
+
+    __slots__ = ("failed",)
+
+    def __init__(self):
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+class _Waiter:
+    __slots__ = ("wake", "granted", "reason")
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+        self.reason = None
+
+
+class AdmissionController:
+    """
+    Admission control and circuit breaker for a slow backend (the assistant).
+
+    At most `max_inflight` calls run at once; up to `max_waiting` more wait
+    in FIFO order for at most `max_wait` seconds, and anything beyond that is
+    rejected right away with Overloaded. A finished call hands its slot
+    directly to the oldest waiter. After `failure_threshold` consecutive
+    failures (exceptions, timeouts, runs without a reply) the breaker opens
+    and rejects every call for `reset_timeout` seconds; then a single trial
+    call decides whether it closes again. Threads wait with admit(),
+    coroutines with admit_async(); both share the same slots.
+    """
+
+    def __init__(self, max_inflight=8, max_waiting=32, max_wait=10.0, failure_threshold=5, reset_timeout=30.0):
+        self.max_inflight = max_inflight
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self._inflight = 0
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.admitted = 0
+        self.rejected = {"circuit_open": 0, "queue_full": 0, "wait_timeout": 0}
+        self.trips = 0
+
+    def init_app(self, app):
+        self.max_inflight = app.config["ADMISSION_MAX_INFLIGHT"]
+        self.max_waiting = app.config["ADMISSION_MAX_WAITING"]
+        self.max_wait = app.config["ADMISSION_MAX_WAIT_SECONDS"]
+        self.failure_threshold = app.config["BREAKER_FAILURE_THRESHOLD"]
+        self.reset_timeout = app.config["BREAKER_RESET_SECONDS"]
+        app.extensions["admission"] = self
+
+    @property
+    def enabled(self):
+        return self.max_inflight > 0
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        raise Overloaded(reason)
+
+    def _try_enter(self):
+        """
+        Take a slot if one is free. Returns False if the caller has to wait,
+        raises Overloaded if it must not. Called with the lock held.
+        """
+        if self._state == OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                self._reject("circuit_open")
+            self._state = HALF_OPEN
+            logging.info("Circuit breaker half-open, letting one trial call through")
+        if self._state == HALF_OPEN:
+            if self._trial_running:
+                self._reject("circuit_open")
+            self._trial_running = True
+        if self._inflight < self.max_inflight and not self._waiters:
+            self._inflight += 1
+            self.admitted += 1
+            return True
+        if self._state == HALF_OPEN:
+            # The trial call can't start right now; let the next caller try instead
+            self._trial_running = False
+        if len(self._waiters) >= self.max_waiting:
+            self._reject("queue_full")
+        return False
+
+    def _give_up(self, waiter):
+        """
+        Called after a wait timed out. Returns True if the slot arrived in the meantime.
+        """
+        with self._lock:
+            if waiter.granted:
+                return True
+            if waiter.reason is None:
+                self._waiters.remove(waiter)
+                waiter.reason = "wait_timeout"
+                self.rejected["wait_timeout"] += 1
+        raise Overloaded(waiter.reason)
+
+    def acquire(self):
+        with self._lock:
+            if self._try_enter():
+                return
+            event = threading.Event()
+            waiter = _Waiter(event.set)
+            self._waiters.append(waiter)
+        if event.wait(self.max_wait) and waiter.granted:
+            return
+        self._give_up(waiter)
+
+    async def acquire_async(self):
+        with self._lock:
+            if self._try_enter():
+                return
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+
+            def wake():
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+            waiter = _Waiter(wake)
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._hand_over()
+                elif waiter.reason is None:
+                    self._waiters.remove(waiter)
+            raise
+        if not waiter.granted:
+            self._give_up(waiter)
+
+    def release(self, ok):
+        with self._lock:
+            if ok:
+                if self._state != CLOSED:
+                    logging.info("Circuit breaker closed again")
+                self._state = CLOSED
+                self._failures = 0
+            else:
+                self._failures += 1
+                if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                    self._state = OPEN
+                    self._opened_at = time.monotonic()
+                    self.trips += 1
+                    logging.warning(
+                        f"Circuit breaker open after {self._failures} consecutive failures, "
+                        f"rejecting calls for {self.reset_timeout}s"
+                    )
+            self._trial_running = False
+            self._hand_over()
+
+    def _hand_over(self):
+        """
+        Pass a finished call's slot to the oldest waiter, or free it. Called with the lock held.
+        """
+        if self._state == OPEN:
+            # Nobody gets through for a while; waiting longer would only delay the busy reply
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.reason = "circuit_open"
+                self.rejected["circuit_open"] += 1
+                waiter.wake()
+        elif self._waiters:
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            self.admitted += 1
+            waiter.wake()
+            return
+        self._inflight -= 1
+
+    @contextmanager
+    def admit(self):
+        """
+        Hold a slot for the block. Raises Overloaded if the call is not admitted.
+        """
+        ticket = Ticket()
+        if not self.enabled:
+            yield ticket
+            return
+        self.acquire()
+        try:
+            yield ticket
+        except BaseException:
+            self.release(False)
+            raise
+        self.release(not ticket.failed)
+
+    @asynccontextmanager
+    async def admit_async(self):
+        ticket = Ticket()
+        if not self.enabled:
+            yield ticket
+            return
+        await self.acquire_async()
+        try:
+            yield ticket
+        except BaseException:
+            self.release(False)
+            raise
+        self.release(not ticket.failed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "inflight": self._inflight,
+                "waiting": len(self._waiters),
+                "admitted": self.admitted,
+                "rejected_circuit_open": self.rejected["circuit_open"],
+                "rejected_queue_full": self.rejected["queue_full"],
+                "rejected_wait_timeout": self.rejected["wait_timeout"],
+                "breaker_open": int(self._state != CLOSED),
+                "breaker_trips": self.trips,
+            }
+
+
+admission = AdmissionController()
@@ -0,0 +1,183 @@
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(text):
+    """
+    Normalize a question for cache lookups: Unicode NFKC, case folding,
+    no punctuation or emoji, collapsed whitespace.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def _vector(normalized):
+    return Counter(normalized.split())
+
+
+def _cosine(a, b):
+    dot = sum(count * b.get(token, 0) for token, count in a.items())
+    if not dot:
+        return 0.0
+    norm_a = sum(count * count for count in a.values()) ** 0.5
+    norm_b = sum(count * count for count in b.values()) ** 0.5
+    return dot / (norm_a * norm_b)
+
+
+class AnswerCache:
+    """
+    Caches answers by normalized question text, shared across all users.
+    Only answers that don't depend on who asked belong here (see
+    ReplyRouter.cacheable); replies built from a user's thread would leak
+    their booking details to whoever asks something similar.
+
+    Entries expire after `ttl` seconds and the least recently used entry is
+    evicted beyond `maxsize`. The whole cache is dropped when the knowledge
+    file changes (checked by mtime and size at most every few seconds).
+    With `similarity` > 0, a miss falls back to the most similar cached
+    question by word-count cosine, found through an inverted word index.
+    """
+
+    def __init__(self, ttl=86400, maxsize=500, similarity=0.0, knowledge_file=None):
+        self.enabled = False
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.similarity = similarity
+        self.knowledge_file = knowledge_file
+        self.check_interval = 10.0
+        self._entries = OrderedDict()
+        self._index = {}
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.enabled = app.config["ANSWER_CACHE_ENABLED"]
+        self.ttl = app.config["ANSWER_CACHE_TTL"]
+        self.maxsize = app.config["ANSWER_CACHE_SIZE"]
+        self.similarity = app.config["ANSWER_CACHE_SIMILARITY"]
+        self.knowledge_file = app.config["KNOWLEDGE_FILE"]
+        self.invalidate()
+        app.extensions["answer_cache"] = self
+
+    def _knowledge_fingerprint(self):
+        try:
+            stat = os.stat(self.knowledge_file)
+        except (OSError, TypeError):
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _check_knowledge_file(self, now):
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        fingerprint = self._knowledge_fingerprint()
+        if fingerprint != self._fingerprint:
+            if self._fingerprint is not None:
+                logging.info("Knowledge file changed, clearing answer cache")
+            self._clear()
+            self._fingerprint = fingerprint
+
+    def _clear(self):
+        self._entries.clear()
+        self._index.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for token in entry["vector"]:
+            keys = self._index.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[token]
+
+    def _nearest(self, vector, now):
+        candidates = set()
+        for token in vector:
+            candidates.update(self._index.get(token, ()))
+        best_key, best_score = None, 0.0
+        for key in candidates:
+            entry = self._entries[key]
+            if entry["expires_at"] <= now:
+                continue
+            score = _cosine(vector, entry["vector"])
+            if score > best_score:
+                best_key, best_score = key, score
+        if best_score >= self.similarity:
+            return best_key
+        return None
+
+    def get(self, question):
+        if not self.enabled:
+            return None
+        key = normalize_question(question)
+        now = time.monotonic()
+        with self._lock:
+            self._check_knowledge_file(now)
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] <= now:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["answer"]
+
+            if self.similarity > 0 and key:
+                near_key = self._nearest(_vector(key), now)
+                if near_key is not None:
+                    self._entries.move_to_end(near_key)
+                    self.near_hits += 1
+                    return self._entries[near_key]["answer"]
+
+            self.misses += 1
+            return None
+
+    def put(self, question, answer):
+        if not self.enabled:
+            return
+        key = normalize_question(question)
+        if not key:
+            return
+        vector = _vector(key)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "answer": answer,
+                "vector": vector,
+                "expires_at": time.monotonic() + self.ttl,
+            }
+            for token in vector:
+                self._index.setdefault(token, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+            self._fingerprint = self._knowledge_fingerprint()
+            self._checked_at = time.monotonic()
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+        }
+
+
+answer_cache = AnswerCache()
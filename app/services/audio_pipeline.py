@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.services import openai_service
+from app.services.graph_api import graph_client, GraphAPIError
+from app.services.metrics import metrics
+
+
+class AudioDownloadError(Exception):
+    pass
+
+
+class AudioTooLargeError(AudioDownloadError):
+    pass
+
+
+class TranscriptionError(Exception):
+    pass
+
+
+class TranscriptCache:
+    """
+    LRU cache with TTL for transcripts, keyed by media ID and content hash.
+    """
+
+    def __init__(self, maxsize=500, ttl=86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, text):
+        with self._lock:
+            self._entries[key] = (text, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class AudioPipeline:
+    """
+    Downloads and transcribes WhatsApp voice notes.
+
+    Downloads are streamed into a spooled temporary file (kept in memory up
+    to spool_bytes, then on disk) and aborted beyond max_bytes. Download and
+    Whisper call run on a dedicated pool of `concurrency` threads, so memory
+    use stays bounded no matter how many voice notes arrive at once.
+    Transcripts are cached by media ID and by content hash, so a retried
+    webhook or a forwarded voice note does not pay for Whisper twice.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, concurrency=2, max_bytes=16 * 1024 * 1024, spool_bytes=1024 * 1024):
+        self.concurrency = concurrency
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.model = "whisper-1"
+        self.cache = TranscriptCache()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.concurrency = app.config["TRANSCRIPTION_CONCURRENCY"]
+        self.max_bytes = app.config["AUDIO_MAX_BYTES"]
+        self.spool_bytes = app.config["AUDIO_SPOOL_BYTES"]
+        self.model = app.config["TRANSCRIPTION_MODEL"]
+        self.cache = TranscriptCache(
+            maxsize=app.config["TRANSCRIPT_CACHE_SIZE"],
+            ttl=app.config["TRANSCRIPT_CACHE_TTL"],
+        )
+        app.extensions["audio_pipeline"] = self
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.concurrency, thread_name_prefix="transcription"
+                    )
+        return self._executor
+
+    def _download(self, media_id):
+        """
+        Stream the media into a spooled temp file. Returns (file, sha256 hex).
+        """
+        url = graph_client.get_media_url(media_id)
+        try:
+            response = graph_client.download_media(url, stream=True)
+        except GraphAPIError as e:
+            raise AudioDownloadError(str(e)) from e
+
+        spooled = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with response:
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise AudioTooLargeError(
+                            f"Voice note {media_id} exceeds {self.max_bytes} bytes"
+                        )
+                    digest.update(chunk)
+                    spooled.write(chunk)
+        except AudioDownloadError:
+            spooled.close()
+            raise
+        except Exception as e:
+            spooled.close()
+            raise AudioDownloadError(f"Download of {media_id} failed: {e}") from e
+        spooled.seek(0)
+        return spooled, digest.hexdigest()
+
+    def _process(self, media_id):
+        with metrics.time("media", "audio"):
+            audio_file, content_hash = self._download(media_id)
+        with audio_file:
+            cached = self.cache.get(f"sha256:{content_hash}")
+            if cached is not None:
+                return cached
+            try:
+                with metrics.time("whisper", "audio"):
+                    transcript = openai_service.client.audio.transcriptions.create(
+                        model=self.model,
+                        file=("audio.ogg", audio_file),
+                        response_format="text",
+                    )
+            except Exception as e:
+                raise TranscriptionError(str(e)) from e
+        self.cache.put(f"sha256:{content_hash}", transcript)
+        return transcript
+
+    def transcribe(self, media_id):
+        """
+        Return the transcript of a voice note. Raises GraphAPIError if the
+        media lookup fails, AudioDownloadError (or AudioTooLargeError) if the
+        download fails and TranscriptionError if Whisper fails.
+        """
+        cached = self.cache.get(f"media:{media_id}")
+        if cached is not None:
+            logging.info(f"Transcript cache hit for media {media_id}")
+            return cached
+
+        transcript = self.executor.submit(self._process, media_id).result()
+        self.cache.put(f"media:{media_id}", transcript)
+        return transcript
+
+    def stats(self):
+        return {
+            "cached": len(self.cache._entries),
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+        }
+
+
+audio_pipeline = AudioPipeline()
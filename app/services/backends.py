@@ -0,0 +1,497 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from app.services import openai_service
+from app.services.admission import admission
+from app.services.conversation_store import conversation_store, count_tokens
+from app.services.knowledge_index import knowledge_index
+from app.services.metrics import metrics
+from app.services.thread_store import thread_store
+
+# Assistant used by the "assistants" backend; OPENAI_ASSISTANT_ID overrides it
+ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID") or "asst_1MqcBju8sZsGXqXLfmfVQotP"
+
+# Outcome of ReplyRouter.reply(): text is None if no backend answered, error is
+# the last failure then (Overloaded if the assistant shed the request).
+Reply = namedtuple("Reply", ["text", "backend", "streamed", "error"])
+
+
+class ReplyRequest:
+    """
+    One message to answer. send_part, if given, lets a backend stream the
+    reply part by part; the router only allows that while the reply can
+    still be taken back, i.e. for an unhedged first attempt.
+    """
+
+    def __init__(self, wa_id, text, message_type="text", name=None, send_part=None):
+        self.wa_id = wa_id
+        self.text = text
+        self.message_type = message_type
+        self.name = name
+        self._send_part = send_part
+        self.hedged = False
+        self.abandoned = False
+        self.streamed = False
+
+    @property
+    def can_stream(self):
+        return self._send_part is not None and not self.hedged and not self.abandoned
+
+    def send_part(self, part):
+        # Parts of an attempt the router already gave up on must not reach the user
+        if self.abandoned:
+            return
+        self.streamed = True
+        self._send_part(part)
+
+
+class ReplyBackend:
+    """
+    Something that turns a message into a reply. generate() returns the
+    reply text, or None if this backend has no answer (the router then asks
+    the next one); exceptions count as failures. `timeout` is the deadline
+    the router enforces for one call. Backends whose replies depend only on
+    the message text, not on who sent it, set `context_free`; only their
+    replies may be shared with other users through the answer cache.
+    """
+
+    name = None
+    default_timeout = 30.0
+    context_free = False
+
+    def __init__(self, config, timeout):
+        self.timeout = timeout
+
+    def generate(self, request, timeout):
+        raise NotImplementedError
+
+    async def generate_async(self, request, timeout):
+        return await asyncio.to_thread(self.generate, request, timeout)
+
+
+class EchoBackend(ReplyBackend):
+    """
+    Replies with the message in uppercase. For local testing without OpenAI.
+    """
+
+    name = "echo"
+    default_timeout = 1.0
+    context_free = True
+
+    def generate(self, request, timeout):
+        return request.text.upper()
+
+    async def generate_async(self, request, timeout):
+        return request.text.upper()
+
+
+class FaqBackend(ReplyBackend):
+    """
+    Answers from the local knowledge index: if a passage matches with at
+    least KNOWLEDGE_MIN_CONFIDENCE, a cheap model answers from the matched
+    passages in one call. No confident match means no answer.
+    """
+
+    name = "faq"
+    default_timeout = 10.0
+    context_free = True
+
+    def __init__(self, config, timeout):
+        super().__init__(config, timeout)
+        self.min_confidence = config["KNOWLEDGE_MIN_CONFIDENCE"]
+
+    def _passages(self, text):
+        matches = knowledge_index.search(text, k=3)
+        if matches and matches[0][1] >= self.min_confidence:
+            return [chunk for _, _, chunk in matches]
+        return None
+
+    def generate(self, request, timeout):
+        passages = self._passages(request.text)
+        if passages is None:
+            return None
+        with metrics.time("knowledge", request.message_type):
+            return openai_service.answer_from_context(request.text, passages, timeout=timeout)
+
+    async def generate_async(self, request, timeout):
+        passages = self._passages(request.text)
+        if passages is None:
+            return None
+        with metrics.time("knowledge", request.message_type):
+            return await openai_service.answer_from_context_async(request.text, passages, timeout=timeout)
+
+
+class ChatBackend(ReplyBackend):
+    """
+    A single Chat Completions call without conversation history.
+    """
+
+    name = "chat"
+    default_timeout = 15.0
+    context_free = True
+
+    def generate(self, request, timeout):
+        return openai_service.chat_reply(request.text, timeout=timeout)
+
+    async def generate_async(self, request, timeout):
+        return await openai_service.chat_reply_async(request.text, timeout=timeout)
+
+
+class ConversationBackend(ReplyBackend):
+    """
+    Chat Completions with the conversation history kept locally: one API
+    call per turn, with the prompt held to CONVERSATION_TOKEN_BUDGET by the
+    conversation store (recent messages plus a running summary).
+    """
+
+    name = "conversation"
+    default_timeout = 20.0
+
+    def __init__(self, config, timeout):
+        super().__init__(config, timeout)
+        conversation_store.set_summarizer(openai_service.summarize_conversation)
+
+    def generate(self, request, timeout):
+        messages = conversation_store.prompt(request.wa_id, openai_service.CHAT_INSTRUCTIONS, request.text)
+        with metrics.time("chat", request.message_type):
+            reply_text = openai_service.chat_completion(messages, timeout=timeout)
+        if reply_text:
+            conversation_store.append(request.wa_id, ("user", request.text), ("assistant", reply_text))
+        return reply_text or None
+
+    async def generate_async(self, request, timeout):
+        # The store reads and writes SQLite, so it is called off the event loop
+        messages = await asyncio.to_thread(
+            conversation_store.prompt, request.wa_id, openai_service.CHAT_INSTRUCTIONS, request.text
+        )
+        with metrics.time("chat", request.message_type):
+            reply_text = await openai_service.chat_completion_async(messages, timeout=timeout)
+        if reply_text:
+            await asyncio.to_thread(
+                conversation_store.append, request.wa_id, ("user", request.text), ("assistant", reply_text)
+            )
+        return reply_text or None
+
+
+class AssistantsBackend(ReplyBackend):
+    """
+    The OpenAI Assistant on the user's persistent thread. Runs go through
+    admission control; with ASSISTANT_STREAMING the reply is streamed part
+    by part when the request allows it, falling back to polling if the
+    stream fails before the first part.
+    """
+
+    name = "assistants"
+    default_timeout = 60.0
+
+    def __init__(self, config, timeout):
+        super().__init__(config, timeout)
+        self.assistant_id = ASSISTANT_ID
+        self.streaming = config["ASSISTANT_STREAMING"]
+
+    def generate(self, request, timeout):
+        deadline = time.monotonic() + timeout
+        with admission.admit() as ticket:
+            with metrics.time("thread", request.message_type):
+                thread_id = openai_service.add_user_message(request.wa_id, request.text)
+            logging.info(f"Added message to thread {thread_id}")
+
+            if self.streaming and request.can_stream:
+                try:
+                    with metrics.time("run", request.message_type):
+                        reply_text = openai_service.stream_thread(thread_id, self.assistant_id, request.send_part)
+                    if not request.streamed:
+                        ticket.fail()
+                        return None
+                    thread_store.touch(request.wa_id, tokens=count_tokens(reply_text), thread_id=thread_id)
+                    return reply_text
+                except Exception as e:
+                    if request.streamed:
+                        raise
+                    logging.warning(f"Streaming failed, falling back to polling: {e}")
+
+            with metrics.time("run", request.message_type):
+                reply_text = openai_service.run_thread(
+                    thread_id, self.assistant_id, timeout=max(deadline - time.monotonic(), 0.0)
+                )
+            if reply_text is None:
+                ticket.fail()
+            else:
+                thread_store.touch(request.wa_id, tokens=count_tokens(reply_text), thread_id=thread_id)
+            return reply_text
+
+    async def generate_async(self, request, timeout):
+        deadline = time.monotonic() + timeout
+        async with admission.admit_async() as ticket:
+            with metrics.time("thread", request.message_type):
+                thread_id = await openai_service.add_user_message_async(request.wa_id, request.text)
+            with metrics.time("run", request.message_type):
+                reply_text = await openai_service.run_assistant_async(
+                    thread_id, self.assistant_id, timeout=max(deadline - time.monotonic(), 0.0)
+                )
+            if reply_text is None:
+                ticket.fail()
+            else:
+                await asyncio.to_thread(
+                    thread_store.touch, request.wa_id, tokens=count_tokens(reply_text), thread_id=thread_id
+                )
+            return reply_text
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (AssistantsBackend, ConversationBackend, ChatBackend, FaqBackend, EchoBackend)
+}
+
+
+def register_backend(backend_class):
+    """
+    Make a ReplyBackend subclass available to REPLY_BACKENDS under its name.
+    Can be used as a class decorator.
+    """
+    BACKENDS[backend_class.name] = backend_class
+    return backend_class
+
+
+def parse_timeouts(value):
+    """
+    Parse "assistants=45,chat=10" into {"assistants": 45.0, "chat": 10.0}.
+    """
+    timeouts = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, seconds = item.split("=", 1)
+            timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+
+class ReplyRouter:
+    """
+    Generates replies through an ordered chain of backends (REPLY_BACKENDS).
+
+    Every call gets its backend's deadline; a backend that fails, times out
+    or has no answer hands the message to the next one. With
+    REPLY_HEDGE_PERCENTILE set, a call that is still running after that
+    percentile of its backend's recent latencies starts the next backend in
+    parallel and the first answer wins, which caps the tail latency at
+    roughly the percentile plus the secondary's latency. Calls the router
+    gave up on keep running in the background until they finish (threads
+    can't be interrupted), but their results are dropped.
+    """
+
+    def __init__(self):
+        self.chain = []
+        self.hedge_percentile = 0.0
+        self.hedge_min_samples = 20
+        self._latencies = {}
+        self._executor = None
+        self._lock = threading.Lock()
+        self.answered = {}
+        self.failures = {}
+        self.timeouts = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.unanswered = 0
+
+    def init_app(self, app):
+        timeouts = parse_timeouts(app.config["REPLY_TIMEOUTS"])
+        chain = []
+        for name in app.config["REPLY_BACKENDS"].split(","):
+            name = name.strip()
+            if not name:
+                continue
+            if name not in BACKENDS:
+                raise ValueError(f"Unknown reply backend {name!r}, available: {', '.join(sorted(BACKENDS))}")
+            backend_class = BACKENDS[name]
+            chain.append(backend_class(app.config, timeouts.get(name, backend_class.default_timeout)))
+        if not chain:
+            raise ValueError("REPLY_BACKENDS must name at least one backend")
+        self.chain = chain
+        self.hedge_percentile = app.config["REPLY_HEDGE_PERCENTILE"]
+        self._latencies = {backend.name: deque(maxlen=200) for backend in chain}
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=app.config["REPLY_POOL_SIZE"], thread_name_prefix="reply"
+            )
+        app.extensions["reply_router"] = self
+        logging.info(f"Reply backends: {' -> '.join(backend.name for backend in chain)}")
+
+    def _hedge_delay(self, backend):
+        """
+        Seconds after which a call to backend gets hedged, or None while
+        hedging is off or there are too few latency samples.
+        """
+        if not self.hedge_percentile:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies[backend.name])
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(int(len(samples) * self.hedge_percentile), len(samples) - 1)]
+
+    def _record(self, backend, outcome, latency=None):
+        with self._lock:
+            counter = getattr(self, outcome)
+            counter[backend.name] = counter.get(backend.name, 0) + 1
+            if latency is not None:
+                self._latencies[backend.name].append(latency)
+
+    def _run(self, backend, request):
+        started = time.monotonic()
+        text = backend.generate(request, backend.timeout)
+        latency = time.monotonic() - started
+        metrics.observe(f"backend_{backend.name}", request.message_type, latency)
+        return text, latency
+
+    async def _run_async(self, backend, request):
+        started = time.monotonic()
+        text = await asyncio.wait_for(backend.generate_async(request, backend.timeout), backend.timeout)
+        latency = time.monotonic() - started
+        metrics.observe(f"backend_{backend.name}", request.message_type, latency)
+        return text, latency
+
+    def _attempt(self, index):
+        """
+        (backend, hedge backend or None, hedge delay) for the chain step starting at index.
+        The step after it starts at index + 2 if the hedge was started, else at index + 1.
+        """
+        backend = self.chain[index]
+        delay = self._hedge_delay(backend)
+        if delay is not None and index + 1 < len(self.chain):
+            return backend, self.chain[index + 1], delay
+        return backend, None, None
+
+    def _settle(self, backend, future_or_task):
+        """
+        Turn a finished call into (text, error) and record the outcome.
+        """
+        try:
+            text, latency = future_or_task.result()
+        except Exception as e:
+            if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+                self._record(backend, "timeouts")
+                logging.warning(f"Reply backend {backend.name} timed out after {backend.timeout}s")
+            else:
+                self._record(backend, "failures")
+                logging.warning(f"Reply backend {backend.name} failed: {e}")
+            return None, e
+        if text is None:
+            return None, None
+        self._record(backend, "answered", latency)
+        return text, None
+
+    def reply(self, request):
+        """
+        Ask the backends in order and return a Reply.
+        """
+        error = None
+        index = 0
+        while index < len(self.chain):
+            backend, hedge, delay = self._attempt(index)
+            request.hedged = hedge is not None
+            futures = {self._executor.submit(self._run, backend, request): backend}
+            deadline = time.monotonic() + backend.timeout
+            index += 1
+            if hedge is not None:
+                done, _ = wait(futures, timeout=delay)
+                if not done:
+                    with self._lock:
+                        self.hedges += 1
+                    futures[self._executor.submit(self._run, hedge, request)] = hedge
+                    deadline = max(deadline, time.monotonic() + hedge.timeout)
+                    index += 1
+                # Otherwise the primary finished early and the hedge backend runs as the next step
+
+            while futures:
+                done, _ = wait(futures, timeout=max(deadline - time.monotonic(), 0.0), return_when=FIRST_COMPLETED)
+                if not done:
+                    for pending in futures.values():
+                        self._record(pending, "timeouts")
+                        logging.warning(f"Reply backend {pending.name} timed out after {pending.timeout}s")
+                    error = TimeoutError("reply deadline exceeded")
+                    # The timed-out calls keep running and must not stream into the next backend's reply
+                    request.abandoned = True
+                    break
+                for future in done:
+                    answered_by = futures.pop(future)
+                    text, failure = self._settle(answered_by, future)
+                    error = failure or error
+                    if text is not None:
+                        if answered_by is hedge:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        # The reply is complete; a losing hedge or an earlier timed-out call must not add to it
+                        request.abandoned = True
+                        return Reply(text, answered_by.name, request.streamed, None)
+
+            if request.streamed:
+                # Part of this reply is already out; another backend's answer would contradict it
+                break
+
+        with self._lock:
+            self.unanswered += 1
+        return Reply(None, None, request.streamed, error)
+
+    async def reply_async(self, request):
+        """
+        Like reply(), for the asyncio server. Timed-out calls are cancelled.
+        """
+        error = None
+        index = 0
+        while index < len(self.chain):
+            backend, hedge, delay = self._attempt(index)
+            request.hedged = hedge is not None
+            tasks = {asyncio.ensure_future(self._run_async(backend, request)): backend}
+            index += 1
+            if hedge is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    with self._lock:
+                        self.hedges += 1
+                    tasks[asyncio.ensure_future(self._run_async(hedge, request))] = hedge
+                    index += 1
+
+            try:
+                while tasks:
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        answered_by = tasks.pop(task)
+                        text, failure = self._settle(answered_by, task)
+                        error = failure or error
+                        if text is not None:
+                            if answered_by is hedge:
+                                with self._lock:
+                                    self.hedge_wins += 1
+                            return Reply(text, answered_by.name, False, None)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        with self._lock:
+            self.unanswered += 1
+        return Reply(None, None, False, error)
+
+    def cacheable(self, reply):
+        """
+        Whether reply may be served to other users from the answer cache.
+        Answers built from a user's thread or conversation history never are.
+        """
+        backend_class = BACKENDS.get(reply.backend)
+        return reply.text is not None and backend_class is not None and backend_class.context_free
+
+    def stats(self):
+        with self._lock:
+            stats = {"hedges": self.hedges, "hedge_wins": self.hedge_wins, "unanswered": self.unanswered}
+            for backend in self.chain:
+                stats[f"{backend.name}_answered"] = self.answered.get(backend.name, 0)
+                stats[f"{backend.name}_failures"] = self.failures.get(backend.name, 0)
+                stats[f"{backend.name}_timeouts"] = self.timeouts.get(backend.name, 0)
+        return stats
+
+
+reply_router = ReplyRouter()
@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+
+
+class MessageCoalescer:
+    """
+    Debounces rapid-fire messages per key (wa_id).
+
+    The first message of a key opens a window; every further message within
+    the window joins the batch and pushes the flush back, up to max_delay
+    after the first message. When the window closes, flush(key, items) is
+    called once with all buffered items (from a timer thread, inside an
+    application context).
+    """
+
+    def __init__(self, window=0.0, max_delay=None):
+        self.window = window
+        self.max_delay = max_delay or window * 3
+        self._app = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.batches = 0
+
+    def init_app(self, app):
+        self.window = app.config["COALESCE_WINDOW_SECONDS"]
+        self.max_delay = app.config["COALESCE_MAX_DELAY_SECONDS"] or self.window * 3
+        self._app = app
+        app.extensions["coalescer"] = self
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, key, item, flush):
+        """
+        Buffer item for key. Returns True if it opened a new batch.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.messages += 1
+            batch = self._pending.get(key)
+            if batch is not None:
+                batch["items"].append(item)
+                batch["last_at"] = now
+                return False
+            self._pending[key] = {
+                "items": [item],
+                "first_at": now,
+                "last_at": now,
+                "flush": flush,
+            }
+        self._schedule(key, self.window)
+        return True
+
+    def _schedule(self, key, delay):
+        timer = threading.Timer(delay, self._expire, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    def _expire(self, key):
+        now = time.monotonic()
+        with self._lock:
+            batch = self._pending[key]
+            quiet_until = batch["last_at"] + self.window
+            deadline = batch["first_at"] + self.max_delay
+            if now < quiet_until and now < deadline:
+                delay = min(quiet_until, deadline) - now
+            else:
+                del self._pending[key]
+                self.batches += 1
+                delay = None
+
+        if delay is not None:
+            self._schedule(key, delay)
+            return
+
+        try:
+            if self._app is not None:
+                with self._app.app_context():
+                    batch["flush"](key, batch["items"])
+            else:
+                batch["flush"](key, batch["items"])
+        except Exception as e:
+            logging.exception(f"Flushing coalesced messages for {key} failed: {e}")
+
+    def pending_counts(self):
+        with self._lock:
+            return {key: len(batch["items"]) for key, batch in self._pending.items()}
+
+    def stats(self):
+        return {
+            "messages": self.messages,
+            "batches": self.batches,
+            "pending_keys": len(self._pending),
+        }
+
+
+coalescer = MessageCoalescer()
@@ -0,0 +1,351 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils.sqlite_utils import ThreadLocalConnection
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # optional (pip install tiktoken); token counts are estimated instead
+    _encoding = None
+
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text)) + MESSAGE_OVERHEAD_TOKENS
+    # Roughly four characters per token for English and German text
+    return len(text) // 4 + 1 + MESSAGE_OVERHEAD_TOKENS
+
+
+class _Conversation:
+    __slots__ = ("summary", "summary_tokens", "covers_until", "messages", "tokens", "max_id")
+
+    def __init__(self, summary, summary_tokens, covers_until, messages, max_id):
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.covers_until = covers_until
+        # (id, role, content, tokens), oldest first, all newer than covers_until
+        self.messages = messages
+        self.tokens = sum(message[3] for message in messages)
+        # Newest message id in the store when this was loaded or last appended to
+        self.max_id = max_id
+
+
+class ConversationStore:
+    """
+    Locally kept chat history per wa_id for the Chat Completions path.
+
+    Messages are stored in SQLite (WAL mode) with their token counts, and the
+    conversations of active users are kept in a bounded LRU cache. prompt()
+    fills `token_budget` with the running summary and the newest messages;
+    older messages that no longer fit are folded into the summary by a
+    background summarizer and then deleted, which keeps both the prompt and
+    the store small no matter how long a guest has been chatting. Without a
+    summarizer they are simply deleted.
+
+    Before a cached conversation is used, one indexed query compares its
+    newest message id and summary with the database, so turns stored by
+    other server processes are picked up. At most twice the token budget of
+    messages is loaded and cached per user, and messages and summaries older
+    than `retention` seconds are deleted.
+    """
+
+    def __init__(self, path=None, token_budget=2000, summarize=True, cache_size=1024, retention=30 * 86400):
+        self.path = path
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.cache_size = cache_size
+        self.retention = retention
+        self._connection = ThreadLocalConnection(path, self._create_tables)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._summarizing = set()
+        self._summarizer = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-summary")
+        self._last_purge = 0.0
+        self.summaries = 0
+        self.summary_failures = 0
+        self.reloads = 0
+
+    def init_app(self, app):
+        self.path = app.config["CONVERSATION_DB_PATH"]
+        self.token_budget = app.config["CONVERSATION_TOKEN_BUDGET"]
+        self.summarize = app.config["CONVERSATION_SUMMARIZE"]
+        self.cache_size = app.config["CONVERSATION_CACHE_SIZE"]
+        self.retention = app.config["CONVERSATION_RETENTION_SECONDS"]
+        self._connection.path = self.path
+        with self._lock:
+            self._cache.clear()
+        app.extensions["conversation_store"] = self
+
+    def set_summarizer(self, summarizer):
+        """
+        summarizer(previous_summary, [(role, content), ...]) returns the new summary text.
+        """
+        self._summarizer = summarizer
+
+    @property
+    def summarizing(self):
+        return self.summarize and self._summarizer is not None
+
+    @property
+    def cache_tokens(self):
+        # The budget for the prompt plus as much again as backlog for the summarizer
+        return 2 * self.token_budget
+
+    @staticmethod
+    def _create_tables(connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, wa_id TEXT NOT NULL, role TEXT NOT NULL, "
+            "content TEXT NOT NULL, tokens INTEGER NOT NULL, created_at REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS conversation_messages_wa_id ON conversation_messages (wa_id, id)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_summaries ("
+            "wa_id TEXT PRIMARY KEY, summary TEXT NOT NULL, tokens INTEGER NOT NULL, "
+            "covers_until INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _version(self, wa_id):
+        """
+        (newest message id, id covered by the summary) of wa_id in the database.
+        """
+        max_id, covers_until = self._connection().execute(
+            "SELECT (SELECT MAX(id) FROM conversation_messages WHERE wa_id = ?), "
+            "(SELECT covers_until FROM conversation_summaries WHERE wa_id = ?)",
+            (wa_id, wa_id),
+        ).fetchone()
+        return max_id or 0, covers_until or 0
+
+    def _load(self, wa_id):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT summary, tokens, covers_until FROM conversation_summaries WHERE wa_id = ?", (wa_id,)
+        ).fetchone()
+        summary, summary_tokens, covers_until = row if row else (None, 0, 0)
+        # Newest first, and only as much as the cache keeps
+        messages, tokens = [], 0
+        for message in connection.execute(
+            "SELECT id, role, content, tokens FROM conversation_messages "
+            "WHERE wa_id = ? AND id > ? ORDER BY id DESC",
+            (wa_id, covers_until),
+        ):
+            if messages and tokens + message[3] > self.cache_tokens:
+                break
+            messages.append(message)
+            tokens += message[3]
+        messages.reverse()
+        return _Conversation(summary, summary_tokens, covers_until, messages, messages[-1][0] if messages else 0)
+
+    def _get(self, wa_id):
+        """
+        The cached conversation of wa_id, (re)loaded if the database has newer
+        messages or a newer summary. Must be called without the lock held.
+        """
+        max_id, covers_until = self._version(wa_id)
+        with self._lock:
+            conversation = self._cache.get(wa_id)
+            if (
+                conversation is not None
+                and conversation.max_id == max_id
+                and conversation.covers_until == covers_until
+            ):
+                self._cache.move_to_end(wa_id)
+                return conversation
+            if conversation is not None:
+                self.reloads += 1
+        conversation = self._load(wa_id)
+        with self._lock:
+            self._cache[wa_id] = conversation
+            self._cache.move_to_end(wa_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return conversation
+
+    def _trim(self, conversation):
+        """
+        Drop the oldest cached messages beyond cache_tokens. Returns the
+        oldest id still cached, or None if nothing was dropped. Called with
+        the lock held.
+        """
+        trimmed = False
+        while conversation.tokens > self.cache_tokens and len(conversation.messages) > 1:
+            conversation.tokens -= conversation.messages.pop(0)[3]
+            trimmed = True
+        return conversation.messages[0][0] if trimmed else None
+
+    def prompt(self, wa_id, system_prompt, text):
+        """
+        Chat messages for answering `text`: the system prompt (with the running
+        summary), as many recent messages as fit the token budget, and text.
+        """
+        budget = self.token_budget - count_tokens(text)
+        conversation = self._get(wa_id)
+        with self._lock:
+            if conversation.summary:
+                system_prompt = f"{system_prompt}\n\nSummary of the conversation so far:\n{conversation.summary}"
+                budget -= conversation.summary_tokens
+            history = []
+            for message_id, role, content, tokens in reversed(conversation.messages):
+                if tokens > budget:
+                    break
+                budget -= tokens
+                history.append({"role": role, "content": content})
+            overflow = len(conversation.messages) - len(history)
+        if overflow:
+            self._schedule_summary(wa_id)
+        history.reverse()
+        return [{"role": "system", "content": system_prompt}, *history, {"role": "user", "content": text}]
+
+    def append(self, wa_id, *messages):
+        """
+        Store (role, content) pairs, e.g. a user message and the reply to it.
+        """
+        now = time.time()
+        rows = [(wa_id, role, content, count_tokens(content), now) for role, content in messages]
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            previous_id = connection.execute(
+                "SELECT MAX(id) FROM conversation_messages WHERE wa_id = ?", (wa_id,)
+            ).fetchone()[0] or 0
+            stored = []
+            for row in rows:
+                cursor = connection.execute(
+                    "INSERT INTO conversation_messages (wa_id, role, content, tokens, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    row,
+                )
+                stored.append((cursor.lastrowid, row[1], row[2], row[3]))
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+
+        keep_from = None
+        with self._lock:
+            conversation = self._cache.get(wa_id)
+            if conversation is not None and conversation.max_id == previous_id:
+                conversation.messages.extend(stored)
+                conversation.tokens += sum(message[3] for message in stored)
+                conversation.max_id = stored[-1][0]
+                keep_from = self._trim(conversation)
+            elif conversation is not None:
+                # Another process added messages in between; load them with the next prompt
+                self._cache.pop(wa_id, None)
+        if keep_from is not None and not self.summarizing:
+            # Nobody will fold these into a summary and no prompt can use them any more
+            connection.execute(
+                "DELETE FROM conversation_messages WHERE wa_id = ? AND id < ?", (wa_id, keep_from)
+            )
+        if self.retention and now - self._last_purge > 3600:
+            self._last_purge = now
+            self.purge()
+
+    def purge(self):
+        """
+        Delete messages and summaries older than the retention period.
+        """
+        cutoff = time.time() - self.retention
+        connection = self._connection()
+        connection.execute("DELETE FROM conversation_messages WHERE created_at < ?", (cutoff,))
+        connection.execute("DELETE FROM conversation_summaries WHERE updated_at < ?", (cutoff,))
+
+    def _schedule_summary(self, wa_id):
+        if not self.summarizing:
+            return
+        with self._lock:
+            if wa_id in self._summarizing:
+                return
+            self._summarizing.add(wa_id)
+        self._executor.submit(self._summarize, wa_id)
+
+    def _summarize(self, wa_id):
+        """
+        Fold the older half of the budget's worth of messages into the summary.
+        """
+        try:
+            conversation = self._get(wa_id)
+            with self._lock:
+                summary = conversation.summary
+                # Keep the newest half of the budget verbatim, so the next few turns don't
+                # immediately trigger another summary
+                keep_budget = self.token_budget // 2
+                kept = 0
+                for index in range(len(conversation.messages) - 1, -1, -1):
+                    kept += conversation.messages[index][3]
+                    if kept > keep_budget:
+                        break
+                else:
+                    return
+                folded = conversation.messages[: index + 1]
+            if not folded:
+                return
+
+            new_summary = self._summarizer(summary, [(role, content) for _, role, content, _ in folded])
+            covers_until = folded[-1][0]
+            tokens = count_tokens(new_summary)
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT INTO conversation_summaries (wa_id, summary, tokens, covers_until, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT(wa_id) DO UPDATE SET summary = excluded.summary, "
+                    "tokens = excluded.tokens, covers_until = excluded.covers_until, "
+                    "updated_at = excluded.updated_at",
+                    (wa_id, new_summary, tokens, covers_until, time.time()),
+                )
+                connection.execute(
+                    "DELETE FROM conversation_messages WHERE wa_id = ? AND id <= ?", (wa_id, covers_until)
+                )
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+            with self._lock:
+                conversation = self._cache.get(wa_id)
+                if conversation is not None:
+                    conversation.summary = new_summary
+                    conversation.summary_tokens = tokens
+                    conversation.covers_until = covers_until
+                    conversation.messages = [m for m in conversation.messages if m[0] > covers_until]
+                    conversation.tokens = sum(m[3] for m in conversation.messages)
+                self.summaries += 1
+            logging.info(f"Summarized {len(folded)} older messages of {wa_id} ({tokens} tokens)")
+        except Exception as e:
+            self.summary_failures += 1
+            logging.warning(f"Summarizing the conversation of {wa_id} failed: {e}")
+        finally:
+            with self._lock:
+                self._summarizing.discard(wa_id)
+
+    def delete(self, wa_id):
+        connection = self._connection()
+        connection.execute("DELETE FROM conversation_messages WHERE wa_id = ?", (wa_id,))
+        connection.execute("DELETE FROM conversation_summaries WHERE wa_id = ?", (wa_id,))
+        with self._lock:
+            self._cache.pop(wa_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cached": len(self._cache),
+                "summaries": self.summaries,
+                "summary_failures": self.summary_failures,
+                "summarizing": len(self._summarizing),
+                "reloads": self.reloads,
+            }
+
+
+conversation_store = ConversationStore()
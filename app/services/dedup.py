@@ -0,0 +1,118 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from app.utils.sqlite_utils import ThreadLocalConnection
+
+
+class MessageDeduplicator:
+    """
+    Remembers recently seen WhatsApp message IDs so retried webhook
+    deliveries are only processed once.
+
+    The in-process cache is an OrderedDict in insertion order; since every
+    entry has the same TTL, insertion order is also expiry order, so both
+    expiry and size eviction pop from the front in O(1). An optional SQLite
+    file shares the seen IDs between server processes.
+    """
+
+    def __init__(self, ttl=86400, max_entries=10000, db_path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.enabled = True
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = ThreadLocalConnection(db_path, self._create_table)
+        self._last_purge = 0.0
+
+    def init_app(self, app):
+        self.enabled = app.config["DEDUP_ENABLED"]
+        self.ttl = app.config["DEDUP_TTL_SECONDS"]
+        self.max_entries = app.config["DEDUP_MAX_ENTRIES"]
+        self.db_path = app.config["DEDUP_DB_PATH"] or None
+        self._connection.path = self.db_path
+        with self._lock:
+            self._seen.clear()
+        if self.db_path:
+            self._connection()
+        app.extensions["dedup"] = self
+
+    @staticmethod
+    def _create_table(connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS processed_messages ("
+            "message_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+
+    def _expire(self, now):
+        seen = self._seen
+        while seen:
+            expires_at = next(iter(seen.values()))
+            if expires_at > now:
+                break
+            seen.popitem(last=False)
+
+    def _seen_in_db(self, message_id, now):
+        connection = self._connection()
+        cursor = connection.execute(
+            "INSERT INTO processed_messages (message_id, seen_at) VALUES (?, ?) "
+            "ON CONFLICT(message_id) DO UPDATE SET seen_at = excluded.seen_at "
+            "WHERE processed_messages.seen_at < ?",
+            (message_id, now, now - self.ttl),
+        )
+        if now - self._last_purge > self.ttl:
+            self._last_purge = now
+            connection.execute(
+                "DELETE FROM processed_messages WHERE seen_at < ?", (now - self.ttl,)
+            )
+        # rowcount is 0 when the ID was already stored and is still fresh
+        return cursor.rowcount == 0
+
+    def is_duplicate(self, message_id):
+        """
+        Record message_id and return True if it was already seen within the TTL.
+        """
+        if not self.enabled or not message_id:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if message_id in self._seen:
+                return True
+            self._seen[message_id] = now + self.ttl
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+        if self.db_path:
+            try:
+                return self._seen_in_db(message_id, time.time())
+            except sqlite3.Error as e:
+                logging.error(f"Dedup database lookup failed: {e}")
+        return False
+
+    def forget(self, message_id):
+        """
+        Remove message_id again, e.g. when its processing could not be queued
+        and Meta should be allowed to redeliver it.
+        """
+        if not self.enabled or not message_id:
+            return
+        with self._lock:
+            self._seen.pop(message_id, None)
+        if self.db_path:
+            try:
+                self._connection().execute(
+                    "DELETE FROM processed_messages WHERE message_id = ?", (message_id,)
+                )
+            except sqlite3.Error as e:
+                logging.error(f"Dedup database delete failed: {e}")
+
+    def __len__(self):
+        return len(self._seen)
+
+
+deduplicator = MessageDeduplicator()
@@ -0,0 +1,226 @@
+import asyncio
+import threading
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class GraphAPIError(Exception):
+    """
+    A Graph API call failed, either with a non-2xx response or a transport error.
+    """
+
+    def __init__(self, message, status_code=None, body=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+class GraphAPITimeout(GraphAPIError):
+    pass
+
+
+class GraphAPIClient:
+    """
+    Shared client for all WhatsApp Cloud API (Graph API) calls.
+
+    A single requests.Session with a sized connection pool keeps the TCP/TLS
+    connection to graph.facebook.com alive, so multi-part replies and media
+    downloads reuse it instead of paying a new handshake per call.
+    """
+
+    def __init__(
+        self,
+        token=None,
+        version="v17.0",
+        base_url="https://graph.facebook.com",
+        pool_size=10,
+        connect_timeout=3.05,
+        read_timeout=10,
+    ):
+        self.token = token
+        self.version = version
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.token = app.config["WHATSAPP_TOKEN"]
+        self.version = app.config["GRAPH_API_VERSION"]
+        self.base_url = app.config["GRAPH_API_BASE_URL"].rstrip("/")
+        self.pool_size = app.config["GRAPH_POOL_SIZE"]
+        self.timeout = (
+            app.config["GRAPH_CONNECT_TIMEOUT"],
+            app.config["GRAPH_READ_TIMEOUT"],
+        )
+        self.close()
+        app.extensions["graph_api"] = self
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=self.pool_size, pool_maxsize=self.pool_size
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{self.version}/{path.lstrip('/')}"
+
+    def request(self, method, path, **kwargs):
+        """
+        Perform a Graph API request and return the response.
+        Raises GraphAPITimeout on timeouts and GraphAPIError on any other
+        transport error or non-2xx status.
+        """
+        headers = {"Authorization": f"Bearer {self.token}"}
+        headers.update(kwargs.pop("headers", None) or {})
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.url(path)
+
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.Timeout as e:
+            raise GraphAPITimeout(f"{method} {url} timed out") from e
+        except requests.RequestException as e:
+            raise GraphAPIError(f"{method} {url} failed: {e}") from e
+
+        if not response.ok:
+            raise GraphAPIError(
+                f"{method} {url} returned {response.status_code}",
+                status_code=response.status_code,
+                body=response.text,
+            )
+        return response
+
+    def send_message(self, phone_number_id, payload):
+        """
+        Post a message payload (dict or JSON string) from phone_number_id.
+        """
+        if isinstance(payload, (str, bytes)):
+            return self.request(
+                "POST",
+                f"{phone_number_id}/messages",
+                data=payload,
+                headers={"Content-Type": "application/json"},
+            )
+        return self.request("POST", f"{phone_number_id}/messages", json=payload)
+
+    def send_text(self, phone_number_id, to, text):
+        return self.send_message(
+            phone_number_id,
+            {
+                "messaging_product": "whatsapp",
+                "to": to,
+                "type": "text",
+                "text": {"body": text},
+            },
+        )
+
+    def get_media_url(self, media_id):
+        """
+        Look up the temporary download URL of a media object.
+        """
+        url = self.request("GET", media_id).json().get("url")
+        if not url:
+            raise GraphAPIError(f"No download URL for media {media_id}")
+        return url
+
+    def download_media(self, url, stream=False):
+        return self.request("GET", url, stream=stream)
+
+
+class AsyncGraphAPIClient:
+    """
+    asyncio counterpart of GraphAPIClient for the aiohttp server, backed by
+    one aiohttp.ClientSession whose connector keeps up to pool_size
+    keep-alive connections. Raises the same GraphAPIError/GraphAPITimeout.
+    """
+
+    def __init__(self, sync_client):
+        self.sync_client = sync_client
+        self._session = None
+
+    async def start(self):
+        connect_timeout, read_timeout = self.sync_client.timeout
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.sync_client.pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method, path, **kwargs):
+        headers = {"Authorization": f"Bearer {self.sync_client.token}"}
+        headers.update(kwargs.pop("headers", None) or {})
+        url = self.sync_client.url(path)
+        try:
+            response = await self._session.request(method, url, headers=headers, **kwargs)
+        except asyncio.TimeoutError as e:
+            raise GraphAPITimeout(f"{method} {url} timed out") from e
+        except aiohttp.ClientError as e:
+            raise GraphAPIError(f"{method} {url} failed: {e}") from e
+
+        if response.status >= 400:
+            body = await response.text()
+            response.release()
+            raise GraphAPIError(
+                f"{method} {url} returned {response.status}",
+                status_code=response.status,
+                body=body,
+            )
+        return response
+
+    async def send_message(self, phone_number_id, payload):
+        response = await self._request("POST", f"{phone_number_id}/messages", json=payload)
+        async with response:
+            return response.status, await response.text()
+
+    async def send_text(self, phone_number_id, to, text):
+        return await self.send_message(
+            phone_number_id,
+            {
+                "messaging_product": "whatsapp",
+                "to": to,
+                "type": "text",
+                "text": {"body": text},
+            },
+        )
+
+    async def get_media_url(self, media_id):
+        response = await self._request("GET", media_id)
+        async with response:
+            url = (await response.json()).get("url")
+        if not url:
+            raise GraphAPIError(f"No download URL for media {media_id}")
+        return url
+
+    async def download_media(self, url):
+        """
+        Return the response for a media download; iterate response.content to stream it.
+        """
+        return await self._request("GET", url)
+
+
+graph_client = GraphAPIClient()
+async_graph_client = AsyncGraphAPIClient(graph_client)
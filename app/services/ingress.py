@@ -0,0 +1,93 @@
+import hashlib
+import hmac
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library decoder is used instead
+    orjson = None
+
+SIGNATURE_PREFIX = "sha256="
+
+# Webhook kinds, as returned by WebhookIngress.classify()
+STATUS = "status"
+EVENTS = "events"
+
+_MESSAGES_KEY = b'"messages"'
+_CALL_KEY = b'"call"'
+_STATUSES_KEY = b'"statuses"'
+
+
+class WebhookIngress:
+    """
+    Signature check, parsing and classification of raw webhook bodies.
+
+    The HMAC is keyed once with APP_SECRET and copied per request, and the
+    request bytes are hashed as they are, without decoding or re-encoding.
+    Without an APP_SECRET every signature is rejected: a MAC with an empty
+    key would let anyone sign webhooks.
+    classify() looks at the raw bytes only, so status-only webhooks (the
+    bulk of Meta's traffic) can be told apart before any other work.
+    """
+
+    def __init__(self, app_secret=None, fast_json=True):
+        self._mac = None
+        self.fast_json = fast_json
+        if app_secret is not None:
+            self.set_secret(app_secret)
+
+    def init_app(self, app):
+        self.set_secret(app.config["APP_SECRET"])
+        self.fast_json = app.config["INGRESS_FAST_JSON"]
+        if self.fast_json and orjson is None:
+            logging.info("orjson is not installed, webhook bodies are parsed with json")
+        app.extensions["ingress"] = self
+
+    def set_secret(self, app_secret):
+        if not app_secret:
+            logging.warning("APP_SECRET is not set, all webhook POSTs will be rejected")
+            self._mac = None
+            return
+        self._mac = hmac.new(app_secret.encode("latin-1"), digestmod=hashlib.sha256)
+
+    def verify(self, raw_payload_bytes, signature_header):
+        """
+        Check an X-Hub-Signature-256 header ("sha256=<hex>") against the raw body.
+        """
+        if self._mac is None or not signature_header or not signature_header.startswith(SIGNATURE_PREFIX):
+            return False
+        mac = self._mac.copy()
+        mac.update(raw_payload_bytes)
+        return hmac.compare_digest(mac.hexdigest(), signature_header[len(SIGNATURE_PREFIX):])
+
+    def parse(self, raw_payload_bytes):
+        """
+        Decode a JSON body. Returns None for empty or invalid payloads.
+        """
+        if not raw_payload_bytes:
+            return None
+        try:
+            if self.fast_json and orjson is not None:
+                return orjson.loads(raw_payload_bytes)
+            return json.loads(raw_payload_bytes)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def classify(raw_payload_bytes):
+        """
+        STATUS if the body only carries status updates, EVENTS otherwise.
+        Messages and calls always appear under their own keys, so a body
+        without those keys cannot contain anything but statuses.
+        """
+        if (
+            _STATUSES_KEY in raw_payload_bytes
+            and _MESSAGES_KEY not in raw_payload_bytes
+            and _CALL_KEY not in raw_payload_bytes
+        ):
+            return STATUS
+        return EVENTS
+
+
+ingress = WebhookIngress()
@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+class JobQueue:
+    """
+    Bounded job queue drained by a pool of worker threads.
+
+    Jobs submitted with a key (e.g. a wa_id) go into a per-key lane: jobs of
+    one lane run strictly one after another in submission order, while
+    different lanes run in parallel up to the number of workers. Jobs
+    without a key are scheduled individually.
+
+    Jobs run inside an application context of the Flask app passed to
+    init_app, so they can use current_app just like a request handler.
+    Workers are started lazily on the first submit, which keeps the pool
+    alive in forked server processes (e.g. gunicorn with --preload).
+    """
+
+    def __init__(self, workers=4, maxsize=100):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._app = None
+        # Holds ready work as (key, job): job is None for a lane key
+        self._ready = queue.Queue()
+        self._lanes = {}
+        self._pending = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.workers = app.config["WORKER_COUNT"]
+        self.maxsize = app.config["JOB_QUEUE_SIZE"]
+        self._app = app
+        app.extensions["job_queue"] = self
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker, name=f"job-worker-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            logging.info(f"Started {self.workers} background workers")
+
+    def _run(self, job):
+        future, fn, args, kwargs = job
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            if self._app is not None:
+                with self._app.app_context():
+                    result = fn(*args, **kwargs)
+            else:
+                result = fn(*args, **kwargs)
+        except BaseException as e:
+            logging.exception(f"Background job {fn.__name__} failed: {e}")
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _worker(self):
+        while True:
+            key, job = self._ready.get()
+            if key is None:
+                self._run(job)
+                with self._lock:
+                    self._pending -= 1
+                continue
+
+            # A lane key: run the job at the head of the lane, then hand the
+            # lane back to the ready queue if more jobs are waiting in it.
+            lane = self._lanes[key]
+            self._run(lane[0])
+            with self._lock:
+                lane.popleft()
+                self._pending -= 1
+                if lane:
+                    self._ready.put((key, None))
+                else:
+                    del self._lanes[key]
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) for a worker and return a Future.
+        Raises queue.Full if the queue is at capacity.
+        """
+        return self.submit_keyed(None, fn, *args, **kwargs)
+
+    def submit_keyed(self, key, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) in the lane of key and return a Future.
+        Jobs with the same key never run concurrently and keep their order.
+        Raises queue.Full if the queue is at capacity.
+        """
+        self._ensure_started()
+        future = Future()
+        job = (future, fn, args, kwargs)
+        with self._lock:
+            if self._pending >= self.maxsize:
+                raise queue.Full
+            self._pending += 1
+            if key is None:
+                self._ready.put((None, job))
+            elif key in self._lanes:
+                self._lanes[key].append(job)
+            else:
+                self._lanes[key] = deque([job])
+                self._ready.put((key, None))
+        return future
+
+    def depth(self):
+        return self._pending
+
+    def lane_depths(self):
+        """
+        Number of queued or running jobs per key.
+        """
+        with self._lock:
+            return {key: len(lane) for key, lane in self._lanes.items()}
+
+    def stats(self):
+        lanes = self.lane_depths()
+        return {
+            "workers": self.workers,
+            "queue_depth": self.depth(),
+            "queue_size": self.maxsize,
+            "active_lanes": len(lanes),
+            "max_lane_depth": max(lanes.values(), default=0),
+        }
+
+
+job_queue = JobQueue()
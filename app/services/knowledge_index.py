@@ -0,0 +1,297 @@
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+_QUESTION_MARKER = re.compile(r"(?=\bQ\s*:)")
+
+META_FILE = "meta.json"
+POSTINGS_FILE = "postings.bin"
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Function words and chat fillers (English and German). They are left out of
+# queries: a message like "yes" or "where?" would otherwise match some chunk
+# with full confidence.
+STOPWORDS = frozenset(
+    """
+    a about after all am an and any are as at be been but by can could did do does for from
+    had has have he her him his how if in into is it its me my no not of ok okay on or our
+    please she so than thank thanks that the their them then there these they this to too
+    up us was we were what when where which who why will with would yes you your hi hello hey
+    aber alle als am an auch auf aus bei bin bis bist bitte da danke dann das dass dem den der
+    des die dir doch du ein eine einem einen einer es für hallo hat hatte ich ihr im in ist ja
+    kann mein meine mich mir mit nach nein nicht noch nun oder sein sich sie sind so und uns
+    von vom war was wann warum wer wie wir wo zu zum zur
+    """.split()
+)
+
+
+def tokenize(text):
+    return [token for token in _TOKEN.findall(text.casefold()) if len(token) > 1]
+
+
+def chunk_text(text, max_words=80, overlap=20):
+    """
+    Split page text into chunks. FAQ-style "Q: ... A: ..." pairs stay
+    together; longer passages are cut into overlapping word windows.
+    """
+    text = " ".join(text.split())
+    chunks = []
+    for segment in _QUESTION_MARKER.split(text):
+        words = segment.split()
+        if not words:
+            continue
+        start = 0
+        while True:
+            chunks.append(" ".join(words[start:start + max_words]))
+            if start + max_words >= len(words):
+                break
+            start += max_words - overlap
+    return chunks
+
+
+def extract_pages(pdf_path):
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("pypdf is required to index PDF files: pip install pypdf") from e
+    return [page.extract_text() or "" for page in PdfReader(pdf_path).pages]
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def build_index(source, index_dir):
+    """
+    (Re)build the index for source in index_dir. Pages whose text did not
+    change since the last build keep their chunks and term counts, so only
+    edited pages are re-chunked and re-tokenized.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    meta_path = os.path.join(index_dir, META_FILE)
+    previous_pages = {}
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            previous = json.load(f)
+        previous_pages = {page["hash"]: page for page in previous.get("pages", [])}
+
+    pages = []
+    reused = 0
+    for text in extract_pages(source):
+        page_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        page = previous_pages.get(page_hash)
+        if page is not None:
+            reused += 1
+        else:
+            page = {
+                "hash": page_hash,
+                "chunks": [
+                    {"text": chunk, "tf": dict(Counter(tokenize(chunk)))}
+                    for chunk in chunk_text(text)
+                ],
+            }
+        pages.append(page)
+
+    chunks = [chunk for page in pages for chunk in page["chunks"]]
+    postings = {}
+    for chunk_id, chunk in enumerate(chunks):
+        for term, count in chunk["tf"].items():
+            postings.setdefault(term, []).append((chunk_id, count))
+
+    # Postings are stored as flat uint32 (chunk_id, tf) pairs; the metadata
+    # maps each term to its offset and number of pairs in that array.
+    flat = array("I")
+    terms = {}
+    for term in sorted(postings):
+        terms[term] = [len(flat) // 2, len(postings[term])]
+        for chunk_id, count in postings[term]:
+            flat.append(chunk_id)
+            flat.append(count)
+
+    doc_lengths = [sum(chunk["tf"].values()) for chunk in chunks]
+    meta = {
+        "source": os.path.abspath(source),
+        "fingerprint": file_fingerprint(source),
+        "pages": pages,
+        "doc_lengths": doc_lengths,
+        "avg_doc_length": sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0,
+        "terms": terms,
+    }
+
+    postings_path = os.path.join(index_dir, POSTINGS_FILE)
+    with open(postings_path + ".tmp", "wb") as f:
+        flat.tofile(f)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(postings_path + ".tmp", postings_path)
+    os.replace(meta_path + ".tmp", meta_path)
+    logging.info(
+        f"Indexed {source}: {len(pages)} pages ({reused} unchanged), "
+        f"{len(chunks)} chunks, {len(terms)} terms"
+    )
+    return meta
+
+
+class KnowledgeIndex:
+    """
+    BM25 index over the knowledge base for a local fast-answer tier.
+
+    The postings file is memory-mapped, so loading is cheap and lookups only
+    touch the postings of the query terms. confidence is the share of the
+    query's IDF weight that a chunk covers (0..1), counting only words that
+    are not in STOPWORDS, and scaled down while fewer than `min_terms` of
+    them match, so a single matching word is not a confident answer.
+
+    The source file is checked for changes at most every `check_interval`
+    seconds during searches; a changed file is re-indexed in the background
+    while the old index keeps serving.
+    """
+
+    def __init__(self, source=None, index_dir=None, min_terms=2, check_interval=60.0):
+        self.source = source
+        self.index_dir = index_dir
+        self.min_terms = min_terms
+        self.check_interval = check_interval
+        self._meta = None
+        self._chunks = []
+        self._postings = None
+        self._mmap = None
+        self._lock = threading.Lock()
+        self._checked_at = time.monotonic()
+        self._rebuilding = False
+
+    def init_app(self, app):
+        self.source = app.config["KNOWLEDGE_FILE"]
+        self.index_dir = app.config["KNOWLEDGE_INDEX_DIR"]
+        self.min_terms = app.config["KNOWLEDGE_MIN_MATCHED_TERMS"]
+        self.check_interval = app.config["KNOWLEDGE_CHECK_INTERVAL"]
+        if not app.config["KNOWLEDGE_FAST_TIER"]:
+            return
+        app.extensions["knowledge_index"] = self
+        self.load()
+        self._check_source(force=True)
+
+    @property
+    def loaded(self):
+        return self._meta is not None
+
+    def load(self):
+        meta_path = os.path.join(self.index_dir, META_FILE)
+        postings_path = os.path.join(self.index_dir, POSTINGS_FILE)
+        if not os.path.exists(meta_path) or not os.path.exists(postings_path):
+            logging.info(f"No knowledge index in {self.index_dir}")
+            return False
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        postings, mapped = None, None
+        if os.path.getsize(postings_path):
+            with open(postings_path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            postings = memoryview(mapped).cast("I")
+        with self._lock:
+            self._meta = meta
+            self._chunks = [chunk["text"] for page in meta["pages"] for chunk in page["chunks"]]
+            self._postings = postings
+            self._mmap = mapped
+        return True
+
+    def is_stale(self):
+        if not self.source or not os.path.exists(self.source):
+            return False
+        if self._meta is None:
+            return True
+        return self._meta["fingerprint"] != file_fingerprint(self.source)
+
+    def _check_source(self, force=False):
+        """
+        Start a background rebuild if the source changed since the index was built.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._rebuilding or (not force and now - self._checked_at < self.check_interval):
+                return
+            self._checked_at = now
+        if not self.is_stale():
+            return
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        # Rebuild off the request path; the old index keeps serving meanwhile
+        threading.Thread(target=self.rebuild, name="knowledge-index", daemon=True).start()
+
+    def rebuild(self):
+        try:
+            build_index(self.source, self.index_dir)
+            self.load()
+        except Exception as e:
+            logging.error(f"Rebuilding the knowledge index failed: {e}")
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._checked_at = time.monotonic()
+
+    def search(self, query, k=3):
+        """
+        Return up to k (score, confidence, chunk_text) tuples, best first.
+        """
+        if self.check_interval:
+            self._check_source()
+        with self._lock:
+            meta, postings, chunks = self._meta, self._postings, self._chunks
+        if meta is None or postings is None:
+            return []
+
+        terms = meta["terms"]
+        doc_lengths = meta["doc_lengths"]
+        avg_length = meta["avg_doc_length"] or 1.0
+        total = len(doc_lengths)
+        scores = {}
+        covered = {}
+        matched = {}
+        query_weight = 0.0
+        # Query terms unknown to the index count as maximally rare, so
+        # off-topic questions get a low confidence
+        unknown_idf = math.log(1 + (total + 0.5) / 0.5)
+        for term in set(tokenize(query)) - STOPWORDS:
+            entry = terms.get(term)
+            if entry is None:
+                query_weight += unknown_idf
+                continue
+            offset, count = entry
+            idf = math.log(1 + (total - count + 0.5) / (count + 0.5))
+            query_weight += idf
+            for i in range(offset * 2, (offset + count) * 2, 2):
+                chunk_id, tf = postings[i], postings[i + 1]
+                norm = K1 * (1 - B + B * doc_lengths[chunk_id] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+                covered[chunk_id] = covered.get(chunk_id, 0.0) + idf
+                matched[chunk_id] = matched.get(chunk_id, 0) + 1
+
+        if not scores:
+            return []
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [
+            (
+                score,
+                covered[chunk_id] / query_weight * min(1.0, matched[chunk_id] / max(self.min_terms, 1)),
+                chunks[chunk_id],
+            )
+            for chunk_id, score in best
+        ]
+
+
+knowledge_index = KnowledgeIndex()
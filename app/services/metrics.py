@@ -0,0 +1,195 @@
+import hmac
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, request
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+PREFIX = "whatsapp"
+
+# Without METRICS_TOKEN, /metrics only answers requests made directly on this host
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+# Set by reverse proxies and tunnels (e.g. ngrok), whose requests also arrive from localhost
+FORWARDED_HEADERS = ("Forwarded", "X-Forwarded-For", "X-Real-IP")
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * (size + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+
+class _StageTimer:
+    """
+    Context manager that observes the duration of a stage and counts it as
+    an error if the block raises.
+    """
+
+    __slots__ = ("metrics", "stage", "message_type", "started")
+
+    def __init__(self, metrics, stage, message_type):
+        self.metrics = metrics
+        self.stage = stage
+        self.message_type = message_type
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, self.message_type, time.perf_counter() - self.started)
+        if exc_type is not None:
+            self.metrics.count("stage_errors", self.message_type, stage=self.stage)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class Metrics:
+    """
+    In-process latency histograms and counters for the webhook pipeline,
+    exported in the Prometheus text format on /metrics.
+
+    Stages (signature, parse, media, whisper, thread, run, send, ...) are
+    labelled by message type (text, audio, call, status). Recording is a
+    bisect and a few integer increments under one lock. Services register
+    a stats() callable whose numeric values are exported as gauges.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.enabled = True
+        self.token = None
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config["METRICS_ENABLED"]
+        self.token = app.config["METRICS_TOKEN"] or None
+        app.extensions["metrics"] = self
+        if self.enabled:
+            app.add_url_rule("/metrics", "metrics", self.view, methods=["GET"])
+            if not self.token:
+                logging.info("METRICS_TOKEN is not set, /metrics only answers requests from localhost")
+
+    def register(self, name, collect):
+        """
+        Export the numeric values of collect() as gauges named <prefix>_<name>_<key>.
+        """
+        self._collectors[name] = collect
+
+    def observe(self, stage, message_type, seconds):
+        if not self.enabled:
+            return
+        index = bisect_left(self.buckets, seconds)
+        key = (stage, message_type)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def time(self, stage, message_type):
+        """
+        with metrics.time("run", "text"): ...
+        """
+        if not self.enabled:
+            return _NOOP_TIMER
+        return _StageTimer(self, stage, message_type)
+
+    def count(self, name, message_type, amount=1, stage=None):
+        if not self.enabled:
+            return
+        key = (name, message_type, stage)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        with self._lock:
+            histograms = [
+                (key, list(h.counts), h.sum, h.count) for key, h in sorted(self._histograms.items())
+            ]
+            counters = sorted(self._counters.items(), key=lambda item: tuple(str(k) for k in item[0]))
+
+        lines = [
+            f"# HELP {PREFIX}_stage_seconds Duration of a webhook pipeline stage.",
+            f"# TYPE {PREFIX}_stage_seconds histogram",
+        ]
+        for (stage, message_type), counts, total, count in histograms:
+            labels = f'stage="{stage}",type="{message_type}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{PREFIX}_stage_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{PREFIX}_stage_seconds_count{{{labels}}} {count}")
+
+        declared = set()
+        for (name, message_type, stage), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            labels = f'type="{message_type}"'
+            if stage is not None:
+                labels = f'stage="{stage}",{labels}'
+            lines.append(f"{PREFIX}_{name}_total{{{labels}}} {value}")
+
+        for name, collect in self._collectors.items():
+            try:
+                values = collect()
+            except Exception as e:
+                logging.warning(f"Collecting {name} metrics failed: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {PREFIX}_{name}_{key} gauge")
+                    lines.append(f"{PREFIX}_{name}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def authorized(self, remote_addr, headers):
+        """
+        With METRICS_TOKEN set, require "Authorization: Bearer <token>";
+        otherwise only allow requests from localhost that no proxy forwarded.
+        """
+        if self.token:
+            return hmac.compare_digest(headers.get("Authorization", ""), f"Bearer {self.token}")
+        return remote_addr in LOCAL_ADDRESSES and not any(header in headers for header in FORWARDED_HEADERS)
+
+    def view(self):
+        if not self.authorized(request.remote_addr, request.headers):
+            return Response("forbidden\n", status=403, mimetype="text/plain")
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+
+metrics = Metrics()
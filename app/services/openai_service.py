@@ -1,14 +1,81 @@
-from openai import OpenAI
-import shelve
+from openai import AsyncOpenAI, NOT_GIVEN, OpenAI
 from dotenv import load_dotenv
+import asyncio
 import os
 import time
 import logging
 
+from app.services.answer_cache import answer_cache
+from app.services.conversation_store import count_tokens
+from app.services.thread_store import thread_store
+
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")
 client = OpenAI(api_key=OPENAI_API_KEY)
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Adaptive run polling: a fast first check, then exponential backoff up to a
+# maximum interval, and a hard deadline after which the run is cancelled.
+# The defaults are replaced by the app config in init_app().
+RUN_POLL_INITIAL = 0.2
+RUN_POLL_MAX = 2.0
+RUN_POLL_FACTOR = 1.6
+RUN_TIMEOUT = 60.0
+
+# Cheaper model for answers grounded in passages from the local knowledge index
+FAST_ANSWER_MODEL = "gpt-4o-mini"
+FAST_ANSWER_INSTRUCTIONS = (
+    "You're a helpful WhatsApp assistant for guests staying in our Paris AirBnb. "
+    "Answer the guest's question using only the FAQ excerpts below. If they don't "
+    "contain the answer, say that you cannot help with the question and advise to "
+    "contact the host directly. Be friendly and brief."
+)
+
+# Single-call Chat Completions backend (no thread, no run)
+CHAT_MODEL = FAST_ANSWER_MODEL
+CHAT_INSTRUCTIONS = (
+    "You're a helpful WhatsApp assistant that can assist guests that are staying in "
+    "our Paris AirBnb. If you don't know the answer, say simply that you cannot help "
+    "with the question and advise to contact the host directly. Be friendly and brief."
+)
+SUMMARY_INSTRUCTIONS = (
+    "Summarize this conversation between a guest and the WhatsApp assistant of a "
+    "Paris AirBnb for the assistant's memory. Keep names, dates, booking details, "
+    "open questions and promises made; drop small talk. Write at most a short "
+    "paragraph in the language of the conversation."
+)
+# First message of a rotated thread, followed by the summary of the previous one
+CARRY_OVER_PREFIX = "Summary of our conversation so far (earlier messages are no longer shown):"
+# A message that loses a race against a thread rotation re-reads the mapping this often
+THREAD_CLAIM_ATTEMPTS = 3
+
+RUN_PENDING_STATUSES = ("queued", "in_progress", "cancelling")
+# Stream events after which a run has ended without a (complete) reply
+RUN_FAILED_EVENTS = (
+    "thread.run.failed",
+    "thread.run.cancelled",
+    "thread.run.expired",
+    "thread.run.incomplete",
+    "thread.run.requires_action",
+    "error",
+)
+FALLBACK_MESSAGE = (
+    "Sorry, I can't answer right now. Please try again in a moment "
+    "or contact the host directly."
+)
+
+
+def init_app(app):
+    """
+    Apply the model and run polling settings of the app config.
+    """
+    global RUN_POLL_INITIAL, RUN_POLL_MAX, RUN_TIMEOUT, FAST_ANSWER_MODEL, CHAT_MODEL
+    RUN_POLL_INITIAL = app.config["RUN_POLL_INITIAL"]
+    RUN_POLL_MAX = app.config["RUN_POLL_MAX"]
+    RUN_TIMEOUT = app.config["RUN_TIMEOUT"]
+    FAST_ANSWER_MODEL = app.config["FAST_ANSWER_MODEL"]
+    CHAT_MODEL = app.config["CHAT_MODEL"]
 
 
 def upload_file(path):
@@ -32,66 +99,321 @@ def create_assistant(file):
     return assistant
 
 
-# Use context manager to ensure the shelf file is closed properly
+# Thread lookups are served from the LRU cache of the shared thread store
 def check_if_thread_exists(wa_id):
-    with shelve.open("threads_db") as threads_shelf:
-        return threads_shelf.get(wa_id, None)
+    return thread_store.get(wa_id)
 
 
 def store_thread(wa_id, thread_id):
-    with shelve.open("threads_db", writeback=True) as threads_shelf:
-        threads_shelf[wa_id] = thread_id
+    thread_store.set(wa_id, thread_id)
+
+
+def wait_for_run(run, timeout=None):
+    """
+    Poll a run until it leaves the queued/in_progress states or the deadline
+    passes. Runs that hit the deadline or need tool outputs are cancelled so
+    the thread accepts new runs again. Returns the last seen run.
+    """
+    # https://platform.openai.com/docs/assistants/how-it-works/runs-and-run-steps#:~:text=under%20failed_at.-,Polling%20for%20updates,-In%20order%20to
+    if timeout is None:
+        timeout = RUN_TIMEOUT
+    deadline = time.monotonic() + timeout
+    interval = RUN_POLL_INITIAL
+    while run.status in RUN_PENDING_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logging.error(f"Run {run.id} did not finish within {timeout}s")
+            _cancel_run(run)
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * RUN_POLL_FACTOR, RUN_POLL_MAX)
+        run = client.beta.threads.runs.retrieve(thread_id=run.thread_id, run_id=run.id)
+
+    if run.status == "requires_action":
+        _cancel_run(run)
+    return run
+
+
+def _cancel_run(run):
+    try:
+        client.beta.threads.runs.cancel(thread_id=run.thread_id, run_id=run.id)
+    except Exception as e:
+        logging.warning(f"Could not cancel run {run.id}: {e}")
 
 
 def run_assistant(thread, name):
-    # Retrieve the Assistant
-    assistant = client.beta.assistants.retrieve(OPENAI_ASSISTANT_ID)
-
-    # Run the assistant
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant.id,
-        # instructions=f"You are having a conversation with {name}",
+    # Wait for completion; failed, expired or stuck runs get a quick fallback
+    # A run only needs the assistant id, so the assistant itself is never retrieved
+    new_message = run_thread(thread.id, OPENAI_ASSISTANT_ID)
+    if new_message is None:
+        return FALLBACK_MESSAGE
+    logging.info(f"Generated message: {new_message}")
+    return new_message
+
+
+def add_user_message(wa_id, text):
+    """
+    Append a user message to the wa_id's thread, creating the thread on first
+    contact. Returns the thread id.
+    """
+    tokens = count_tokens(text)
+    for _ in range(THREAD_CLAIM_ATTEMPTS):
+        thread_id = thread_store.get(wa_id)
+        if not thread_id:
+            logging.info(f"Creating new thread for wa_id {wa_id}")
+            thread = client.beta.threads.create()
+            thread_id = thread_store.set_if_absent(wa_id, thread.id)
+        # Counted before posting: a rotation that already picked this thread then gives up,
+        # and if the rotation won, the mapping points to the new thread
+        if thread_store.touch(wa_id, tokens=tokens, thread_id=thread_id):
+            break
+        logging.info(f"Thread {thread_id} of {wa_id} was just rotated, using the new one")
+    client.beta.threads.messages.create(thread_id=thread_id, role="user", content=text)
+    return thread_id
+
+
+def run_thread(thread_id, assistant_id, timeout=None):
+    """
+    Run the assistant on a thread and return the reply text, or None if the
+    run did not complete within timeout.
+    """
+    run = client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
+    run = wait_for_run(run, timeout)
+    if run.status != "completed":
+        logging.error(f"Run {run.id} ended with status {run.status}: {run.last_error}")
+        return None
+
+    messages = client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, limit=1)
+    for message in messages.data:
+        for content_block in message.content:
+            if content_block.type == "text":
+                return content_block.text.value
+    return None
+
+
+def stream_thread(thread_id, assistant_id, send_part):
+    """
+    Stream a run and call send_part for every [NL]-separated part as soon as
+    it is complete. Returns the whole reply; raises if the run fails.
+    """
+    buffer = ""
+    reply_text = ""
+    with client.beta.threads.runs.stream(thread_id=thread_id, assistant_id=assistant_id) as stream:
+        for event in stream:
+            if event.event == "thread.message.delta":
+                for block in event.data.delta.content or []:
+                    if block.type == "text" and block.text and block.text.value:
+                        buffer += block.text.value
+                        reply_text += block.text.value
+                # A part is complete once the following [NL] has fully arrived
+                while "[NL]" in buffer:
+                    part, buffer = buffer.split("[NL]", 1)
+                    send_part(part)
+            elif event.event in RUN_FAILED_EVENTS:
+                raise RuntimeError(f"Run ended with {event.event}")
+    send_part(buffer)
+    return reply_text
+
+
+def thread_transcript(thread_id, limit=100):
+    """
+    The last `limit` text messages of a thread as (role, content), oldest first.
+    """
+    messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=limit)
+    transcript = []
+    for message in messages.data:
+        text = "".join(block.text.value for block in message.content if block.type == "text")
+        if text:
+            transcript.append((message.role, text))
+    transcript.reverse()
+    return transcript
+
+
+def create_thread_with_summary(summary):
+    """
+    Start a new thread that opens with the summary of an earlier conversation.
+    """
+    thread = client.beta.threads.create(
+        messages=[{"role": "assistant", "content": f"{CARRY_OVER_PREFIX}\n{summary}"}]
     )
+    return thread.id
 
-    # Wait for completion
-    # https://platform.openai.com/docs/assistants/how-it-works/runs-and-run-steps#:~:text=under%20failed_at.-,Polling%20for%20updates,-In%20order%20to
-    while run.status != "completed":
-        # Be nice to the API
-        time.sleep(0.5)
-        run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-
-    # Retrieve the Messages
-    messages = client.beta.threads.messages.list(thread_id=thread.id)
-    new_message = messages.data[0].content[0].text.value
+
+def chat_completion(messages, timeout=NOT_GIVEN, max_tokens=NOT_GIVEN):
+    completion = client.chat.completions.create(
+        model=CHAT_MODEL, messages=messages, timeout=timeout, max_tokens=max_tokens
+    )
+    return completion.choices[0].message.content
+
+
+def chat_reply(text, timeout=NOT_GIVEN):
+    """
+    Answer a message with a single Chat Completions call.
+    """
+    return chat_completion(
+        [
+            {"role": "system", "content": CHAT_INSTRUCTIONS},
+            {"role": "user", "content": text},
+        ],
+        timeout=timeout,
+    )
+
+
+def summarize_conversation(summary, messages, max_tokens=300):
+    """
+    Fold (role, content) messages into the running summary of a conversation.
+    """
+    transcript = "\n".join(f"{role}: {content}" for role, content in messages)
+    if summary:
+        transcript = f"Summary so far:\n{summary}\n\nLater messages:\n{transcript}"
+    return chat_completion(
+        [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": transcript},
+        ],
+        max_tokens=max_tokens,
+    )
+
+
+def answer_from_context(question, passages, timeout=NOT_GIVEN):
+    """
+    Answer a question from knowledge-base passages with a single Chat
+    Completions call, bypassing the Assistants thread and run machinery.
+    """
+    context = "\n\n".join(passages)
+    completion = client.chat.completions.create(
+        model=FAST_ANSWER_MODEL,
+        messages=[
+            {"role": "system", "content": f"{FAST_ANSWER_INSTRUCTIONS}\n\nFAQ excerpts:\n{context}"},
+            {"role": "user", "content": question},
+        ],
+        timeout=timeout,
+    )
+    return completion.choices[0].message.content
+
+
+def generate_response(message_body, wa_id, name):
+    # Repeated questions are answered from the cache without an assistant run
+    cached = answer_cache.get(message_body)
+    if cached is not None:
+        logging.info(f"Answer cache hit for {wa_id}")
+        return cached
+
+    # Add the message to the user's thread and run the assistant on it
+    logging.info(f"Adding message from {name} ({wa_id}) to their thread")
+    thread_id = add_user_message(wa_id, message_body)
+    new_message = run_thread(thread_id, OPENAI_ASSISTANT_ID)
+    if new_message is None:
+        return FALLBACK_MESSAGE
+
+    # Not cached: the reply comes from this user's thread and may be about their booking
     logging.info(f"Generated message: {new_message}")
     return new_message
 
 
-def generate_response(message_body, wa_id, name):
-    # Check if there is already a thread_id for the wa_id
-    thread_id = check_if_thread_exists(wa_id)
-
-    # If a thread doesn't exist, create one and store it
-    if thread_id is None:
-        logging.info(f"Creating new thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.create()
-        store_thread(wa_id, thread.id)
-        thread_id = thread.id
-
-    # Otherwise, retrieve the existing thread
-    else:
-        logging.info(f"Retrieving existing thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.retrieve(thread_id)
-
-    # Add message to thread
-    message = client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=message_body,
+# --------------------------------------------------------------
+# asyncio variants used by the aiohttp server (app/aio.py)
+# --------------------------------------------------------------
+
+
+async def wait_for_run_async(run, timeout=None):
+    """
+    Like wait_for_run, but sleeps with asyncio so the event loop keeps serving.
+    """
+    if timeout is None:
+        timeout = RUN_TIMEOUT
+    deadline = time.monotonic() + timeout
+    interval = RUN_POLL_INITIAL
+    while run.status in RUN_PENDING_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logging.error(f"Run {run.id} did not finish within {timeout}s")
+            await _cancel_run_async(run)
+            break
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * RUN_POLL_FACTOR, RUN_POLL_MAX)
+        run = await async_client.beta.threads.runs.retrieve(thread_id=run.thread_id, run_id=run.id)
+
+    if run.status == "requires_action":
+        await _cancel_run_async(run)
+    return run
+
+
+async def _cancel_run_async(run):
+    try:
+        await async_client.beta.threads.runs.cancel(thread_id=run.thread_id, run_id=run.id)
+    except Exception as e:
+        logging.warning(f"Could not cancel run {run.id}: {e}")
+
+
+async def add_user_message_async(wa_id, text):
+    # The thread store may wait on SQLite, so it is called off the event loop
+    tokens = count_tokens(text)
+    for _ in range(THREAD_CLAIM_ATTEMPTS):
+        thread_id = await asyncio.to_thread(thread_store.get, wa_id)
+        if not thread_id:
+            logging.info(f"Creating new thread for wa_id {wa_id}")
+            thread = await async_client.beta.threads.create()
+            thread_id = await asyncio.to_thread(thread_store.set_if_absent, wa_id, thread.id)
+        if await asyncio.to_thread(thread_store.touch, wa_id, tokens=tokens, thread_id=thread_id):
+            break
+        logging.info(f"Thread {thread_id} of {wa_id} was just rotated, using the new one")
+    await async_client.beta.threads.messages.create(thread_id=thread_id, role="user", content=text)
+    return thread_id
+
+
+async def run_assistant_async(thread_id, assistant_id, timeout=None):
+    """
+    Run the assistant on a thread and return the reply text, or None if the
+    run did not complete.
+    """
+    run = await async_client.beta.threads.runs.create(thread_id=thread_id, assistant_id=assistant_id)
+    run = await wait_for_run_async(run, timeout)
+    if run.status != "completed":
+        logging.error(f"Run {run.id} ended with status {run.status}: {run.last_error}")
+        return None
+
+    messages = await async_client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, limit=1)
+    for message in messages.data:
+        for content_block in message.content:
+            if content_block.type == "text":
+                return content_block.text.value
+    return None
+
+
+async def transcribe_async(audio_file, model="whisper-1"):
+    return await async_client.audio.transcriptions.create(
+        model=model,
+        file=("audio.ogg", audio_file),
+        response_format="text",
     )
 
-    # Run the assistant and get the new message
-    new_message = run_assistant(thread, name)
 
-    return new_message
+async def answer_from_context_async(question, passages, timeout=NOT_GIVEN):
+    context = "\n\n".join(passages)
+    completion = await async_client.chat.completions.create(
+        model=FAST_ANSWER_MODEL,
+        messages=[
+            {"role": "system", "content": f"{FAST_ANSWER_INSTRUCTIONS}\n\nFAQ excerpts:\n{context}"},
+            {"role": "user", "content": question},
+        ],
+        timeout=timeout,
+    )
+    return completion.choices[0].message.content
+
+
+async def chat_completion_async(messages, timeout=NOT_GIVEN, max_tokens=NOT_GIVEN):
+    completion = await async_client.chat.completions.create(
+        model=CHAT_MODEL, messages=messages, timeout=timeout, max_tokens=max_tokens
+    )
+    return completion.choices[0].message.content
+
+
+async def chat_reply_async(text, timeout=NOT_GIVEN):
+    return await chat_completion_async(
+        [
+            {"role": "system", "content": CHAT_INSTRUCTIONS},
+            {"role": "user", "content": text},
+        ],
+        timeout=timeout,
+    )
@@ -0,0 +1,221 @@
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from app.services.graph_api import graph_client, GraphAPIError
+from app.services.job_queue import JobQueue
+from app.services.metrics import metrics
+from app.services.outbox import outbox
+
+
+class TokenBucket:
+    """
+    Classic token bucket: refills at `rate` tokens per second up to `burst`.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available. Returns the time waited.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class SendStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def record(self, ok, latency, queue_wait, retries):
+        with self._lock:
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.retries += retries
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.queue_wait_total += queue_wait
+            self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+
+    def snapshot(self):
+        with self._lock:
+            count = self.sent + self.failed
+            return {
+                "sent": self.sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "latency_avg": self.latency_total / count if count else 0.0,
+                "latency_max": self.latency_max,
+                "queue_wait_avg": self.queue_wait_total / count if count else 0.0,
+                "queue_wait_max": self.queue_wait_max,
+            }
+
+
+class OutboundSender:
+    """
+    Queues outgoing WhatsApp messages instead of posting them inline.
+
+    Each recipient has its own lane, so the parts of a reply arrive in order,
+    and each sending phone_number_id has a token bucket that smooths bursts
+    to the Cloud API throughput limit. 429 and 5xx responses (and transport
+    errors) are retried with exponential backoff and jitter.
+
+    With the outbox enabled every payload is journaled before it is queued.
+    A message that still fails after the retries keeps its lane busy and is
+    retried with the outbox's longer backoff until it is delivered or given
+    up, so later parts never overtake it; messages of a crashed process are
+    handed back by the outbox drainer after a restart.
+    """
+
+    RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, rate=20.0, burst=20, max_retries=3, backoff=0.5, workers=4, maxsize=1000):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue = JobQueue(workers=workers, maxsize=maxsize)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.stats = SendStats()
+
+    def init_app(self, app):
+        self.rate = app.config["SEND_RATE_PER_SECOND"]
+        self.burst = app.config["SEND_BURST"]
+        self.max_retries = app.config["SEND_MAX_RETRIES"]
+        self.backoff = app.config["SEND_BACKOFF_SECONDS"]
+        self._queue.workers = app.config["SEND_WORKER_COUNT"]
+        self._queue.maxsize = app.config["SEND_QUEUE_SIZE"]
+        with self._lock:
+            self._buckets.clear()
+        app.extensions["outbound"] = self
+        outbox.start(self.redeliver)
+
+    def _bucket(self, phone_number_id):
+        with self._lock:
+            bucket = self._buckets.get(phone_number_id)
+            if bucket is None:
+                bucket = self._buckets[phone_number_id] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def _retryable(self, error):
+        return error.status_code is None or error.status_code in self.RETRYABLE_STATUS
+
+    def _deliver(self, phone_number_id, payload, enqueued_at, entry_id=None):
+        queue_wait = time.monotonic() - enqueued_at
+        bucket = self._bucket(phone_number_id)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            started = time.monotonic()
+            try:
+                response = graph_client.send_message(phone_number_id, payload)
+            except GraphAPIError as e:
+                if attempt < self.max_retries and self._retryable(e):
+                    delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                    attempt += 1
+                    logging.warning(
+                        f"Send to {payload.get('to')} failed ({e}), retry {attempt} in {delay:.2f}s"
+                    )
+                    time.sleep(delay)
+                    continue
+                metrics.observe("send", payload.get("type"), time.monotonic() - started)
+                metrics.count("stage_errors", payload.get("type"), stage="send")
+                self.stats.record(False, time.monotonic() - started, queue_wait, attempt)
+                logging.error(f"Send to {payload.get('to')} failed: {e} {e.body or ''}")
+                if self._retryable(e):
+                    # Keep the recipient's lane on this entry, so the next part of the reply can't overtake it
+                    delay = outbox.defer(entry_id, str(e))
+                    if delay is not None:
+                        time.sleep(delay)
+                        attempt = 0
+                        continue
+                else:
+                    # Rejected by the API (invalid recipient, expired window, ...): retrying won't help
+                    outbox.ack(entry_id, e.status_code, f"{e} {e.body or ''}")
+                return None
+            latency = time.monotonic() - started
+            metrics.observe("send", payload.get("type"), latency)
+            self.stats.record(True, latency, queue_wait, attempt)
+            outbox.ack(entry_id, response.status_code)
+            logging.info(
+                f"WhatsApp Send API Status: {response.status_code} "
+                f"(latency {latency * 1000:.0f} ms, queued {queue_wait * 1000:.0f} ms)",
+                extra={"sample": "send"},
+            )
+            return response
+
+    def enqueue(self, phone_number_id, payload):
+        """
+        Queue a message payload and return a Future that resolves to the Graph
+        API response, or to None if sending failed for good.
+        When the queue is full the message is sent in the calling thread.
+        """
+        entry_id = outbox.append(phone_number_id, payload)
+        key = (phone_number_id, payload.get("to"))
+        enqueued_at = time.monotonic()
+        try:
+            return self._queue.submit_keyed(
+                key, self._deliver, phone_number_id, payload, enqueued_at, entry_id
+            )
+        except queue.Full:
+            logging.warning("Outbound queue full, sending in the calling thread")
+            future = Future()
+            future.set_result(self._deliver(phone_number_id, payload, enqueued_at, entry_id))
+            return future
+
+    def redeliver(self, entry_id, phone_number_id, payload):
+        """
+        Queue a pending outbox entry again. Raises queue.Full instead of
+        sending inline, so the drainer never blocks on the Graph API.
+        """
+        key = (phone_number_id, payload.get("to"))
+        self._queue.submit_keyed(
+            key, self._deliver, phone_number_id, payload, time.monotonic(), entry_id
+        )
+
+    def enqueue_text(self, phone_number_id, to, text):
+        return self.enqueue(
+            phone_number_id,
+            {
+                "messaging_product": "whatsapp",
+                "to": to,
+                "type": "text",
+                "text": {"body": text},
+            },
+        )
+
+    def queue_stats(self):
+        return self._queue.stats()
+
+
+outbound = OutboundSender()
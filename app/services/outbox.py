@@ -0,0 +1,337 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from app.utils.sqlite_utils import ThreadLocalConnection
+
+
+class Outbox:
+    """
+    Durable journal of outgoing messages in SQLite.
+
+    Every message is appended to `outbox` before its first send attempt, and
+    the result is appended to `outbox_acks` once it is delivered (2xx) or
+    given up; acknowledged entries are purged after `retention` seconds.
+
+    Each open entry carries a lease (claimed_by, lease_until): the process
+    that appended or claimed it owns it and renews the lease while the send
+    is in flight. The sender retries a failed entry in place with
+    exponential backoff (defer), keeping its lease, so later messages to
+    the same recipient wait behind it; release() instead drops the lease
+    and sets the next attempt time. The drainer thread claims due entries
+    whose lease has expired in one BEGIN IMMEDIATE transaction and hands
+    them back to the sender, so an entry is never sent by two processes at
+    once, and entries of a crashed process are taken over once its leases
+    run out after `replay_after` seconds.
+    """
+
+    def __init__(self, db_path=None, drain_interval=5.0, batch_size=100, max_attempts=10,
+                 backoff=5.0, max_backoff=600.0, replay_after=30.0, retention=7 * 86400):
+        self.db_path = db_path
+        self.drain_interval = drain_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.replay_after = replay_after
+        self.retention = retention
+        self._connection = ThreadLocalConnection(db_path, self._create_tables)
+        self._lock = threading.Lock()
+        self._owner = None
+        self._inflight = set()
+        self._deliver = None
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._last_purge = 0.0
+        self._renewed_at = 0.0
+        self.appended = 0
+        self.delivered = 0
+        self.dead = 0
+        self.retried = 0
+        self.claimed = 0
+
+    def init_app(self, app):
+        self.db_path = app.config["OUTBOX_DB_PATH"] or None
+        self.drain_interval = app.config["OUTBOX_DRAIN_INTERVAL"]
+        self.batch_size = app.config["OUTBOX_BATCH_SIZE"]
+        self.max_attempts = app.config["OUTBOX_MAX_ATTEMPTS"]
+        self.backoff = app.config["OUTBOX_BACKOFF_SECONDS"]
+        self.replay_after = app.config["OUTBOX_REPLAY_AFTER"]
+        self.retention = app.config["OUTBOX_RETENTION_SECONDS"]
+        self._connection.path = self.db_path
+        if self.db_path:
+            self._connection()
+        app.extensions["outbox"] = self
+
+    @property
+    def enabled(self):
+        return self.db_path is not None
+
+    @property
+    def owner(self):
+        """
+        Lease owner id of this process; a forked worker gets its own.
+        """
+        pid = os.getpid()
+        if self._owner is None or self._owner[0] != pid:
+            self._owner = (pid, f"{socket.gethostname()}:{pid}:{uuid.uuid4().hex[:8]}")
+        return self._owner[1]
+
+    @staticmethod
+    def _create_tables(connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, phone_number_id TEXT NOT NULL, "
+            "recipient TEXT, payload TEXT NOT NULL, created_at REAL NOT NULL, "
+            "claimed_by TEXT, lease_until REAL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_at REAL NOT NULL DEFAULT 0)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_acks ("
+            "entry_id INTEGER PRIMARY KEY, status_code INTEGER, error TEXT, "
+            "acked_at REAL NOT NULL)"
+        )
+        # Only open entries (lease_until not NULL) are ever searched for
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_open ON outbox (lease_until) WHERE lease_until IS NOT NULL"
+        )
+
+    @contextmanager
+    def _transaction(self, connection):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def start(self, deliver):
+        """
+        Start the drainer. deliver(entry_id, phone_number_id, payload) must
+        hand the entry to the sender and not block on the send itself.
+        """
+        if not self.enabled or self._thread is not None:
+            return
+        self._deliver = deliver
+        self._thread = threading.Thread(target=self._run, name="outbox-drainer", daemon=True)
+        self._thread.start()
+
+    def append(self, phone_number_id, payload):
+        """
+        Journal a message before it is sent and return its entry id (None when disabled).
+        The entry is leased to this process until ack() or release() is called for it.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO outbox (phone_number_id, recipient, payload, created_at, claimed_by, lease_until) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                phone_number_id,
+                payload.get("to"),
+                json.dumps(payload, ensure_ascii=False),
+                now,
+                self.owner,
+                now + self.replay_after,
+            ),
+        )
+        with self._lock:
+            self._inflight.add(cursor.lastrowid)
+            self.appended += 1
+        return cursor.lastrowid
+
+    def ack(self, entry_id, status_code=None, error=None):
+        """
+        Mark an entry as finished: delivered (no error) or given up.
+        """
+        if entry_id is None:
+            return
+        connection = self._connection()
+        with self._transaction(connection):
+            connection.execute(
+                "INSERT OR IGNORE INTO outbox_acks (entry_id, status_code, error, acked_at) VALUES (?, ?, ?, ?)",
+                (entry_id, status_code, error, time.time()),
+            )
+            connection.execute("UPDATE outbox SET lease_until = NULL WHERE id = ?", (entry_id,))
+        with self._lock:
+            self._inflight.discard(entry_id)
+            if error is None:
+                self.delivered += 1
+            else:
+                self.dead += 1
+        if error is not None:
+            logging.error(f"Outbox entry {entry_id} given up: {error}")
+
+    def _failed_attempt(self, connection, entry_id):
+        """
+        Count a failed attempt of an entry leased to this process. Returns
+        (attempts, backoff delay), or None if this process doesn't own it.
+        """
+        row = connection.execute(
+            "SELECT attempts FROM outbox WHERE id = ? AND claimed_by = ? AND lease_until IS NOT NULL",
+            (entry_id, self.owner),
+        ).fetchone()
+        if row is None:
+            # Acknowledged meanwhile, or the lease ran out and another process owns it now
+            return None
+        attempts = row[0] + 1
+        return attempts, min(self.backoff * (2 ** (attempts - 1)), self.max_backoff)
+
+    def defer(self, entry_id, error=None):
+        """
+        Count a failed attempt of an entry the caller keeps sending itself,
+        so that nothing queued behind it overtakes it. The lease is kept.
+        Returns the seconds to wait before the next attempt, or None once
+        the entry was given up or belongs to another process.
+        """
+        if entry_id is None:
+            return None
+        connection = self._connection()
+        with self._transaction(connection):
+            failed = self._failed_attempt(connection, entry_id)
+            if failed is None:
+                return None
+            attempts, delay = failed
+            connection.execute(
+                "UPDATE outbox SET attempts = ?, lease_until = ? WHERE id = ?",
+                (attempts, time.time() + delay + self.replay_after, entry_id),
+            )
+        if attempts >= self.max_attempts:
+            self.ack(entry_id, error=f"{attempts} attempts failed, last error: {error}")
+            return None
+        with self._lock:
+            self.retried += 1
+        logging.warning(f"Outbox entry {entry_id} failed ({error}), retry {attempts} in {delay:.0f}s")
+        return delay
+
+    def release(self, entry_id, error=None):
+        """
+        Give up the lease of a failed entry; the drainer retries it after a backoff.
+        """
+        if entry_id is None:
+            return
+        with self._lock:
+            self._inflight.discard(entry_id)
+        connection = self._connection()
+        with self._transaction(connection):
+            failed = self._failed_attempt(connection, entry_id)
+            if failed is None:
+                return
+            attempts, delay = failed
+            connection.execute(
+                "UPDATE outbox SET attempts = ?, next_at = ?, claimed_by = NULL, lease_until = 0 WHERE id = ?",
+                (attempts, time.time() + delay, entry_id),
+            )
+        if attempts >= self.max_attempts:
+            self.ack(entry_id, error=f"{attempts} attempts failed, last error: {error}")
+        else:
+            with self._lock:
+                self.retried += 1
+            logging.warning(f"Outbox entry {entry_id} failed ({error}), retry {attempts} in {delay:.0f}s")
+
+    def pending(self, limit=None):
+        """
+        Unacknowledged entries as (id, phone_number_id, payload dict, created_at), oldest first.
+        """
+        rows = self._connection().execute(
+            "SELECT id, phone_number_id, payload, created_at FROM outbox "
+            "WHERE lease_until IS NOT NULL ORDER BY id LIMIT ?",
+            (limit or -1,),
+        ).fetchall()
+        return [(entry_id, phone, json.loads(payload), created_at) for entry_id, phone, payload, created_at in rows]
+
+    def claim(self, limit):
+        """
+        Lease up to limit due entries to this process: open, past their backoff
+        and not leased by anyone. Returns (id, phone_number_id, payload dict).
+        """
+        now = time.time()
+        connection = self._connection()
+        with self._transaction(connection):
+            rows = connection.execute(
+                "SELECT id, phone_number_id, payload FROM outbox "
+                "WHERE lease_until IS NOT NULL AND lease_until <= ? AND next_at <= ? "
+                "ORDER BY id LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            if rows:
+                connection.executemany(
+                    "UPDATE outbox SET claimed_by = ?, lease_until = ? WHERE id = ?",
+                    [(self.owner, now + self.replay_after, entry_id) for entry_id, _, _ in rows],
+                )
+        with self._lock:
+            self._inflight.update(entry_id for entry_id, _, _ in rows)
+            self.claimed += len(rows)
+        return [(entry_id, phone, json.loads(payload)) for entry_id, phone, payload in rows]
+
+    def renew(self):
+        """
+        Extend the leases of all entries this process is still sending.
+        """
+        now = time.time()
+        self._connection().execute(
+            "UPDATE outbox SET lease_until = ? WHERE claimed_by = ? AND lease_until IS NOT NULL AND lease_until > 0",
+            (now + self.replay_after, self.owner),
+        )
+        self._renewed_at = time.monotonic()
+
+    def drain(self):
+        """
+        Hand one batch of due pending entries to the sender. Returns the number handed over.
+        """
+        handed = 0
+        for entry_id, phone_number_id, payload in self.claim(self.batch_size):
+            try:
+                self._deliver(entry_id, phone_number_id, payload)
+                handed += 1
+            except Exception as e:
+                logging.exception(f"Handing outbox entry {entry_id} to the sender failed: {e}")
+                self.release(entry_id, str(e))
+        return handed
+
+    def purge(self):
+        cutoff = time.time() - self.retention
+        connection = self._connection()
+        with self._transaction(connection):
+            connection.execute(
+                "DELETE FROM outbox WHERE id IN (SELECT entry_id FROM outbox_acks WHERE acked_at < ?)",
+                (cutoff,),
+            )
+            connection.execute("DELETE FROM outbox_acks WHERE acked_at < ?", (cutoff,))
+
+    def _run(self):
+        while True:
+            try:
+                # Renew well before the leases run out, so no other process replays live sends
+                if time.monotonic() - self._renewed_at > self.replay_after / 3:
+                    self.renew()
+                if self.drain() < self.batch_size:
+                    self._wakeup.wait(min(self.drain_interval, self.replay_after / 3))
+                    self._wakeup.clear()
+                if time.monotonic() - self._last_purge > 3600:
+                    self._last_purge = time.monotonic()
+                    self.purge()
+            except Exception as e:
+                logging.exception(f"Outbox drain failed: {e}")
+                time.sleep(self.drain_interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "appended": self.appended,
+                "delivered": self.delivered,
+                "dead": self.dead,
+                "inflight": len(self._inflight),
+                "retried": self.retried,
+                "claimed": self.claimed,
+            }
+
+
+outbox = Outbox()
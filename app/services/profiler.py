@@ -0,0 +1,208 @@
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import request
+
+PROFILE_HEADER = "X-Profile-Token"
+
+# Innermost frames in these modules mean a thread is idle (waiting for work)
+_IDLE_MODULES = ("threading.py", "queue.py", "selectors.py", "concurrent/futures/thread.py")
+
+
+class _StackSampler:
+    """
+    Samples the Python stacks of all threads every `interval` seconds while
+    it runs. Webhook work happens in job-queue and transcription threads, so
+    sampling only the request thread would mostly show it waiting.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if frame.f_code.co_filename.endswith(_IDLE_MODULES):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+class RequestProfiler:
+    """
+    Opt-in profiling of webhook requests.
+
+    A share of requests (PROFILE_SAMPLE_RATE), plus every request carrying
+    the admin X-Profile-Token header, is profiled and dumped to PROFILE_DIR:
+    the "sampling" mode writes collapsed stacks of all busy threads
+    (flamegraph.pl / speedscope input), the "cprofile" mode a pstats file of
+    the request thread. summary.txt keeps the hottest functions over the
+    last PROFILE_KEEP dumps. Without PROFILING_ENABLED or an admin token the
+    view is not wrapped at all.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.token = None
+        self.sample_rate = 0.0
+        self.mode = "sampling"
+        self.interval = 0.005
+        self.directory = "profiles"
+        self.keep = 200
+        self.top = 40
+        self._recent = []
+        self._lock = threading.Lock()
+        self._active = threading.Semaphore(1)
+        self.profiled = 0
+
+    def init_app(self, app, endpoints=("webhook.webhook_post",)):
+        """
+        Wrap the given view functions. Must run after the blueprints are registered.
+        """
+        self.enabled = app.config["PROFILING_ENABLED"]
+        self.token = app.config["PROFILE_ADMIN_TOKEN"] or None
+        self.sample_rate = app.config["PROFILE_SAMPLE_RATE"]
+        self.mode = app.config["PROFILE_MODE"]
+        self.interval = app.config["PROFILE_INTERVAL"]
+        self.directory = app.config["PROFILE_DIR"]
+        self.keep = app.config["PROFILE_KEEP"]
+        if not self.enabled and not self.token:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for endpoint in endpoints:
+            app.view_functions[endpoint] = self.wrap(app.view_functions[endpoint], endpoint)
+        app.extensions["profiler"] = self
+        logging.info(
+            f"Request profiling on for {', '.join(endpoints)} "
+            f"(sample rate {self.sample_rate}, mode {self.mode}, dir {self.directory})"
+        )
+
+    def _wanted(self):
+        if self.token:
+            supplied = request.headers.get(PROFILE_HEADER)
+            if supplied and hmac.compare_digest(supplied, self.token):
+                return True
+        return self.enabled and random.random() < self.sample_rate
+
+    def wrap(self, view, endpoint):
+        @wraps(view)
+        def profiled_view(*args, **kwargs):
+            # One profile at a time: overlapping samplers would double-count each other's threads
+            if not self._wanted() or not self._active.acquire(blocking=False):
+                return view(*args, **kwargs)
+            try:
+                return self._profile(view, endpoint, args, kwargs)
+            finally:
+                self._active.release()
+
+        return profiled_view
+
+    def _profile(self, view, endpoint, args, kwargs):
+        started = time.perf_counter()
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(view, *args, **kwargs)
+            finally:
+                self._dump_cprofile(profile, endpoint, time.perf_counter() - started)
+
+        sampler = _StackSampler(self.interval)
+        sampler.start()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            sampler.stop()
+            self._dump_stacks(sampler, endpoint, time.perf_counter() - started)
+
+    def _filename(self, endpoint, duration, extension):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(
+            self.directory,
+            f"{stamp}-{endpoint.rsplit('.', 1)[-1]}-{int(duration * 1000)}ms-{os.getpid()}-{self.profiled}.{extension}",
+        )
+
+    def _dump_cprofile(self, profile, endpoint, duration):
+        path = self._filename(endpoint, duration, "prof")
+        profile.dump_stats(path)
+        hot = Counter()
+        for (filename, line, name), (_, _, inline_time, _, _) in pstats.Stats(profile).stats.items():
+            hot[f"{name} ({os.path.basename(filename)}:{line})"] += inline_time
+        self._record(path, hot, duration, "s self time")
+
+    def _dump_stacks(self, sampler, endpoint, duration):
+        path = self._filename(endpoint, duration, "folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        hot = Counter()
+        for stack, count in sampler.stacks.items():
+            hot[stack.rsplit(";", 1)[-1]] += count
+        self._record(path, hot, duration, "samples")
+
+    def _record(self, path, hot, duration, unit):
+        with self._lock:
+            self.profiled += 1
+            self._recent.append((path, hot, duration, unit))
+            while len(self._recent) > self.keep:
+                old_path = self._recent.pop(0)[0]
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+            self._write_summary()
+        logging.info(f"Request profile written to {path} ({duration * 1000:.0f} ms)")
+
+    def _write_summary(self):
+        totals = {}
+        for _, hot, _, unit in self._recent:
+            totals.setdefault(unit, Counter()).update(hot)
+        durations = sorted(duration for _, _, duration, _ in self._recent)
+        lines = [
+            f"Profiles: {len(self._recent)} (of {self.profiled} since start), "
+            f"median request {durations[len(durations) // 2] * 1000:.0f} ms, "
+            f"slowest {durations[-1] * 1000:.0f} ms",
+        ]
+        for unit, counter in totals.items():
+            lines.append("")
+            lines.append(f"Hottest functions by {unit}:")
+            for function, value in counter.most_common(self.top):
+                lines.append(f"{value:>12.3f}  {function}" if isinstance(value, float) else f"{value:>12}  {function}")
+        path = os.path.join(self.directory, "summary.txt")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+profiler = RequestProfiler()
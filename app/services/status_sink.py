@@ -0,0 +1,206 @@
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from app.utils.sqlite_utils import connect
+
+# Columns of message_statuses that record when a status was first reported
+STATUS_COLUMNS = {
+    "sent": "sent_at",
+    "delivered": "delivered_at",
+    "read": "read_at",
+    "failed": "failed_at",
+}
+
+
+class StatusSink:
+    """
+    Collects WhatsApp delivery statuses (sent, delivered, read, failed) and
+    writes them to SQLite in batches.
+
+    add() only appends a small tuple to an in-memory buffer, so the webhook
+    never waits for the database. A background thread flushes the buffer
+    every `flush_interval` seconds, or sooner once `batch_size` statuses are
+    waiting, in one transaction. Each message gets one row with the first
+    time each status was reported, so sent -> delivered -> read latency can
+    be queried directly. If the database falls behind or a write fails, the
+    oldest buffered statuses are dropped beyond `max_buffer`.
+    """
+
+    def __init__(self, db_path=None, flush_interval=5.0, batch_size=500, max_buffer=10000):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer = deque(maxlen=max_buffer)
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._connection = None
+        self._thread = None
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+
+    def init_app(self, app):
+        self.db_path = app.config["STATUS_DB_PATH"] or None
+        self.flush_interval = app.config["STATUS_FLUSH_INTERVAL"]
+        self.batch_size = app.config["STATUS_BATCH_SIZE"]
+        self._buffer = deque(maxlen=app.config["STATUS_BUFFER_MAX"])
+        app.extensions["status_sink"] = self
+        if self.db_path and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="status-sink", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return self.db_path is not None
+
+    def add(self, status):
+        """
+        Buffer one entry of a webhook's "statuses" list.
+        """
+        if not self.enabled:
+            return
+        column = STATUS_COLUMNS.get(status.get("status"))
+        message_id = status.get("id")
+        if column is None or not message_id:
+            return
+        errors = status.get("errors") or [{}]
+        try:
+            timestamp = int(status.get("timestamp"))
+        except (TypeError, ValueError):
+            timestamp = int(time.time())
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append(
+            (message_id, status.get("recipient_id"), column, timestamp, errors[0].get("code"))
+        )
+        self.received += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _connect(self):
+        if self._connection is None:
+            # One connection, used under _flush_lock; batches are written in explicit transactions
+            connection = connect(self.db_path, isolation_level="DEFERRED", check_same_thread=False)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS message_statuses ("
+                "message_id TEXT PRIMARY KEY, recipient_id TEXT, "
+                "sent_at INTEGER, delivered_at INTEGER, read_at INTEGER, failed_at INTEGER, "
+                "error_code INTEGER, updated_at REAL NOT NULL)"
+            )
+            self._connection = connection
+        return self._connection
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered statuses in one transaction. Returns the number written.
+        """
+        with self._flush_lock:
+            batch = []
+            while self._buffer:
+                try:
+                    batch.append(self._buffer.popleft())
+                except IndexError:
+                    break
+            if not batch:
+                return 0
+
+            rows = {column: [] for column in STATUS_COLUMNS.values()}
+            now = time.time()
+            for message_id, recipient_id, column, timestamp, error_code in batch:
+                rows[column].append((message_id, recipient_id, timestamp, error_code, now))
+            try:
+                connection = self._connect()
+                with connection:
+                    for column, params in rows.items():
+                        if not params:
+                            continue
+                        # The first report of each status wins; retried callbacks do not move it
+                        connection.executemany(
+                            f"INSERT INTO message_statuses "
+                            f"(message_id, recipient_id, {column}, error_code, updated_at) "
+                            f"VALUES (?, ?, ?, ?, ?) "
+                            f"ON CONFLICT(message_id) DO UPDATE SET "
+                            f"{column} = COALESCE(message_statuses.{column}, excluded.{column}), "
+                            f"recipient_id = COALESCE(message_statuses.recipient_id, excluded.recipient_id), "
+                            f"error_code = COALESCE(excluded.error_code, message_statuses.error_code), "
+                            f"updated_at = excluded.updated_at",
+                            params,
+                        )
+            except sqlite3.Error as e:
+                # Put the batch back in front of newer statuses for the next flush; like add(),
+                # the oldest statuses are dropped if that exceeds max_buffer
+                room = max(self._buffer.maxlen - len(self._buffer), 0)
+                kept = batch[len(batch) - room:] if room else []
+                self._buffer.extendleft(reversed(kept))
+                self.dropped += len(batch) - len(kept)
+                self.write_errors += 1
+                logging.error(
+                    f"Writing {len(batch)} delivery statuses failed: {e} "
+                    f"({len(kept)} kept for the next flush, {len(batch) - len(kept)} dropped)"
+                )
+                return 0
+            self.written += len(batch)
+            return len(batch)
+
+    def timings(self, message_id):
+        """
+        Return the status timestamps of one message, or None if it is unknown.
+        """
+        self.flush()
+        with self._flush_lock:
+            connection = self._connect()
+            connection.row_factory = sqlite3.Row
+            try:
+                row = connection.execute(
+                    "SELECT * FROM message_statuses WHERE message_id = ?", (message_id,)
+                ).fetchone()
+            finally:
+                connection.row_factory = None
+        return dict(row) if row else None
+
+    def latency_summary(self, since=None):
+        """
+        Aggregate delivery latency (seconds) over messages sent since the given epoch time.
+        """
+        self.flush()
+        since = since or 0
+        with self._flush_lock:
+            row = self._connect().execute(
+                "SELECT COUNT(*), "
+                "AVG(delivered_at - sent_at), MAX(delivered_at - sent_at), "
+                "AVG(read_at - delivered_at), "
+                "SUM(failed_at IS NOT NULL) "
+                "FROM message_statuses WHERE COALESCE(sent_at, failed_at) >= ?",
+                (since,),
+            ).fetchone()
+        return {
+            "messages": row[0],
+            "avg_sent_to_delivered": row[1],
+            "max_sent_to_delivered": row[2],
+            "avg_delivered_to_read": row[3],
+            "failed": row[4] or 0,
+        }
+
+    def stats(self):
+        return {
+            "buffered": len(self._buffer),
+            "received": self.received,
+            "written": self.written,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+        }
+
+
+status_sink = StatusSink()
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+
+from app.services import openai_service
+from app.services.thread_store import thread_store
+
+# Threads that got a message more recently than this are not rotated for size,
+# so a rotation rarely has to give up because a run is still writing to the old thread
+QUIET_SECONDS = 120
+
+
+class ThreadRotator:
+    """
+    Background maintenance that keeps Assistants threads short.
+
+    Every `interval` seconds it looks for users whose thread has reached
+    `max_messages` messages or `max_tokens` (estimated) tokens, or has been
+    idle for `idle_seconds`, summarizes the end of the old thread and
+    switches the user to a fresh thread that starts with that summary. Runs
+    on the new thread only read the summary and what came after it, so run
+    latency no longer grows with the age of a conversation.
+
+    The switch is compare-and-set on the thread id and its last update: if
+    the mapping changed or a message was counted on the old thread in the
+    meantime, the new thread is discarded. Messages are counted before they
+    are posted, so a message either makes the rotation give up or goes to
+    the new thread. Other server processes notice the switch through the
+    thread store's generation on their next lookup.
+    """
+
+    def __init__(self, max_messages=0, max_tokens=0, idle_seconds=0, interval=60.0, batch_size=20,
+                 transcript_messages=50):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.batch_size = batch_size
+        self.transcript_messages = transcript_messages
+        self._thread = None
+        self._lock = threading.Lock()
+        self.rotated = 0
+        self.failed = 0
+        self.conflicts = 0
+
+    def init_app(self, app):
+        self.max_messages = app.config["THREAD_ROTATE_MESSAGES"]
+        self.max_tokens = app.config["THREAD_ROTATE_TOKENS"]
+        self.idle_seconds = app.config["THREAD_ROTATE_IDLE_SECONDS"]
+        self.interval = app.config["THREAD_ROTATE_INTERVAL"]
+        app.extensions["thread_rotator"] = self
+        if self.enabled:
+            self.start()
+
+    @property
+    def enabled(self):
+        return bool(self.max_messages or self.max_tokens or self.idle_seconds)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="thread-rotation", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.exception(f"Thread rotation failed: {e}")
+
+    def run_once(self):
+        """
+        Rotate up to batch_size due threads. Returns the number rotated.
+        """
+        now = time.time()
+        due = thread_store.due_for_rotation(
+            self.max_messages,
+            self.max_tokens,
+            now - self.idle_seconds if self.idle_seconds else None,
+            now - QUIET_SECONDS,
+            limit=self.batch_size,
+        )
+        rotated = 0
+        for wa_id, thread_id, updated_at in due:
+            try:
+                rotated += self.rotate(wa_id, thread_id, updated_at)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logging.warning(f"Rotating thread {thread_id} of {wa_id} failed: {e}")
+        return rotated
+
+    def rotate(self, wa_id, thread_id, updated_at=None):
+        """
+        Move wa_id from thread_id to a new thread carrying a summary. Returns True if it did.
+        With updated_at, gives up if the old thread got a message since.
+        """
+        transcript = openai_service.thread_transcript(thread_id, limit=self.transcript_messages)
+        summary = None
+        if transcript:
+            # A previous rotation's carry-over message becomes the summary to build on
+            role, content = transcript[0]
+            if role == "assistant" and content.startswith(openai_service.CARRY_OVER_PREFIX):
+                summary = content[len(openai_service.CARRY_OVER_PREFIX):].strip()
+                transcript = transcript[1:]
+        if transcript:
+            summary = openai_service.summarize_conversation(summary, transcript)
+
+        new_thread_id = openai_service.create_thread_with_summary(summary) if summary else (
+            openai_service.client.beta.threads.create().id
+        )
+        if not thread_store.replace(wa_id, thread_id, new_thread_id, updated_at):
+            with self._lock:
+                self.conflicts += 1
+            logging.info(f"Thread of {wa_id} changed during rotation, keeping the current one")
+            return False
+
+        with self._lock:
+            self.rotated += 1
+        logging.info(f"Rotated {wa_id} from thread {thread_id} to {new_thread_id}")
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"rotated": self.rotated, "failed": self.failed, "conflicts": self.conflicts}
+
+
+thread_rotator = ThreadRotator()
@@ -0,0 +1,326 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import data_path
+from app.utils.sqlite_utils import ThreadLocalConnection
+
+
+class ThreadStore:
+    """
+    Maps a WhatsApp ID (wa_id) to the OpenAI thread holding its conversation.
+    """
+
+    def get(self, wa_id):
+        raise NotImplementedError
+
+    def set(self, wa_id, thread_id):
+        raise NotImplementedError
+
+    def set_if_absent(self, wa_id, thread_id):
+        """
+        Store thread_id unless wa_id already has a thread; return the stored thread.
+        """
+        existing = self.get(wa_id)
+        if existing is not None:
+            return existing
+        self.set(wa_id, thread_id)
+        return thread_id
+
+    def delete(self, wa_id):
+        raise NotImplementedError
+
+    def generation(self):
+        """
+        A number that changes whenever an existing mapping is changed or
+        deleted, so caches in other processes can tell their entries are stale.
+        """
+        return 0
+
+    def touch(self, wa_id, messages=1, tokens=0, thread_id=None):
+        """
+        Count messages and (estimated) tokens added to wa_id's thread. With
+        thread_id, only if wa_id still uses that thread. Returns True if counted.
+        """
+        return True
+
+    def due_for_rotation(self, max_messages, max_tokens, idle_before, quiet_before, limit=100):
+        """
+        (wa_id, thread_id, updated_at) rows whose thread should be replaced by a fresh one.
+        """
+        return []
+
+    def replace(self, wa_id, old_thread_id, new_thread_id, updated_at=None):
+        """
+        Point wa_id to new_thread_id if it still uses old_thread_id and, with
+        updated_at, nothing was added to it since. Returns True on success.
+        """
+        raise NotImplementedError
+
+
+class SQLiteThreadStore(ThreadStore):
+    """
+    Thread mapping in a SQLite file in WAL mode, safe to share between
+    threads and server processes. Each thread gets its own connection.
+    Besides the thread id, each row tracks when the thread was started and
+    how many messages and tokens it holds, for thread rotation.
+
+    Every change to an existing mapping bumps a generation counter in the
+    same transaction. generation() only reads it after PRAGMA data_version
+    shows that another connection committed something, so checking it on
+    every lookup costs no disk read while nothing changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection = ThreadLocalConnection(path, self._create_tables)
+
+    @staticmethod
+    def _create_tables(connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS user_threads ("
+            "wa_id TEXT PRIMARY KEY, thread_id TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "created_at REAL NOT NULL DEFAULT 0, message_count INTEGER NOT NULL DEFAULT 0, "
+            "token_count INTEGER NOT NULL DEFAULT 0)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS user_threads_generation ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), generation INTEGER NOT NULL)"
+        )
+        connection.execute("INSERT OR IGNORE INTO user_threads_generation VALUES (0, 0)")
+
+    def _write(self, *statements):
+        """
+        Run (sql, params) statements in one transaction that also bumps the generation.
+        Returns the cursor of the first statement.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = connection.execute(*statements[0])
+            for statement in statements[1:]:
+                connection.execute(*statement)
+            connection.execute("UPDATE user_threads_generation SET generation = generation + 1")
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        # Our own commits don't change data_version on this connection
+        self._local.data_version = None
+        return cursor
+
+    def generation(self):
+        connection = self._connection()
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        if getattr(self._local, "data_version", None) != data_version:
+            self._local.generation = connection.execute(
+                "SELECT generation FROM user_threads_generation"
+            ).fetchone()[0]
+            self._local.data_version = data_version
+        return self._local.generation
+
+    def get(self, wa_id):
+        row = self._connection().execute(
+            "SELECT thread_id FROM user_threads WHERE wa_id = ?", (wa_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, wa_id, thread_id):
+        now = time.time()
+        self._write((
+            "INSERT INTO user_threads (wa_id, thread_id, updated_at, created_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(wa_id) DO UPDATE SET thread_id = excluded.thread_id, "
+            "updated_at = excluded.updated_at, "
+            "created_at = CASE WHEN thread_id = excluded.thread_id THEN created_at ELSE excluded.created_at END, "
+            "message_count = CASE WHEN thread_id = excluded.thread_id THEN message_count ELSE 0 END, "
+            "token_count = CASE WHEN thread_id = excluded.thread_id THEN token_count ELSE 0 END",
+            (wa_id, thread_id, now, now),
+        ))
+
+    def set_if_absent(self, wa_id, thread_id):
+        connection = self._connection()
+        now = time.time()
+        connection.execute(
+            "INSERT OR IGNORE INTO user_threads (wa_id, thread_id, updated_at, created_at) "
+            "VALUES (?, ?, ?, ?)",
+            (wa_id, thread_id, now, now),
+        )
+        return self.get(wa_id)
+
+    def delete(self, wa_id):
+        self._write(("DELETE FROM user_threads WHERE wa_id = ?", (wa_id,)))
+
+    def touch(self, wa_id, messages=1, tokens=0, thread_id=None):
+        sql = (
+            "UPDATE user_threads SET message_count = message_count + ?, "
+            "token_count = token_count + ?, updated_at = ? WHERE wa_id = ?"
+        )
+        params = (messages, tokens, time.time(), wa_id)
+        if thread_id is not None:
+            sql += " AND thread_id = ?"
+            params += (thread_id,)
+        return self._connection().execute(sql, params).rowcount == 1
+
+    def due_for_rotation(self, max_messages, max_tokens, idle_before, quiet_before, limit=100):
+        # Size limits only apply to threads that have been quiet for a moment, so a
+        # rotation doesn't race with a run that is still adding to the old thread
+        conditions, params = [], []
+        if max_messages:
+            conditions.append("message_count >= ?")
+            params.append(max_messages)
+        if max_tokens:
+            conditions.append("token_count >= ?")
+            params.append(max_tokens)
+        size = f"(({' OR '.join(conditions)}) AND updated_at < ?)" if conditions else None
+        if size:
+            params.append(quiet_before)
+        idle = None
+        if idle_before:
+            idle = "(message_count > 0 AND updated_at < ?)"
+            params.append(idle_before)
+        where = " OR ".join(clause for clause in (size, idle) if clause)
+        if not where:
+            return []
+        return self._connection().execute(
+            f"SELECT wa_id, thread_id, updated_at FROM user_threads WHERE {where} ORDER BY updated_at LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+
+    def replace(self, wa_id, old_thread_id, new_thread_id, updated_at=None):
+        now = time.time()
+        sql = (
+            "UPDATE user_threads SET thread_id = ?, created_at = ?, message_count = 0, "
+            "token_count = 0 WHERE wa_id = ? AND thread_id = ?"
+        )
+        params = (new_thread_id, now, wa_id, old_thread_id)
+        if updated_at is not None:
+            # A message counted after the thread was picked means a run may still be using it
+            sql += " AND updated_at = ?"
+            params += (updated_at,)
+        cursor = self._write((sql, params))
+        return cursor.rowcount == 1
+
+
+class LRUCachedThreadStore(ThreadStore):
+    """
+    Bounded LRU read cache in front of another ThreadStore, so lookups for
+    active users never touch disk. Writes go through to the backend.
+
+    Each lookup first compares the backend's generation with the one the
+    cache was filled under and drops all entries when it moved, so a thread
+    deleted or rotated by another server process is not used from here
+    after that change is committed.
+    """
+
+    def __init__(self, backend, maxsize=1024):
+        self.backend = backend
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        self.backend = SQLiteThreadStore(app.config["THREADS_DB_PATH"])
+        self.maxsize = app.config["THREAD_CACHE_SIZE"]
+        self.clear()
+        app.extensions["thread_store"] = self
+
+    def _revalidate(self):
+        """
+        Drop the cache if the backend changed since it was filled. Returns the current generation.
+        """
+        generation = self.backend.generation()
+        with self._lock:
+            if generation != self._generation:
+                if self._cache:
+                    self._cache.clear()
+                    self.invalidations += 1
+                self._generation = generation
+        return generation
+
+    def _remember(self, wa_id, thread_id, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                # Read before a newer change; caching it could bring back a stale id
+                return
+            self._cache[wa_id] = thread_id
+            self._cache.move_to_end(wa_id)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def get(self, wa_id):
+        generation = self._revalidate()
+        with self._lock:
+            thread_id = self._cache.get(wa_id)
+            if thread_id is not None:
+                self._cache.move_to_end(wa_id)
+                self.hits += 1
+                return thread_id
+            self.misses += 1
+
+        thread_id = self.backend.get(wa_id)
+        if thread_id is not None:
+            self._remember(wa_id, thread_id, generation)
+        return thread_id
+
+    def set(self, wa_id, thread_id):
+        self.backend.set(wa_id, thread_id)
+        self._remember(wa_id, thread_id)
+
+    def set_if_absent(self, wa_id, thread_id):
+        thread_id = self.backend.set_if_absent(wa_id, thread_id)
+        self._remember(wa_id, thread_id)
+        return thread_id
+
+    def delete(self, wa_id):
+        self.backend.delete(wa_id)
+        with self._lock:
+            self._cache.pop(wa_id, None)
+
+    def generation(self):
+        return self.backend.generation()
+
+    def touch(self, wa_id, messages=1, tokens=0, thread_id=None):
+        touched = self.backend.touch(wa_id, messages, tokens, thread_id)
+        if not touched:
+            with self._lock:
+                self._cache.pop(wa_id, None)
+        return touched
+
+    def due_for_rotation(self, max_messages, max_tokens, idle_before, quiet_before, limit=100):
+        return self.backend.due_for_rotation(max_messages, max_tokens, idle_before, quiet_before, limit)
+
+    def replace(self, wa_id, old_thread_id, new_thread_id, updated_at=None):
+        replaced = self.backend.replace(wa_id, old_thread_id, new_thread_id, updated_at)
+        if replaced:
+            self._remember(wa_id, new_thread_id)
+        else:
+            # Someone else changed the mapping; reload it on the next get()
+            with self._lock:
+                self._cache.pop(wa_id, None)
+        return replaced
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._generation = None
+
+    def stats(self):
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+thread_store = LRUCachedThreadStore(
+    SQLiteThreadStore(os.getenv("THREADS_DB_PATH") or data_path("threads.sqlite3")),
+    maxsize=int(os.getenv("THREAD_CACHE_SIZE") or 1024),
+)
@@ -0,0 +1,119 @@
+import datetime
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def truncate(value, limit):
+    if limit and isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}… [{len(value) - limit} more chars]"
+    return value
+
+
+class TruncatingFilter(logging.Filter):
+    """
+    Renders the message once and cuts it (and string `extra` fields) to
+    max_length characters, so whole webhook bodies or API responses never
+    reach the log queue.
+    """
+
+    def __init__(self, max_length):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        record.msg = truncate(str(record.msg), self.max_length)
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and isinstance(value, str):
+                setattr(record, key, truncate(value, self.max_length))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through one in `every` records of each repetitive event. Log calls
+    opt in with extra={"sample": "<event>"}; warnings and errors always pass.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self._counters = {}
+
+    def filter(self, record):
+        event = getattr(record, "sample", None)
+        if event is None or self.every <= 1 or record.levelno >= logging.WARNING:
+            return True
+        counter = self._counters.get(event)
+        if counter is None:
+            counter = self._counters.setdefault(event, itertools.count())
+        if next(counter) % self.every:
+            return False
+        record.sampled_1_in = self.every
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line with timestamp, level, logger, message, thread,
+    any `extra` fields and the formatted exception.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler for a bounded queue: when the writer falls behind, records
+    are dropped and counted instead of blocking the calling worker.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "dropped": self.dropped,
+        }
+
+    def prepare(self, record):
+        # Keep exc_info as text only; the formatter runs in the listener thread
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
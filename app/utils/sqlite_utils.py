@@ -0,0 +1,43 @@
+import os
+import sqlite3
+import threading
+
+
+def connect(path, **options):
+    """
+    Open a SQLite database in WAL mode, so readers in other threads and
+    processes don't wait for a writer. Autocommit unless isolation_level is
+    given; the parent directory is created if needed.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    options.setdefault("timeout", 5)
+    options.setdefault("isolation_level", None)
+    connection = sqlite3.connect(path, **options)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class ThreadLocalConnection:
+    """
+    Callable returning this thread's connection to the database at `path`,
+    opened on first use. setup(connection) runs once on every new connection,
+    e.g. to create tables. Changing `path` opens new connections.
+    """
+
+    def __init__(self, path=None, setup=None):
+        self.path = path
+        self.setup = setup
+        self._local = threading.local()
+
+    def __call__(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.path != self.path:
+            connection = connect(self.path)
+            if self.setup is not None:
+                self.setup(connection)
+            self._local.connection = connection
+            self._local.path = self.path
+        return connection
@@ -1,16 +1,16 @@
 import logging
-from flask import current_app, jsonify
+from collections import namedtuple
+from flask import current_app
 import json
-import requests
 
-# from app.services.openai_service import generate_response
-import re
+from app.services.backends import reply_router, ReplyRequest
+from app.services.outbound import outbound
 
+import re
 
-def log_http_response(response):
-    logging.info(f"Status: {response.status_code}")
-    logging.info(f"Content-type: {response.headers.get('content-type')}")
-    logging.info(f"Body: {response.text}")
+# A single call, status or message from a webhook payload, together with the
+# "value" object it came from (metadata, contacts).
+WebhookEvent = namedtuple("WebhookEvent", ["kind", "value", "item"])
 
 
 def get_text_message_input(recipient, text):
@@ -25,36 +25,14 @@ def get_text_message_input(recipient, text):
     )
 
 
-def generate_response(response):
-    # Return text in uppercase
-    return response.upper()
-
-
 def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {current_app.config['ACCESS_TOKEN']}",
-    }
-
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
-
-    try:
-        response = requests.post(
-            url, data=data, headers=headers, timeout=10
-        )  # 10 seconds timeout as an example
-        response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
-    except requests.Timeout:
-        logging.error("Timeout occurred while sending message")
-        return jsonify({"status": "error", "message": "Request timed out"}), 408
-    except (
-        requests.RequestException
-    ) as e:  # This will catch any general request exception
-        logging.error(f"Request failed due to: {e}")
-        return jsonify({"status": "error", "message": "Failed to send message"}), 500
-    else:
-        # Process the response as normal
-        log_http_response(response)
-        return response
+    """
+    Journal the message in the outbox and queue it for sending. Returns a
+    Future that resolves to the Graph API response, or to None if the message
+    was rejected or given up after the outbox retries.
+    """
+    payload = json.loads(data) if isinstance(data, (str, bytes)) else data
+    return outbound.enqueue(current_app.config["PHONE_NUMBER_ID"], payload)
 
 
 def process_text_for_whatsapp(text):
@@ -75,33 +53,60 @@ def process_text_for_whatsapp(text):
     return whatsapp_style_text
 
 
-def process_whatsapp_message(body):
-    wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
-    name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
+def iter_webhook_events(body):
+    """
+    Yield every call, status and message of a webhook payload as a WebhookEvent.
+    Meta may batch several entries (phone numbers), changes and messages into one POST.
+    """
+    for entry in body.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            if value.get("event") == "call":
+                yield WebhookEvent("call", value, value.get("call") or {})
+            for status in value.get("statuses") or []:
+                yield WebhookEvent("status", value, status)
+            for message in value.get("messages") or []:
+                if message:
+                    yield WebhookEvent("message", value, message)
+
+
+def get_contact(value, wa_id):
+    """
+    Return the contact entry for wa_id from a webhook value, or the first contact.
+    """
+    contacts = value.get("contacts") or [{}]
+    for contact in contacts:
+        if contact.get("wa_id") == wa_id:
+            return contact
+    return contacts[0]
+
 
-    message = body["entry"][0]["changes"][0]["value"]["messages"][0]
-    message_body = message["text"]["body"]
+def process_whatsapp_message(body):
+    for event in iter_webhook_events(body):
+        if event.kind != "message":
+            continue
+        message = event.item
+        contact = get_contact(event.value, message.get("from"))
+        wa_id = contact["wa_id"]
+        name = contact["profile"]["name"]
 
-    # TODO: implement custom function here
-    response = generate_response(message_body)
+        message_body = message["text"]["body"]
 
-    # OpenAI Integration
-    # response = generate_response(message_body, wa_id, name)
-    # response = process_text_for_whatsapp(response)
+        # The configured backend chain (REPLY_BACKENDS) answers; "echo" replies in uppercase
+        reply = reply_router.reply(ReplyRequest(wa_id, message_body, name=name))
+        if reply.text is None:
+            logging.error(f"No reply backend answered {wa_id}: {reply.error}")
+            continue
+        response = process_text_for_whatsapp(reply.text)
 
-    data = get_text_message_input(current_app.config["RECIPIENT_WAID"], response)
-    send_message(data)
+        data = get_text_message_input(current_app.config["RECIPIENT_WAID"], response)
+        send_message(data)
 
 
 def is_valid_whatsapp_message(body):
     """
-    Check if the incoming webhook event has a valid WhatsApp message structure.
+    Check if the incoming webhook event contains at least one WhatsApp message.
     """
-    return (
-        body.get("object")
-        and body.get("entry")
-        and body["entry"][0].get("changes")
-        and body["entry"][0]["changes"][0].get("value")
-        and body["entry"][0]["changes"][0]["value"].get("messages")
-        and body["entry"][0]["changes"][0]["value"]["messages"][0]
+    return bool(body.get("object")) and any(
+        event.kind == "message" for event in iter_webhook_events(body)
     )
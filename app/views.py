@@ -1,201 +1,297 @@
-import os
 import logging
-import json
-import re
-from openai import OpenAI
-import requests
+import queue
+from concurrent.futures import wait
 from flask import Blueprint, request, jsonify, current_app
 from .decorators.security import signature_required
-from .utils.whatsapp_utils import (
-    process_whatsapp_message,
-    is_valid_whatsapp_message,
-)
+from .services.admission import Overloaded
+from .services.answer_cache import answer_cache
+from .services.backends import reply_router, ReplyRequest
+from .services.coalescer import coalescer
+from .services.dedup import deduplicator
+from .services.audio_pipeline import audio_pipeline, AudioDownloadError, TranscriptionError
+from .services.graph_api import GraphAPIError
+from .services.ingress import ingress, STATUS
+from .services.job_queue import job_queue
+from .services.metrics import metrics
+from .services.outbound import outbound
+from .services.status_sink import status_sink
+from .utils.whatsapp_utils import iter_webhook_events
 
-# --- OpenAI-Client initialisieren ---
-client = OpenAI()
-
-# --- Assistants API: Speicher für Threads (In-Memory - NUR ZUM TESTEN!) ---
-user_threads = {}
-
-# --- DEINE ASSISTANT ID HIER EINFÜGEN ---
-ASSISTANT_ID = "asst_1MqcBju8sZsGXqXLfmfVQotP"
+NO_REPLY_TEXT = "Entschuldige, ich konnte keine Antwort generieren."
+CALL_REPLY_TEXT = "Hallo! Ich bin ein automatischer Chatbot und kann keine Anrufe annehmen. Bitte schreib mir eine Nachricht, um mir dein Anliegen mitzuteilen. 😊"
 
 # --- Blueprint für Webhooks ---
 webhook_blueprint = Blueprint("webhook", __name__)
 
 # --- Funktion zur Verarbeitung eingehender Nachrichten ---
 def handle_message():
+    # Die rohen Bytes hat signature_required bereits gelesen und geprüft; sie werden genau einmal geparst
+    raw_payload = request.get_data(cache=True)
+    with metrics.time("parse", "webhook"):
+        body = ingress.parse(raw_payload)
+    if not body:
+        logging.info("Leerer oder ungültiger JSON-Body empfangen. Möglicherweise ein Status-Update ohne Inhalt oder ein ungültiger Request.")
+        return jsonify({"status": "ok", "message": "No valid JSON body"}), 200
+
+    # Reine Statusupdates (der Großteil aller Webhooks) brauchen weder Dedup noch Job-Queue
+    if ingress.classify(raw_payload) == STATUS:
+        for event in iter_webhook_events(body):
+            handle_status(event.value, event.item)
+        return jsonify({"status": "ok"}), 200
+
+    events, duplicates = drop_duplicates(body)
+    if not events:
+        if duplicates:
+            return jsonify({"status": "ok", "message": "Duplicate message"}), 200
+        logging.info("Request ist kein gültiges WhatsApp API-Ereignis.")
+        return (
+            jsonify({"status": "error", "message": "Kein gültiges WhatsApp API-Ereignis"}),
+            404,
+        )
+
+    # Im Hintergrundmodus werden die Events nur in die Job-Queue gelegt und sofort bestätigt,
+    # damit Meta den Webhook nicht wegen Zeitüberschreitung erneut zustellt.
+    if current_app.config["ASYNC_PROCESSING"]:
+        for index, event in enumerate(events):
+            try:
+                job_queue.submit_keyed(event_key(event), process_event, event)
+            except queue.Full:
+                logging.warning(f"Job-Queue voll ({job_queue.depth()} Einträge). Webhook wird abgelehnt.")
+                # Nicht eingereihte Nachrichten dürfen von Meta erneut zugestellt werden
+                forget_messages(events[index:])
+                return jsonify({"status": "error", "message": "Server ausgelastet"}), 503
+        return jsonify({"status": "ok"}), 200
+
+    return process_events(events)
+
+# --- Alle Einträge, Changes, Nachrichten und Statusupdates des Payloads in einem Durchlauf einsammeln ---
+def drop_duplicates(body):
+    """
+    Events of the payload without messages that were already processed, and the number dropped.
+    """
+    # Von Meta erneut zugestellte Nachrichten werden verworfen, bevor Transkription, Assistant oder Versand starten.
+    events = []
+    duplicates = 0
+    for event in iter_webhook_events(body):
+        if event.kind == "message" and deduplicator.is_duplicate(event.item.get("id")):
+            logging.info(f"Doppelte Zustellung der Nachricht {event.item.get('id')} wird ignoriert.")
+            duplicates += 1
+            continue
+        events.append(event)
+    return events, duplicates
+
+# --- Nicht verarbeitete Nachrichten wieder freigeben, damit Meta sie erneut zustellen darf ---
+def forget_messages(events):
+    for event in events:
+        if event.kind == "message":
+            deduplicator.forget(event.item.get("id"))
+
+# --- Synchrone Verarbeitung aller Events eines Payloads ---
+def process_events(events):
+    futures = {}
     try:
-        body = request.get_json(silent=True)
-        if not body:
-            logging.info("Leerer oder ungültiger JSON-Body empfangen. Möglicherweise ein Status-Update ohne Inhalt oder ein ungültiger Request.")
-            return jsonify({"status": "ok", "message": "No valid JSON body"}), 200
-
-        # Hier wird der event_type überprüft, um Anrufe abzufangen
-        event_type = body["entry"][0]["changes"][0]["value"].get("event")
-        if event_type == "call":
-            from_number = body["entry"][0]["changes"][0]["value"]["call"]["from"]
-            logging.info(f"WhatsApp-Anruf von {from_number} empfangen. Sende automatische Antwort.")
-            
-            # Sende eine Nachricht, die den Anruf nicht annimmt
-            reply_text = "Hallo! Ich bin ein automatischer Chatbot und kann keine Anrufe annehmen. Bitte schreib mir eine Nachricht, um mir dein Anliegen mitzuteilen. 😊"
-            
-            phone_number_id = body["entry"][0]["changes"][0]["value"]["metadata"]["phone_number_id"]
-            url = f"https://graph.facebook.com/v17.0/{phone_number_id}/messages"
-            headers = {
-                "Authorization": f"Bearer {os.getenv('WHATSAPP_TOKEN')}",
-                "Content-Type": "application/json"
-            }
-            data = {
-                "messaging_product": "whatsapp",
-                "to": from_number,
-                "type": "text",
-                "text": {"body": reply_text}
-            }
-            requests.post(url, headers=headers, json=data)
-            
-            return jsonify({"status": "ok"}), 200
-
-        if (
-            body.get("entry", [{}])[0]
-            .get("changes", [{}])[0]
-            .get("value", {})
-            .get("statuses")
-        ):
-            logging.info("WhatsApp-Statusupdate empfangen.")
-            return jsonify({"status": "ok"}), 200
-
-        if is_valid_whatsapp_message(body):
-            message_body = body["entry"][0]["changes"][0]["value"]["messages"][0]
-            from_number = message_body["from"]
-            message_type = message_body["type"]
-
-            incoming_message_text = ""
-
-            if message_type == "text":
-                incoming_message_text = message_body["text"]["body"]
-            elif message_type == "audio":
-                audio_media_id = message_body["audio"]["id"]
-                logging.info(f"Sprachnachricht empfangen mit Media ID: {audio_media_id}")
-                
-                media_url = f"https://graph.facebook.com/v17.0/{audio_media_id}"
-                headers = {
-                    "Authorization": f"Bearer {os.getenv('WHATSAPP_TOKEN')}"
-                }
-                
-                media_response = requests.get(media_url, headers=headers)
-                
-                if media_response.status_code == 200:
-                    download_url = media_response.json().get('url')
-                    
-                    if download_url:
-                        audio_data_response = requests.get(download_url, headers=headers)
-                        
-                        if audio_data_response.status_code == 200:
-                            audio_file = audio_data_response.content
-                            try:
-                                whisper_response = client.audio.transcriptions.create(
-                                    model="whisper-1",
-                                    file=("audio.ogg", audio_file),
-                                    response_format="text"
-                                )
-                                incoming_message_text = whisper_response
-                                logging.info(f"Transkribierte Sprachnachricht: {incoming_message_text}")
-                            except Exception as e:
-                                logging.error(f"Fehler bei der Transkription: {e}")
-                                incoming_message_text = "Transkription fehlgeschlagen."
-                        else:
-                            logging.error(f"Fehler beim Herunterladen der Sprachdatei: {audio_data_response.status_code}")
-                            incoming_message_text = "Fehler beim Herunterladen der Sprachdatei."
-                    else:
-                        logging.error("Download URL für Sprachnachricht nicht gefunden.")
-                        incoming_message_text = "Fehler beim Abrufen der Sprachnachricht."
-                else:
-                    logging.error(f"Fehler beim Abrufen der Media-Informationen von WhatsApp: {media_response.status_code}")
-                    incoming_message_text = "Fehler beim Verarbeiten der Sprachnachricht."
-            else:
-                logging.info(f"Nachrichtentyp '{message_type}' wird noch nicht unterstützt.")
-                return jsonify({"status": "ok"}), 200
-
-            if not incoming_message_text:
-                logging.info("Nachricht ohne Textinhalt verarbeitet (z.B. eine leere Audionachricht).")
-                return jsonify({"status": "ok"}), 200
-
-            thread_id = user_threads.get(from_number)
-            if not thread_id:
-                logging.info(f"Neuer Thread für Benutzer {from_number} wird erstellt.")
-                thread = client.beta.threads.create()
-                thread_id = thread.id
-                user_threads[from_number] = thread_id
-
-            client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=incoming_message_text
-            )
-            logging.info(f"Nachricht zu Thread {thread_id} hinzugefügt.")
-
-            run = client.beta.threads.runs.create_and_poll(
-                thread_id=thread_id,
-                assistant_id=ASSISTANT_ID
-            )
-
-            messages = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit="1")
-            
-            reply_text = "Entschuldige, ich konnte keine Antwort generieren."
-
-            for msg in messages.data:
-                if msg.role == "assistant" and msg.run_id == run.id:
-                    for content_block in msg.content:
-                        if content_block.type == "text":
-                            reply_text = content_block.text.value
-                            break
-                    if reply_text:
-                        break
-
-            reply_text = reply_text.replace('\\n', '\n')
-            reply_parts = reply_text.split('[NL]')
-            
-            logging.info(f"Antwort des Bots: {reply_text}")
-
-            phone_number_id = body["entry"][0]["changes"][0]["value"]["metadata"]["phone_number_id"]
-            
-            url = f"https://graph.facebook.com/v17.0/{phone_number_id}/messages"
-            headers = {
-                "Authorization": f"Bearer {os.getenv('WHATSAPP_TOKEN')}",
-                "Content-Type": "application/json"
-            }
-            
-            for part in reply_parts:
-                if part.strip():
-                    data = {
-                        "messaging_product": "whatsapp",
-                        "to": from_number,
-                        "type": "text",
-                        "text": {"body": part.strip()}
-                    }
-                    whatsapp_send_response = requests.post(url, headers=headers, json=data)
-                    logging.info(f"WhatsApp Send API Status: {whatsapp_send_response.status_code}")
-                    logging.info(f"WhatsApp Send API Body: {whatsapp_send_response.text}")
-
-            return jsonify({"status": "ok"}), 200
-        else:
-            logging.info("Request ist kein gültiges WhatsApp API-Ereignis.")
-            return (
-                jsonify({"status": "error", "message": "Kein gültiges WhatsApp API-Ereignis"}),
-                404,
-            )
-
-    except json.JSONDecodeError:
-        logging.error("Fehler beim Dekodieren von JSON des Webhook-Payloads.")
-        return jsonify({"status": "error", "message": "Ungültiges JSON bereitgestellt"}), 400
+        # Nachrichten laufen parallel auf dem Worker-Pool, damit ein Webhook mit N Nachrichten
+        # ungefähr eine Assistant-Laufzeit kostet statt N. Pro Absender bleibt die Reihenfolge
+        # erhalten, da ein Assistants-Thread keinen zweiten aktiven Run zulässt.
+        for index, event in enumerate(events):
+            if event.kind != "message":
+                process_event(event)
+                continue
+            try:
+                futures[index] = job_queue.submit_keyed(event_key(event), process_event, event)
+            except queue.Full:
+                # Nicht inline verarbeiten: die Nachricht könnte eine ältere desselben Absenders
+                # überholen, die noch in dessen Lane wartet
+                logging.warning(f"Job-Queue voll ({job_queue.depth()} Einträge). Webhook wird abgelehnt.")
+                forget_unfinished(events, futures)
+                return jsonify({"status": "error", "message": "Server ausgelastet"}), 503
+
+        # Erst auf alle Nachrichten warten, damit bei einem Fehler feststeht, welche fertig sind
+        wait(futures.values())
+        for future in futures.values():
+            future.result()
+
+        return jsonify({"status": "ok"}), 200
+
     except KeyError as ke:
-        logging.error(f"Fehler: Fehlender Schlüssel im Payload - {ke}. Vollständiger Body: {body}")
+        logging.error(f"Fehler: Fehlender Schlüssel im Payload - {ke}. Events: {events}")
+        forget_unfinished(events, futures)
         return jsonify({"status": "error", "message": f"Fehlender Datenpunkt im Payload: {ke}"}), 400
     except Exception as e:
         logging.error(f"Ein unerwarteter Fehler ist aufgetreten: {e}")
+        forget_unfinished(events, futures)
         return jsonify({"status": "error", "message": "Interner Serverfehler"}), 500
 
+# --- Nach einem Fehler darf Meta alle Nachrichten erneut zustellen, die nicht erfolgreich verarbeitet wurden ---
+def forget_unfinished(events, futures):
+    # Bereits eingereihte Nachrichten laufen noch; erst ihr Ergebnis entscheidet
+    wait(futures.values())
+    forget_messages(
+        event
+        for index, event in enumerate(events)
+        if index not in futures or futures[index].exception() is not None
+    )
+
+# --- Nachrichten eines Absenders landen in derselben Lane und werden nacheinander verarbeitet ---
+def event_key(event):
+    if event.kind == "message":
+        return event.item.get("from")
+    return None
+
+# --- Verarbeitung eines einzelnen Events (synchron oder im Hintergrund-Worker) ---
+def process_event(event):
+    if event.kind == "call":
+        handle_call(event.value, event.item)
+    elif event.kind == "status":
+        handle_status(event.value, event.item)
+    else:
+        handle_incoming_message(event.value, event.item)
+
+def handle_status(value, status):
+    logging.info(f"WhatsApp-Statusupdate empfangen: {status.get('status')}", extra={"sample": "status"})
+    metrics.count("events", "status")
+    if status.get("status") == "failed":
+        logging.warning(f"Zustellung von {status.get('id')} fehlgeschlagen: {status.get('errors')}")
+    # Nur puffern; geschrieben wird gesammelt im Hintergrund
+    status_sink.add(status)
+
+def handle_call(value, call):
+    from_number = call["from"]
+    logging.info(f"WhatsApp-Anruf von {from_number} empfangen. Sende automatische Antwort.")
+    metrics.count("events", "call")
+
+    # Sende eine Nachricht, die den Anruf nicht annimmt
+    phone_number_id = value["metadata"]["phone_number_id"]
+    outbound.enqueue_text(phone_number_id, from_number, CALL_REPLY_TEXT)
+
+def handle_incoming_message(value, message_body):
+    from_number = message_body["from"]
+    message_type = message_body["type"]
+    metrics.count("events", message_type)
+
+    incoming_message_text = ""
+
+    if message_type == "text":
+        incoming_message_text = message_body["text"]["body"]
+    elif message_type == "audio":
+        audio_media_id = message_body["audio"]["id"]
+        logging.info(f"Sprachnachricht empfangen mit Media ID: {audio_media_id}")
+
+        # Download (gestreamt, mit Größenlimit) und Whisper laufen im Transkriptions-Pool;
+        # bereits transkribierte Sprachnachrichten kommen aus dem Cache.
+        try:
+            incoming_message_text = audio_pipeline.transcribe(audio_media_id)
+            logging.info(f"Transkribierte Sprachnachricht: {incoming_message_text}")
+        except TRANSCRIPTION_ERRORS as e:
+            incoming_message_text = transcription_error_text(e)
+    else:
+        logging.info(f"Nachrichtentyp '{message_type}' wird noch nicht unterstützt.")
+        return
+
+    if not incoming_message_text:
+        logging.info("Nachricht ohne Textinhalt verarbeitet (z.B. eine leere Audionachricht).")
+        return
+
+    # Kurz aufeinander folgende Nachrichten desselben Absenders werden gesammelt
+    # und mit einem einzigen Assistant-Run beantwortet.
+    if coalescer.enabled:
+        coalescer.add(from_number, (value, incoming_message_text, message_type), flush_coalesced_messages)
+        return
+
+    answer_messages(value, from_number, [incoming_message_text], message_type)
+
+# --- Fehler beim Abrufen oder Transkribieren einer Sprachnachricht (auch vom asyncio-Server genutzt) ---
+TRANSCRIPTION_ERRORS = (GraphAPIError, AudioDownloadError, TranscriptionError)
+
+def transcription_error_text(error):
+    # Der Text ersetzt die Nachricht des Gasts, damit der Assistant auf den Fehler eingehen kann
+    if isinstance(error, AudioDownloadError):
+        logging.error(f"Fehler beim Herunterladen der Sprachdatei: {error}")
+        return "Fehler beim Herunterladen der Sprachdatei."
+    if isinstance(error, TranscriptionError):
+        logging.error(f"Fehler bei der Transkription: {error}")
+        return "Transkription fehlgeschlagen."
+    logging.error(f"Fehler beim Abrufen der Media-Informationen von WhatsApp: {error}")
+    return "Fehler beim Verarbeiten der Sprachnachricht."
+
+# --- Gesammelte Nachrichten eines Absenders in seiner Lane beantworten lassen ---
+def flush_coalesced_messages(from_number, batch):
+    value = batch[-1][0]
+    texts = [text for _, text, _ in batch]
+    # Gemischte Batches zählen in den Metriken als Audio, sobald eine Sprachnachricht dabei ist
+    message_type = "audio" if any(kind == "audio" for _, _, kind in batch) else "text"
+    logging.info(f"{len(texts)} Nachricht(en) von {from_number} werden gemeinsam beantwortet.")
+    try:
+        job_queue.submit_keyed(from_number, answer_messages, value, from_number, texts, message_type)
+    except queue.Full:
+        answer_messages(value, from_number, texts, message_type)
+
+# --- Nachrichten an den Assistant-Thread anhängen und die Antwort senden ---
+def answer_messages(value, from_number, texts, message_type="text"):
+    incoming_message_text = "\n".join(texts)
+    phone_number_id = value["metadata"]["phone_number_id"]
+
+    # Die Teile werden an den Outbound-Scheduler übergeben, der die Reihenfolge pro Empfänger
+    # einhält, pro Absendernummer drosselt und bei 429/5xx erneut versucht.
+    sent_parts = []
+
+    def send_part(part):
+        part = clean_part(part)
+        if part:
+            outbound.enqueue_text(phone_number_id, from_number, part)
+            sent_parts.append(part)
+
+    # Wiederkehrende FAQ-Fragen direkt aus dem Antwort-Cache beantworten, ohne OpenAI-Aufruf
+    cached = cached_reply(incoming_message_text, message_type)
+    if cached is not None:
+        send_reply(phone_number_id, from_number, cached)
+        return
+
+    # Die Backend-Kette (REPLY_BACKENDS) erzeugt die Antwort: jedes Backend hat eine eigene
+    # Deadline, bei Fehler oder Zeitüberschreitung ist das nächste dran. Beim Streaming sind
+    # die Teile danach bereits gesendet.
+    reply_request = ReplyRequest(from_number, incoming_message_text, message_type, send_part=send_part)
+    reply = reply_router.reply(reply_request)
+    if reply.streamed and reply.text is None:
+        logging.error(f"Antwort an {from_number} nach {len(sent_parts)} gesendeten Teilen abgebrochen: {reply.error}")
+        return
+    text = reply_text(reply, reply_request, current_app.config)
+    if not reply.streamed:
+        send_reply(phone_number_id, from_number, text)
+
+# --- Bausteine der Antwort, die der Flask- und der asyncio-Server gemeinsam nutzen ---
+def cached_reply(incoming_message_text, message_type):
+    cached = answer_cache.get(incoming_message_text)
+    if cached is not None:
+        logging.info(f"Antwort aus dem Cache: {cached}")
+        metrics.count("cached_answers", message_type)
+    return cached
+
+def reply_text(reply, reply_request, config):
+    # Text, der für eine Antwort der Backend-Kette gesendet wird
+    if reply.text is None:
+        if isinstance(reply.error, Overloaded):
+            # Der Assistant ist ausgelastet oder gestört und kein anderes Backend hat geantwortet
+            logging.warning(f"Assistant überlastet ({reply.error.reason}), sende Hinweis an {reply_request.wa_id}.")
+            metrics.count("shed", reply_request.message_type, stage=reply.error.reason)
+            return config["BUSY_REPLY_TEXT"]
+        return NO_REPLY_TEXT
+    logging.info(f"Antwort des Bots ({reply.backend}): {reply.text}")
+    # Nur Antworten, die nicht vom Verlauf dieses Gasts abhängen, dürfen anderen Nutzern ausgeliefert werden
+    if reply_router.cacheable(reply):
+        answer_cache.put(reply_request.text, reply.text)
+    return reply.text
+
+def clean_part(part):
+    return part.replace('\\n', '\n').strip()
+
+def send_reply(phone_number_id, to, text):
+    # Jeder [NL]-Teil geht an den Outbound-Scheduler (Reihenfolge pro Empfänger, Drosselung, Wiederholung)
+    for part in text.split('[NL]'):
+        part = clean_part(part)
+        if part:
+            outbound.enqueue_text(phone_number_id, to, part)
+
 def verify():
     mode = request.args.get("hub.mode")
     token = request.args.get("hub.verify_token")
@@ -0,0 +1,391 @@
+"""
+Local stand-ins for the WhatsApp Graph API and the OpenAI API.
+
+Both are served by one aiohttp application, so the bot can be pointed at it
+with GRAPH_API_BASE_URL=http://host:port and OPENAI_BASE_URL=http://host:port/v1.
+Every endpoint waits a configurable latency (with jitter) and fails with a
+configurable error rate, so the bot's retries and fallbacks are exercised too.
+
+    python -m bench.fake_services --port 8900 --run-latency 1.5 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+
+from aiohttp import web
+
+REPLY_TEXT = "Danke für deine Nachricht![NL]Der Check-in ist ab 15 Uhr möglich."
+TRANSCRIPT_TEXT = "Wann kann ich einchecken?"
+
+
+class FakeSettings:
+    def __init__(
+        self,
+        graph_latency=0.05,
+        media_latency=0.05,
+        openai_latency=0.05,
+        run_latency=1.0,
+        whisper_latency=0.5,
+        jitter=0.2,
+        error_rate=0.0,
+        media_bytes=32 * 1024,
+        reply_text=REPLY_TEXT,
+        seed=None,
+    ):
+        self.graph_latency = graph_latency
+        self.media_latency = media_latency
+        self.openai_latency = openai_latency
+        self.run_latency = run_latency
+        self.whisper_latency = whisper_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.media_bytes = media_bytes
+        self.reply_text = reply_text
+        self.random = random.Random(seed)
+
+
+class FakeServices:
+    """
+    State of the fake APIs: runs, threads and every message the bot sent.
+    sent_messages holds (monotonic arrival time, payload) tuples.
+    """
+
+    def __init__(self, settings=None):
+        self.settings = settings or FakeSettings()
+        self.ids = itertools.count(1)
+        self.runs = {}
+        self.sent_messages = []
+        self.requests = 0
+        self.errors = 0
+        self.base_url = None
+
+    # --- helpers ---
+
+    async def _delay(self, latency):
+        settings = self.settings
+        if latency > 0:
+            spread = latency * settings.jitter
+            await asyncio.sleep(max(0.0, latency + settings.random.uniform(-spread, spread)))
+
+    def _fail(self):
+        self.requests += 1
+        if self.settings.error_rate and self.settings.random.random() < self.settings.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "injected failure", "type": "server_error", "code": 503}},
+                status=503,
+            )
+        return None
+
+    def _id(self, prefix):
+        return f"{prefix}_{next(self.ids)}"
+
+    def _run_object(self, run):
+        status = run["status"]
+        if status in ("queued", "in_progress") and time.monotonic() >= run["done_at"]:
+            status = run["status"] = "completed"
+        return {
+            "id": run["id"],
+            "object": "thread.run",
+            "created_at": int(run["created_at"]),
+            "assistant_id": run["assistant_id"],
+            "thread_id": run["thread_id"],
+            "status": status,
+            "model": "fake-model",
+            "instructions": "",
+            "tools": [],
+            "last_error": None,
+            "parallel_tool_calls": True,
+        }
+
+    def _message_object(self, thread_id, role, text, run_id=None):
+        return {
+            "id": self._id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "run_id": run_id,
+            "assistant_id": None,
+            "attachments": [],
+            "metadata": {},
+            "status": "completed",
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+        }
+
+    # --- Graph API ---
+
+    async def graph_send(self, request):
+        await self._delay(self.settings.graph_latency)
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        payload = await request.json()
+        self.sent_messages.append((time.monotonic(), payload))
+        return web.json_response(
+            {
+                "messaging_product": "whatsapp",
+                "contacts": [{"input": payload.get("to"), "wa_id": payload.get("to")}],
+                "messages": [{"id": f"wamid.{next(self.ids)}"}],
+            }
+        )
+
+    async def graph_media(self, request):
+        await self._delay(self.settings.graph_latency)
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        media_id = request.match_info["media_id"]
+        return web.json_response(
+            {
+                "url": f"{self.base_url}/_media/{media_id}/audio.ogg",
+                "mime_type": "audio/ogg",
+                "file_size": self.settings.media_bytes,
+                "id": media_id,
+            }
+        )
+
+    async def media_download(self, request):
+        await self._delay(self.settings.media_latency)
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        # Distinct content per media ID, so the transcript cache only hits on real repeats
+        media_id = request.match_info["media_id"].encode()
+        block = (media_id * (1024 // max(len(media_id), 1) + 1))[:1024]
+        return web.Response(body=block * (self.settings.media_bytes // 1024), content_type="audio/ogg")
+
+    # --- OpenAI API ---
+
+    async def create_thread(self, request):
+        await self._delay(self.settings.openai_latency)
+        return self._fail() or web.json_response(
+            {"id": self._id("thread"), "object": "thread", "created_at": int(time.time()), "metadata": {}}
+        )
+
+    async def create_message(self, request):
+        await self._delay(self.settings.openai_latency)
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        body = await request.json()
+        content = body.get("content")
+        text = content if isinstance(content, str) else json.dumps(content)
+        return web.json_response(self._message_object(request.match_info["thread_id"], "user", text))
+
+    async def list_messages(self, request):
+        await self._delay(self.settings.openai_latency)
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        thread_id = request.match_info["thread_id"]
+        run_id = request.query.get("run_id")
+        if run_id is None:
+            finished = [run for run in self.runs.values() if run["thread_id"] == thread_id]
+            run_id = finished[-1]["id"] if finished else None
+        message = self._message_object(thread_id, "assistant", self.settings.reply_text, run_id)
+        return web.json_response(
+            {"object": "list", "data": [message], "first_id": message["id"], "last_id": message["id"], "has_more": False}
+        )
+
+    async def create_run(self, request):
+        await self._delay(self.settings.openai_latency)
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        body = await request.json()
+        now = time.monotonic()
+        run = {
+            "id": self._id("run"),
+            "thread_id": request.match_info["thread_id"],
+            "assistant_id": body.get("assistant_id"),
+            "status": "queued",
+            "created_at": time.time(),
+            "done_at": now + self.settings.run_latency,
+        }
+        self.runs[run["id"]] = run
+        if body.get("stream"):
+            return await self._stream_run(request, run)
+        return web.json_response(self._run_object(run))
+
+    async def _stream_run(self, request, run):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(event, data):
+            await response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+
+        await send("thread.run.created", self._run_object(run))
+        # Spread the reply over the run latency in a few deltas
+        words = self.settings.reply_text.split(" ")
+        step = max(len(words) // 4, 1)
+        message_id = self._id("msg")
+        for start in range(0, len(words), step):
+            await asyncio.sleep(self.settings.run_latency / 4)
+            chunk = " ".join(words[start:start + step]) + " "
+            await send(
+                "thread.message.delta",
+                {
+                    "id": message_id,
+                    "object": "thread.message.delta",
+                    "delta": {"content": [{"index": 0, "type": "text", "text": {"value": chunk}}]},
+                },
+            )
+        run["status"] = "completed"
+        await send("thread.run.completed", self._run_object(run))
+        await response.write(b"event: done\ndata: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def retrieve_run(self, request):
+        await self._delay(self.settings.openai_latency)
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        run = self.runs.get(request.match_info["run_id"])
+        if run is None:
+            return web.json_response({"error": {"message": "No such run"}}, status=404)
+        return web.json_response(self._run_object(run))
+
+    async def cancel_run(self, request):
+        run = self.runs.get(request.match_info["run_id"])
+        if run is None:
+            return web.json_response({"error": {"message": "No such run"}}, status=404)
+        run["status"] = "cancelled"
+        return web.json_response(self._run_object(run))
+
+    async def retrieve_assistant(self, request):
+        return web.json_response(
+            {
+                "id": request.match_info["assistant_id"],
+                "object": "assistant",
+                "created_at": int(time.time()),
+                "model": "fake-model",
+                "tools": [],
+                "metadata": {},
+                "name": "Fake assistant",
+            }
+        )
+
+    async def transcription(self, request):
+        await request.read()
+        await self._delay(self.settings.whisper_latency)
+        return self._fail() or web.Response(text=TRANSCRIPT_TEXT)
+
+    async def chat_completion(self, request):
+        await self._delay(self.settings.openai_latency)
+        failure = self._fail()
+        if failure is not None:
+            return failure
+        return web.json_response(
+            {
+                "id": self._id("chatcmpl"),
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "fake-model",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": self.settings.reply_text},
+                    }
+                ],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+            }
+        )
+
+    async def stats(self, request):
+        return web.json_response(
+            {"requests": self.requests, "errors": self.errors, "sent_messages": len(self.sent_messages)}
+        )
+
+    def make_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/_stats", self.stats)
+        app.router.add_get("/_media/{media_id}/audio.ogg", self.media_download)
+        app.router.add_post("/v1/threads", self.create_thread)
+        app.router.add_post("/v1/threads/{thread_id}/messages", self.create_message)
+        app.router.add_get("/v1/threads/{thread_id}/messages", self.list_messages)
+        app.router.add_post("/v1/threads/{thread_id}/runs", self.create_run)
+        app.router.add_get("/v1/threads/{thread_id}/runs/{run_id}", self.retrieve_run)
+        app.router.add_post("/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run)
+        app.router.add_get("/v1/assistants/{assistant_id}", self.retrieve_assistant)
+        app.router.add_post("/v1/audio/transcriptions", self.transcription)
+        app.router.add_post("/v1/chat/completions", self.chat_completion)
+        app.router.add_post("/{version}/{phone_number_id}/messages", self.graph_send)
+        app.router.add_get("/{version}/{media_id}", self.graph_media)
+        return app
+
+
+def start_in_thread(services, host="127.0.0.1", port=0):
+    """
+    Serve the fake APIs from a background thread. Returns the base URL.
+    """
+    started = threading.Event()
+    loop = asyncio.new_event_loop()
+
+    async def serve():
+        runner = web.AppRunner(services.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        bound_port = runner.addresses[0][1]
+        services.base_url = f"http://{host}:{bound_port}"
+        started.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve())
+        loop.run_forever()
+
+    threading.Thread(target=run, name="fake-services", daemon=True).start()
+    started.wait()
+    return services.base_url
+
+
+def add_arguments(parser):
+    parser.add_argument("--graph-latency", type=float, default=0.05, help="Graph API latency in seconds")
+    parser.add_argument("--media-latency", type=float, default=0.05, help="media download latency")
+    parser.add_argument("--openai-latency", type=float, default=0.05, help="latency of OpenAI CRUD calls")
+    parser.add_argument("--run-latency", type=float, default=1.0, help="time until an assistant run completes")
+    parser.add_argument("--whisper-latency", type=float, default=0.5, help="transcription latency")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency jitter as a fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--media-bytes", type=int, default=32 * 1024, help="size of fake voice notes")
+    parser.add_argument("--seed", type=int, default=None, help="seed for latency jitter and errors")
+
+
+def settings_from_args(args):
+    return FakeSettings(
+        graph_latency=args.graph_latency,
+        media_latency=args.media_latency,
+        openai_latency=args.openai_latency,
+        run_latency=args.run_latency,
+        whisper_latency=args.whisper_latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        media_bytes=args.media_bytes,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    services = FakeServices(settings_from_args(args))
+    services.base_url = f"http://{args.host}:{args.port}"
+    print(f"GRAPH_API_BASE_URL={services.base_url}")
+    print(f"OPENAI_BASE_URL={services.base_url}/v1")
+    web.run_app(services.make_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+Offline load test for the webhook server.
+
+Starts the fake Graph/OpenAI services, points the bot at them, fires signed
+webhooks at it and reports throughput, acknowledgement latency, time until
+the first reply part reaches the (fake) Graph API, and peak memory.
+
+    python -m bench.load --requests 500 --concurrency 20
+    python -m bench.load --server aio --mix text=70,status=25,audio=5
+    python -m bench.load --json result.json --baseline previous.json
+
+--server flask (default) and aio run the bot in this process; --target sends
+to an already running bot, which then has to be configured with the printed
+GRAPH_API_BASE_URL / OPENAI_BASE_URL itself.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.fake_services import FakeServices, add_arguments, settings_from_args, start_in_thread
+from bench.payloads import PayloadFactory, encode, expected_replies
+
+APP_SECRET = "bench-secret"
+DEFAULT_MIX = "text=60,status=30,audio=5,call=2,batch=3"
+
+# p95 increases beyond this share of the baseline count as a regression
+REGRESSION_TOLERANCE = 0.2
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        weights[kind.strip()] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values, share):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(share * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1] if values else None,
+    }
+
+
+def configure_environment(base_url, workdir, args):
+    """
+    Point the bot at the fake services. Must run before the app is imported,
+    because the OpenAI clients are created at import time.
+    """
+    os.environ.update(
+        {
+            "APP_SECRET": APP_SECRET,
+            "VERIFY_TOKEN": "bench",
+            "WHATSAPP_TOKEN": "bench-token",
+            "PHONE_NUMBER_ID": "100000000000001",
+            "GRAPH_API_BASE_URL": base_url,
+            "OPENAI_BASE_URL": f"{base_url}/v1",
+            "OPENAI_API_KEY": "sk-bench",
+            "OPENAI_ASSISTANT_ID": "asst_bench",
+            # Every file the bot writes goes to the temp directory, not the cwd; DEDUP_DB_PATH
+            # stays unset, so dedup is in memory as by default
+            "DATA_DIR": workdir,
+            "THREADS_DB_PATH": os.path.join(workdir, "threads.sqlite3"),
+            "STATUS_DB_PATH": os.path.join(workdir, "statuses.sqlite3"),
+            "OUTBOX_DB_PATH": os.path.join(workdir, "outbox.sqlite3"),
+            "CONVERSATION_DB_PATH": os.path.join(workdir, "conversations.sqlite3"),
+            "PROFILE_DIR": os.path.join(workdir, "profiles"),
+            "ASYNC_PROCESSING": "true" if args.async_processing else os.getenv("ASYNC_PROCESSING", "false"),
+        }
+    )
+
+
+def start_flask(host="127.0.0.1"):
+    from werkzeug.serving import make_server
+
+    from app import create_app
+
+    server = make_server(host, 0, create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-flask", daemon=True).start()
+    return f"http://{host}:{server.server_port}/webhook", server.shutdown
+
+
+def start_aio(host="127.0.0.1"):
+    from aiohttp import web
+
+    from app.aio import create_async_app
+
+    started = threading.Event()
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(create_async_app(), access_log=None)
+
+    async def serve():
+        await runner.setup()
+        await web.TCPSite(runner, host, 0).start()
+        started.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve())
+        loop.run_forever()
+
+    threading.Thread(target=run, name="bench-aio", daemon=True).start()
+    started.wait()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(timeout=60)
+
+    return f"http://{host}:{runner.addresses[0][1]}/webhook", stop
+
+
+class LoadDriver:
+    def __init__(self, url, factory, mix, concurrency):
+        self.url = url
+        self.factory = factory
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.concurrency = concurrency
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.ack_latencies = defaultdict(list)
+        self.status_codes = Counter()
+        self.posted = defaultdict(list)  # wa_id -> monotonic times a reply was requested
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _prepare(self, count):
+        # Bodies are built and signed up front, so the driver's own cost stays out of the timings
+        prepared = []
+        for _ in range(count):
+            kind = self.factory.random.choices(self.kinds, self.weights)[0]
+            body = self.factory.build(kind)
+            raw, headers = encode(body, APP_SECRET)
+            prepared.append((kind, raw, headers, expected_replies(body)))
+        return prepared
+
+    def _post(self, item):
+        kind, raw, headers, recipients = item
+        started = time.monotonic()
+        try:
+            status_code = self._session().post(self.url, data=raw, headers=headers, timeout=120).status_code
+        except requests.RequestException:
+            status_code = "error"
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.ack_latencies[kind].append(elapsed)
+            self.status_codes[status_code] += 1
+            # Rejected webhooks (e.g. 503 on a full queue) are redelivered by Meta, not answered
+            if status_code == 200:
+                for wa_id in recipients:
+                    self.posted[wa_id].append(started)
+
+    def run(self, count):
+        prepared = self._prepare(count)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(self._post, prepared))
+        return time.monotonic() - started
+
+
+def continuation_parts(reply_text):
+    """
+    Texts the bot sends as the second, third, ... part of the fake assistant's reply.
+    """
+    return {part.replace("\\n", "\n").strip() for part in reply_text.split("[NL]")[1:]} - {""}
+
+
+def reply_starts(sent_messages, continuations):
+    """
+    wa_id -> arrival times of the first part of every reply sent to it, in order.
+    """
+    starts = defaultdict(list)
+    for arrived_at, payload in sent_messages:
+        if payload.get("text", {}).get("body") not in continuations:
+            starts[payload.get("to")].append(arrived_at)
+    for arrivals in starts.values():
+        arrivals.sort()
+    return starts
+
+
+def reply_latencies(posted, sent_messages, continuations=()):
+    """
+    Time from each reply-triggering POST to the first part of its reply.
+
+    Replies don't carry the ID of the message they answer, but the bot
+    answers the messages of one sender one after another, so the n-th reply
+    to a wa_id belongs to its n-th message: POSTs and replies are matched by
+    that sequence number. Matching on the wa_id and time alone counts a
+    message as unanswered as soon as the next message of the same sender is
+    posted before its reply arrives, which is the normal case with --users.
+    """
+    starts = reply_starts(sent_messages, continuations)
+    latencies, missing = [], 0
+    for wa_id, post_times in posted.items():
+        arrivals = starts.get(wa_id, [])
+        for sequence, posted_at in enumerate(sorted(post_times)):
+            if sequence < len(arrivals):
+                latencies.append(arrivals[sequence] - posted_at)
+            else:
+                missing += 1
+    return latencies, missing
+
+
+def wait_for_replies(driver, services, timeout, continuations=()):
+    expected = sum(len(times) for times in driver.posted.values())
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        starts = reply_starts(list(services.sent_messages), continuations)
+        if sum(min(len(starts.get(wa_id, ())), len(times)) for wa_id, times in driver.posted.items()) >= expected:
+            break
+        time.sleep(0.1)
+
+
+def compare(result, baseline):
+    regressions = []
+    for section in ("ack", "reply"):
+        for kind, current in result[section].items():
+            previous = baseline.get(section, {}).get(kind)
+            if not previous or not previous.get("p95") or current.get("p95") is None:
+                continue
+            if current["p95"] > previous["p95"] * (1 + REGRESSION_TOLERANCE):
+                regressions.append(
+                    f"{section}/{kind} p95 {current['p95'] * 1000:.1f} ms "
+                    f"(baseline {previous['p95'] * 1000:.1f} ms)"
+                )
+    if baseline.get("throughput") and result["throughput"] < baseline["throughput"] * (1 - REGRESSION_TOLERANCE):
+        regressions.append(
+            f"throughput {result['throughput']:.1f}/s (baseline {baseline['throughput']:.1f}/s)"
+        )
+    return regressions
+
+
+def print_report(result):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:8.1f}"
+
+    print(f"\nserver: {result['server']}  requests: {result['requests']}  concurrency: {result['concurrency']}")
+    print(f"throughput: {result['throughput']:.1f} webhooks/s  status codes: {result['status_codes']}")
+    print(f"{'':14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for section in ("ack", "reply"):
+        for kind, stats in sorted(result[section].items()):
+            print(
+                f"{section + '/' + kind:14}{stats['count']:>7}{ms(stats['p50']):>10}"
+                f"{ms(stats['p95']):>10}{ms(stats['p99']):>10}{ms(stats['max']):>10}"
+            )
+    print(f"missing replies: {result['missing_replies']}  rejected webhooks: {result['rejected']}")
+    print(f"fake API requests: {result['fake_requests']} ({result['fake_errors']} injected errors)")
+    print(f"peak RSS: {result['peak_rss_mb']:.1f} MB", end="")
+    if result.get("peak_traced_mb") is not None:
+        print(f"  peak traced Python memory: {result['peak_traced_mb']:.1f} MB", end="")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=["flask", "aio"], default="flask", help="in-process server to test")
+    parser.add_argument("--target", help="webhook URL of an already running bot instead of an in-process one")
+    parser.add_argument("--requests", type=int, default=300, help="number of webhooks to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="webhooks in flight at once")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="payload kinds and weights")
+    parser.add_argument("--users", type=int, default=None, help="size of the sender pool (default: a new sender per message)")
+    parser.add_argument("--async-processing", action="store_true", help="set ASYNC_PROCESSING for the Flask server")
+    parser.add_argument("--reply-timeout", type=float, default=60.0, help="how long to wait for outstanding replies")
+    parser.add_argument("--tracemalloc", action="store_true", help="also trace peak Python allocations (slower)")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logging")
+    parser.add_argument("--json", help="write the result to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json result; exit 1 on regressions")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    # The fake services and the driver share the process; keep the jitter reproducible
+    random.seed(args.seed)
+    services = FakeServices(settings_from_args(args))
+    base_url = start_in_thread(services)
+    print(f"fake services on {base_url}")
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    configure_environment(base_url, workdir, args)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    if args.target:
+        (url, stop), server = (args.target, None), "external"
+    elif args.server == "aio":
+        (url, stop), server = start_aio(), "aio"
+    else:
+        (url, stop), server = start_flask(), "flask"
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    driver = LoadDriver(url, PayloadFactory(users=args.users, seed=args.seed), parse_mix(args.mix), args.concurrency)
+    duration = driver.run(args.requests)
+    continuations = continuation_parts(services.settings.reply_text)
+    wait_for_replies(driver, services, args.reply_timeout, continuations)
+
+    if stop is not None:
+        stop()
+
+    replies, missing = reply_latencies(driver.posted, list(services.sent_messages), continuations)
+    result = {
+        "server": server,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "mix": args.mix,
+        "throughput": args.requests / duration if duration else 0.0,
+        "status_codes": {str(code): count for code, count in driver.status_codes.items()},
+        "ack": {kind: summarize(values) for kind, values in driver.ack_latencies.items()},
+        "reply": {"first_part": summarize(replies)},
+        "missing_replies": missing,
+        "rejected": sum(count for code, count in driver.status_codes.items() if code != 200),
+        "fake_requests": services.requests,
+        "fake_errors": services.errors,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_traced_mb": tracemalloc.get_traced_memory()[1] / 2**20 if args.tracemalloc else None,
+    }
+    print_report(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f))
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
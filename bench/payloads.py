@@ -0,0 +1,155 @@
+"""
+Webhook payloads in the shape Meta sends them, signed with APP_SECRET.
+"""
+import hashlib
+import hmac
+import itertools
+import json
+import random
+import time
+
+PHONE_NUMBER_ID = "100000000000001"
+DISPLAY_NUMBER = "15550000000"
+
+QUESTIONS = [
+    "Wann kann ich einchecken?",
+    "Gibt es WLAN in der Wohnung?",
+    "Wo finde ich den Schlüssel?",
+    "Darf ich früher auschecken?",
+    "Ist Parken in der Nähe möglich?",
+    "Wie funktioniert die Heizung?",
+]
+
+
+def sign(app_secret, raw_payload_bytes):
+    """
+    Value of the X-Hub-Signature-256 header for a raw body.
+    """
+    digest = hmac.new(app_secret.encode("latin-1"), raw_payload_bytes, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+class PayloadFactory:
+    """
+    Builds webhook bodies. Every message gets a unique ID. Senders are drawn
+    from a pool of `users` wa_ids, so threads and lanes are reused like in
+    production; with users=None every message comes from a new sender.
+    """
+
+    def __init__(self, users=None, seed=None, phone_number_id=PHONE_NUMBER_ID):
+        self.users = users
+        self.phone_number_id = phone_number_id
+        self.random = random.Random(seed)
+        self._ids = itertools.count(1)
+
+    def wa_id(self):
+        if self.users is None:
+            return f"49170{next(self._ids):07d}"
+        return f"49170{self.random.randrange(self.users):07d}"
+
+    def message_id(self):
+        return f"wamid.bench.{next(self._ids)}"
+
+    def _value(self, **fields):
+        value = {
+            "messaging_product": "whatsapp",
+            "metadata": {"display_phone_number": DISPLAY_NUMBER, "phone_number_id": self.phone_number_id},
+        }
+        value.update(fields)
+        return value
+
+    def _contacts(self, wa_ids):
+        return [{"profile": {"name": f"Gast {wa_id[-4:]}"}, "wa_id": wa_id} for wa_id in wa_ids]
+
+    def text_message(self, wa_id=None, text=None):
+        return {
+            "from": wa_id or self.wa_id(),
+            "id": self.message_id(),
+            "timestamp": str(int(time.time())),
+            "type": "text",
+            "text": {"body": text or self.random.choice(QUESTIONS)},
+        }
+
+    def audio_message(self, wa_id=None):
+        return {
+            "from": wa_id or self.wa_id(),
+            "id": self.message_id(),
+            "timestamp": str(int(time.time())),
+            "type": "audio",
+            "audio": {"id": f"media{next(self._ids)}", "mime_type": "audio/ogg; codecs=opus", "voice": True},
+        }
+
+    def messages(self, messages):
+        return self.envelope([self._value(contacts=self._contacts({m["from"] for m in messages}), messages=messages)])
+
+    def text(self, wa_id=None):
+        return self.messages([self.text_message(wa_id)])
+
+    def audio(self, wa_id=None):
+        return self.messages([self.audio_message(wa_id)])
+
+    def batch(self, size=5):
+        """
+        Several messages in one POST, as Meta sends them under load.
+        """
+        return self.messages([self.text_message() for _ in range(size)])
+
+    def status(self, status="delivered", count=1):
+        statuses = [
+            {
+                "id": f"wamid.sent.{next(self._ids)}",
+                "status": status,
+                "timestamp": str(int(time.time())),
+                "recipient_id": self.wa_id(),
+            }
+            for _ in range(count)
+        ]
+        return self.envelope([self._value(statuses=statuses)])
+
+    def call(self, wa_id=None):
+        return self.envelope([self._value(event="call", call={"from": wa_id or self.wa_id(), "id": self.message_id()})])
+
+    def envelope(self, values):
+        return {
+            "object": "whatsapp_business_account",
+            "entry": [{"id": "WABA_ID", "changes": [{"field": "messages", "value": value} for value in values]}],
+        }
+
+    def build(self, kind):
+        """
+        Return a webhook body of the given kind: text, audio, call, status or batch.
+        """
+        if kind == "text":
+            return self.text()
+        if kind == "audio":
+            return self.audio()
+        if kind == "call":
+            return self.call()
+        if kind == "status":
+            return self.status(self.random.choice(["sent", "delivered", "read"]))
+        if kind == "batch":
+            return self.batch()
+        raise ValueError(f"Unknown payload kind: {kind}")
+
+
+def encode(body, app_secret):
+    """
+    Serialize a body the way Meta does and return (raw bytes, headers).
+    """
+    raw = json.dumps(body, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return raw, {"Content-Type": "application/json", "X-Hub-Signature-256": sign(app_secret, raw)}
+
+
+def expected_replies(body):
+    """
+    wa_ids that should get a reply for a body (one per message or call).
+    """
+    recipients = []
+    for entry in body.get("entry", []):
+        for change in entry.get("changes", []):
+            value = change.get("value", {})
+            if value.get("event") == "call":
+                recipients.append(value["call"]["from"])
+            for message in value.get("messages", []):
+                recipients.append(message["from"])
+    return recipients
@@ -0,0 +1,12 @@
+import logging
+
+from aiohttp import web
+
+from app.aio import create_async_app
+
+
+app = create_async_app()
+
+if __name__ == "__main__":
+    logging.info("aiohttp app started")
+    web.run_app(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,28 @@
+import sys
+
+from dotenv import load_dotenv
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from app.services.knowledge_index import build_index, KnowledgeIndex
+
+# --------------------------------------------------------------
+# Build (or incrementally update) the local knowledge index
+# --------------------------------------------------------------
+
+load_dotenv()
+KNOWLEDGE_FILE = os.getenv("KNOWLEDGE_FILE", "data/airbnb-faq.pdf")
+KNOWLEDGE_INDEX_DIR = os.getenv("KNOWLEDGE_INDEX_DIR", "data/index")
+
+build_index(KNOWLEDGE_FILE, KNOWLEDGE_INDEX_DIR)
+
+# --------------------------------------------------------------
+# Try a query
+# --------------------------------------------------------------
+
+index = KnowledgeIndex(KNOWLEDGE_FILE, KNOWLEDGE_INDEX_DIR)
+index.load()
+query = " ".join(sys.argv[1:]) or "What is the wifi password?"
+for score, confidence, chunk in index.search(query):
+    print(f"{score:.2f} ({confidence:.0%}): {chunk}")
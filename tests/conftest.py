@@ -0,0 +1,14 @@
+import os
+
+import pytest
+
+# The OpenAI clients are created at import time; tests never reach the API
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """
+    Path of a fresh SQLite database file for one test.
+    """
+    return str(tmp_path / "test.sqlite3")
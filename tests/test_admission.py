@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.services.admission import AdmissionController, Overloaded
+
+
+def trip(controller):
+    for _ in range(controller.failure_threshold):
+        with controller.admit() as ticket:
+            ticket.fail()
+
+
+def test_calls_beyond_the_inflight_cap_wait_for_a_slot():
+    controller = AdmissionController(max_inflight=1, max_waiting=1, max_wait=5)
+    controller.acquire()
+    admitted = threading.Event()
+
+    def wait_for_slot():
+        controller.acquire()
+        admitted.set()
+
+    waiter = threading.Thread(target=wait_for_slot)
+    waiter.start()
+    while controller.stats()["waiting"] == 0:
+        time.sleep(0.001)
+    assert not admitted.is_set()
+
+    with pytest.raises(Overloaded) as excinfo:
+        controller.acquire()
+    assert excinfo.value.reason == "queue_full"
+
+    controller.release(True)
+    assert admitted.wait(5)
+    waiter.join()
+    stats = controller.stats()
+    assert stats["inflight"] == 1 and stats["waiting"] == 0
+    assert stats["admitted"] == 2 and stats["rejected_queue_full"] == 1
+
+
+def test_waiting_call_is_rejected_after_max_wait():
+    controller = AdmissionController(max_inflight=1, max_waiting=1, max_wait=0.05)
+    controller.acquire()
+
+    with pytest.raises(Overloaded) as excinfo:
+        controller.acquire()
+    assert excinfo.value.reason == "wait_timeout"
+    assert controller.stats()["waiting"] == 0
+
+    controller.release(True)
+    assert controller.stats()["inflight"] == 0
+
+
+def test_consecutive_failures_open_the_breaker():
+    controller = AdmissionController(failure_threshold=2, reset_timeout=60)
+    with pytest.raises(RuntimeError):
+        with controller.admit():
+            raise RuntimeError("backend down")
+    with controller.admit() as ticket:
+        ticket.fail()
+
+    with pytest.raises(Overloaded) as excinfo:
+        with controller.admit():
+            pass
+    assert excinfo.value.reason == "circuit_open"
+    stats = controller.stats()
+    assert stats["breaker_open"] == 1 and stats["breaker_trips"] == 1
+    assert stats["inflight"] == 0
+
+
+def test_success_resets_the_failure_count():
+    controller = AdmissionController(failure_threshold=2)
+    for _ in range(3):
+        with controller.admit() as ticket:
+            ticket.fail()
+        with controller.admit():
+            pass
+    assert controller.stats()["breaker_trips"] == 0
+
+
+def test_half_open_breaker_lets_one_trial_call_through():
+    controller = AdmissionController(failure_threshold=1, reset_timeout=0.05)
+    trip(controller)
+    time.sleep(0.06)
+
+    with controller.admit():
+        with pytest.raises(Overloaded) as excinfo:
+            controller.acquire()
+        assert excinfo.value.reason == "circuit_open"
+
+    assert controller.stats()["breaker_open"] == 0
+    with controller.admit():
+        pass
+
+
+def test_failed_trial_call_opens_the_breaker_again():
+    controller = AdmissionController(failure_threshold=3, reset_timeout=0.05)
+    trip(controller)
+    time.sleep(0.06)
+
+    with controller.admit() as ticket:
+        ticket.fail()
+
+    with pytest.raises(Overloaded):
+        controller.acquire()
+    assert controller.stats()["breaker_trips"] == 2
+
+
+def test_tripping_breaker_rejects_the_waiting_calls():
+    controller = AdmissionController(max_inflight=1, max_waiting=2, max_wait=5, failure_threshold=1)
+    controller.acquire()
+    reasons = []
+
+    def wait_for_slot():
+        try:
+            controller.acquire()
+        except Overloaded as e:
+            reasons.append(e.reason)
+
+    waiters = [threading.Thread(target=wait_for_slot) for _ in range(2)]
+    for waiter in waiters:
+        waiter.start()
+    while controller.stats()["waiting"] < 2:
+        time.sleep(0.001)
+
+    controller.release(False)
+    for waiter in waiters:
+        waiter.join(5)
+    assert reasons == ["circuit_open", "circuit_open"]
+    assert controller.stats()["inflight"] == 0
+
+
+def test_threads_and_coroutines_share_the_slots():
+    controller = AdmissionController(max_inflight=1, max_waiting=1, max_wait=5)
+    controller.acquire()
+
+    async def call():
+        async with controller.admit_async():
+            return controller.stats()["inflight"]
+
+    async def main():
+        task = asyncio.create_task(call())
+        while controller.stats()["waiting"] == 0:
+            await asyncio.sleep(0.001)
+        threading.Timer(0.01, controller.release, args=(True,)).start()
+        return await asyncio.wait_for(task, 5)
+
+    assert asyncio.run(main()) == 1
+    assert controller.stats()["inflight"] == 0
@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import pytest
+from flask import Flask
+
+from app.services import backends
+from app.services.backends import ReplyBackend, ReplyRequest, ReplyRouter
+
+
+class NoAnswerBackend(ReplyBackend):
+    name = "test_no_answer"
+
+    def generate(self, request, timeout):
+        return None
+
+
+class FailingBackend(ReplyBackend):
+    name = "test_failing"
+
+    def generate(self, request, timeout):
+        raise RuntimeError("backend down")
+
+
+class SlowStreamingBackend(ReplyBackend):
+    name = "test_slow_streaming"
+
+    def generate(self, request, timeout):
+        time.sleep(0.3)
+        if request.can_stream:
+            request.send_part("too late")
+        return "too late"
+
+
+class StreamingBackend(ReplyBackend):
+    name = "test_streaming"
+
+    def generate(self, request, timeout):
+        if not request.can_stream:
+            return "one piece"
+        for part in ("first", "second"):
+            request.send_part(part)
+        return "first[NL]second"
+
+
+class KnownQuestionBackend(ReplyBackend):
+    name = "test_known_question"
+
+    def generate(self, request, timeout):
+        return "known answer" if request.text == "known" else None
+
+    async def generate_async(self, request, timeout):
+        return self.generate(request, timeout)
+
+
+class SecondBackend(ReplyBackend):
+    name = "test_second"
+
+    def generate(self, request, timeout):
+        return "from second"
+
+    async def generate_async(self, request, timeout):
+        return self.generate(request, timeout)
+
+
+@pytest.fixture
+def make_router(monkeypatch):
+    for backend_class in (
+        NoAnswerBackend, FailingBackend, SlowStreamingBackend, StreamingBackend, KnownQuestionBackend, SecondBackend
+    ):
+        monkeypatch.setitem(backends.BACKENDS, backend_class.name, backend_class)
+
+    def make_router(chain, timeouts="", hedge_percentile=0.0):
+        app = Flask(__name__)
+        app.config.update(
+            REPLY_BACKENDS=chain,
+            REPLY_TIMEOUTS=timeouts,
+            REPLY_HEDGE_PERCENTILE=hedge_percentile,
+            REPLY_POOL_SIZE=4,
+        )
+        router = ReplyRouter()
+        router.init_app(app)
+        return router
+
+    return make_router
+
+
+@pytest.mark.parametrize("first", ["test_no_answer", "test_failing"])
+def test_backend_after_a_non_answering_one_still_streams(make_router, first):
+    router = make_router(f"{first},test_streaming")
+    sent = []
+    reply = router.reply(ReplyRequest("4917000000001", "Hallo", send_part=sent.append))
+
+    assert reply.backend == "test_streaming"
+    assert reply.streamed
+    assert sent == ["first", "second"]
+
+
+def test_timed_out_backend_cannot_stream_into_the_next_reply(make_router):
+    router = make_router("test_slow_streaming,test_streaming", timeouts="test_slow_streaming=0.05")
+    sent = []
+    reply = router.reply(ReplyRequest("4917000000001", "Hallo", send_part=sent.append))
+    time.sleep(0.4)
+
+    assert reply.backend == "test_streaming"
+    assert reply.text == "one piece"
+    assert not reply.streamed
+    assert sent == []
+
+
+def warmed_up_router(make_router):
+    router = make_router("test_known_question,test_second", hedge_percentile=0.95)
+    # As after enough answered calls: the first backend gets hedged after 200 ms
+    router._latencies["test_known_question"].extend([0.2] * (router.hedge_min_samples + 5))
+    assert router._hedge_delay(router.chain[0]) == 0.2
+    return router
+
+
+def test_early_miss_of_a_hedged_backend_falls_through_to_its_hedge(make_router):
+    router = warmed_up_router(make_router)
+    reply = router.reply(ReplyRequest("4917000000001", "unknown"))
+
+    assert reply.text == "from second"
+    assert reply.backend == "test_second"
+    assert router.hedges == 0
+
+
+def test_early_miss_of_a_hedged_backend_falls_through_to_its_hedge_async(make_router):
+    router = warmed_up_router(make_router)
+    reply = asyncio.run(router.reply_async(ReplyRequest("4917000000001", "unknown")))
+
+    assert reply.text == "from second"
+    assert reply.backend == "test_second"
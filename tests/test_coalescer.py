@@ -0,0 +1,69 @@
+import queue
+import time
+
+from app.services.coalescer import MessageCoalescer
+
+
+def collector():
+    flushed = queue.Queue()
+    return flushed, lambda key, items: flushed.put((key, list(items), time.monotonic()))
+
+
+def test_messages_within_the_window_are_flushed_as_one_batch():
+    coalescer = MessageCoalescer(window=0.1)
+    flushed, flush = collector()
+
+    assert coalescer.add("491", "a", flush)
+    assert not coalescer.add("491", "b", flush)
+    assert coalescer.add("492", "c", flush)
+    assert coalescer.pending_counts() == {"491": 2, "492": 1}
+
+    batches = sorted(flushed.get(timeout=2)[:2] for _ in range(2))
+    assert batches == [("491", ["a", "b"]), ("492", ["c"])]
+    assert coalescer.stats() == {"messages": 3, "batches": 2, "pending_keys": 0}
+
+
+def test_late_message_pushes_the_flush_back():
+    coalescer = MessageCoalescer(window=0.15)
+    flushed, flush = collector()
+
+    started = time.monotonic()
+    coalescer.add("491", "a", flush)
+    time.sleep(0.1)
+    coalescer.add("491", "b", flush)
+
+    key, items, flushed_at = flushed.get(timeout=2)
+    assert items == ["a", "b"]
+    assert flushed_at - started >= 0.25
+
+
+def test_steady_stream_is_flushed_at_the_max_delay():
+    coalescer = MessageCoalescer(window=0.1, max_delay=0.25)
+    flushed, flush = collector()
+
+    started = time.monotonic()
+    coalescer.add("491", 0, flush)
+    for n in range(1, 10):
+        time.sleep(0.05)
+        coalescer.add("491", n, flush)
+
+    key, items, flushed_at = flushed.get(timeout=2)
+    assert items[0] == 0 and len(items) < 10
+    assert 0.25 <= flushed_at - started < 0.45
+
+    # Messages after the flush open the next batch
+    rest = flushed.get(timeout=2)[1]
+    assert items + rest == list(range(10))
+
+
+def test_failing_flush_does_not_stop_later_batches():
+    coalescer = MessageCoalescer(window=0.05)
+    flushed, flush = collector()
+
+    def fail(key, items):
+        raise RuntimeError("boom")
+
+    coalescer.add("491", "a", fail)
+    time.sleep(0.2)
+    coalescer.add("491", "b", flush)
+    assert flushed.get(timeout=2)[1] == ["b"]
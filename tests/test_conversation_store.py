@@ -0,0 +1,79 @@
+import sqlite3
+import time
+
+from app.services.conversation_store import ConversationStore
+
+
+def history(store, wa_id):
+    return [message["content"] for message in store.prompt(wa_id, "system", "next")[1:-1]]
+
+
+def stored_ids(db_path, wa_id):
+    connection = sqlite3.connect(db_path)
+    try:
+        return [row[0] for row in connection.execute(
+            "SELECT id FROM conversation_messages WHERE wa_id = ? ORDER BY id", (wa_id,)
+        )]
+    finally:
+        connection.close()
+
+
+def test_turns_stored_by_another_process_are_picked_up(db_path):
+    first = ConversationStore(db_path, token_budget=1000, summarize=False)
+    second = ConversationStore(db_path, token_budget=1000, summarize=False)
+    first.append("491", ("user", "hello"), ("assistant", "hi"))
+    assert history(second, "491") == ["hello", "hi"]
+
+    first.append("491", ("user", "room 12"), ("assistant", "noted"))
+    assert history(second, "491") == ["hello", "hi", "room 12", "noted"]
+    assert second.stats()["reloads"] == 1
+
+    second.append("491", ("user", "thanks"), ("assistant", "welcome"))
+    assert history(first, "491") == ["hello", "hi", "room 12", "noted", "thanks", "welcome"]
+
+
+def test_append_after_a_foreign_turn_drops_the_cached_conversation(db_path):
+    first = ConversationStore(db_path, token_budget=1000, summarize=False)
+    second = ConversationStore(db_path, token_budget=1000, summarize=False)
+    assert history(first, "491") == []
+    second.append("491", ("user", "from second"), ("assistant", "a"))
+    first.append("491", ("user", "from first"), ("assistant", "b"))
+    assert history(first, "491") == ["from second", "a", "from first", "b"]
+
+
+def test_without_summarizer_old_messages_are_trimmed_and_deleted(db_path):
+    store = ConversationStore(db_path, token_budget=100, summarize=False)
+    for n in range(50):
+        store.prompt("491", "system", f"question {n}")
+        store.append("491", ("user", f"question {n} " * 5), ("assistant", f"answer {n} " * 5))
+
+    conversation = store._cache["491"]
+    assert conversation.tokens <= store.cache_tokens
+    assert stored_ids(db_path, "491") == [message[0] for message in conversation.messages]
+    assert history(store, "491")[-1] == "answer 49 " * 5
+
+
+def test_load_is_capped_to_the_cache_budget(db_path):
+    ConversationStore(db_path, token_budget=10000, summarize=False).append(
+        "491", *[("user", f"message {n} " * 10) for n in range(100)]
+    )
+    store = ConversationStore(db_path, token_budget=100, summarize=False)
+    store.prompt("491", "system", "next")
+    conversation = store._cache["491"]
+    assert conversation.tokens <= store.cache_tokens
+    assert conversation.messages[-1][2] == "message 99 " * 10
+
+
+def test_purge_deletes_messages_past_retention(db_path):
+    store = ConversationStore(db_path, token_budget=1000, summarize=False, retention=3600)
+    store.append("491", ("user", "old"), ("assistant", "reply"))
+    connection = sqlite3.connect(db_path)
+    connection.execute("UPDATE conversation_messages SET created_at = ?", (time.time() - 7200,))
+    connection.commit()
+    connection.close()
+
+    store.append("492", ("user", "new"), ("assistant", "reply"))
+    store.purge()
+    assert stored_ids(db_path, "491") == []
+    assert history(store, "491") == []
+    assert history(store, "492") == ["new", "reply"]
@@ -0,0 +1,80 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from app.services.job_queue import JobQueue
+
+
+def test_jobs_of_one_key_run_in_order_and_never_overlap():
+    jobs = JobQueue(workers=4, maxsize=100)
+    running = set()
+    overlaps = []
+    done = []
+    lock = threading.Lock()
+
+    def job(key, n):
+        with lock:
+            if key in running:
+                overlaps.append((key, n))
+            running.add(key)
+        time.sleep(0.001)
+        with lock:
+            running.discard(key)
+            done.append((key, n))
+
+    futures = [jobs.submit_keyed(key, job, key, n) for n in range(10) for key in ("a", "b")]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert overlaps == []
+    assert [n for key, n in done if key == "a"] == list(range(10))
+    assert [n for key, n in done if key == "b"] == list(range(10))
+    assert jobs.lane_depths() == {}
+
+
+def test_other_keys_run_while_a_lane_is_busy():
+    jobs = JobQueue(workers=2, maxsize=100)
+    release = threading.Event()
+    blocked = jobs.submit_keyed("slow", release.wait, 5)
+    queued = jobs.submit_keyed("slow", lambda: "after")
+
+    assert jobs.submit_keyed("fast", lambda: "fast").result(timeout=5) == "fast"
+    assert not queued.done()
+    assert jobs.lane_depths() == {"slow": 2}
+
+    release.set()
+    assert blocked.result(timeout=5)
+    assert queued.result(timeout=5) == "after"
+
+
+def test_failed_job_does_not_block_its_lane():
+    jobs = JobQueue(workers=1, maxsize=100)
+
+    def fail():
+        raise ValueError("boom")
+
+    failed = jobs.submit_keyed("a", fail)
+    after = jobs.submit_keyed("a", lambda: "after")
+
+    with pytest.raises(ValueError):
+        failed.result(timeout=5)
+    assert after.result(timeout=5) == "after"
+
+
+def test_submit_raises_when_the_queue_is_full():
+    jobs = JobQueue(workers=1, maxsize=2)
+    release = threading.Event()
+    jobs.submit_keyed("a", release.wait, 5)
+    jobs.submit(lambda: None)
+
+    with pytest.raises(queue.Full):
+        jobs.submit_keyed("b", lambda: None)
+    assert jobs.stats()["queue_depth"] == 2
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while jobs.depth() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert jobs.submit_keyed("b", lambda: "ok").result(timeout=5) == "ok"
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from app.services import knowledge_index as knowledge_index_module
+from app.services.knowledge_index import KnowledgeIndex, build_index
+
+PAGES = [
+    "Q: What is the wifi password? A: The wifi network is ParisFlat and the password is croissant42. "
+    "Q: Where is the key? A: The key is in the lockbox next to the door, the code is sent on arrival.",
+    "Q: When is check in? A: Check in is from 3 pm, check out is until 11 am. "
+    "Q: Can I bring my dog? A: Yes, dogs are welcome, but please keep them off the sofa.",
+]
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    source = tmp_path / "faq.pdf"
+    source.write_bytes(b"%PDF stand-in")
+    monkeypatch.setattr(knowledge_index_module, "extract_pages", lambda path: list(PAGES))
+    build_index(str(source), str(tmp_path / "index"))
+    index = KnowledgeIndex(str(source), str(tmp_path / "index"), check_interval=0)
+    assert index.load()
+    return index
+
+
+def best_confidence(index, query):
+    matches = index.search(query)
+    return matches[0][1] if matches else 0.0
+
+
+@pytest.mark.parametrize("query", ["yes", "the", "where", "Where?", "ja danke", "ok thanks", "is it the"])
+def test_stopword_only_queries_have_no_match(index, query):
+    assert index.search(query) == []
+
+
+def test_single_matching_word_is_not_confident(index):
+    assert 0 < best_confidence(index, "dog") < 0.75
+
+
+def test_question_matching_a_passage_is_confident(index):
+    matches = index.search("What is the wifi password?")
+    assert matches[0][1] >= 0.75
+    assert "croissant42" in matches[0][2]
+
+
+def test_off_topic_question_is_not_confident(index):
+    assert best_confidence(index, "Which museum should I visit near the Louvre?") < 0.75
+
+
+def test_changed_source_is_reindexed_during_searches(index, monkeypatch):
+    index.check_interval = 0.01
+    monkeypatch.setattr(
+        knowledge_index_module,
+        "extract_pages",
+        lambda path: ["Q: Is there parking? A: Parking garage Rivoli, level minus two."],
+    )
+    with open(index.source, "ab") as f:
+        f.write(b" edited")
+    index._checked_at = 0.0
+
+    index.search("parking garage")
+    for _ in range(100):
+        if not index._rebuilding:
+            break
+        time.sleep(0.01)
+    assert "Rivoli" in index.search("parking garage")[0][2]
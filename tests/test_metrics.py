@@ -0,0 +1,38 @@
+import pytest
+from flask import Flask
+
+from app.services.metrics import Metrics
+
+
+@pytest.fixture
+def make_client():
+    def make(token=""):
+        app = Flask(__name__)
+        app.config.update(METRICS_ENABLED=True, METRICS_TOKEN=token)
+        Metrics().init_app(app)
+        return app.test_client()
+
+    return make
+
+
+def get(client, remote_addr="127.0.0.1", headers=None):
+    return client.get("/metrics", headers=headers or {}, environ_base={"REMOTE_ADDR": remote_addr})
+
+
+def test_without_token_only_local_requests_are_answered(make_client):
+    client = make_client()
+    assert get(client).status_code == 200
+    assert get(client, "::1").status_code == 200
+    assert get(client, "203.0.113.7").status_code == 403
+
+
+def test_without_token_forwarded_requests_are_refused(make_client):
+    # ngrok and reverse proxies connect from localhost but add a forwarding header
+    client = make_client()
+    assert get(client, headers={"X-Forwarded-For": "203.0.113.7"}).status_code == 403
+
+
+def test_token_is_required_from_anywhere_when_set(make_client):
+    client = make_client("secret")
+    assert get(client).status_code == 403
+    assert get(client, "203.0.113.7", {"Authorization": "Bearer secret"}).status_code == 200
@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from app.services import outbound as outbound_module
+from app.services.graph_api import GraphAPIError
+from app.services.outbound import OutboundSender, TokenBucket
+from app.services.outbox import Outbox
+
+
+class FakeResponse:
+    status_code = 200
+
+
+class FakeGraphClient:
+    """
+    Records sent bodies; fails the first `failures` attempts of a body with `status_code`.
+    """
+
+    def __init__(self, failures=None, status_code=503):
+        self.failures = dict(failures or {})
+        self.status_code = status_code
+        self.attempts = []
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_message(self, phone_number_id, payload):
+        body = payload["text"]["body"]
+        with self._lock:
+            self.attempts.append(body)
+            if self.failures.get(body, 0) > 0:
+                self.failures[body] -= 1
+                raise GraphAPIError(f"{self.status_code} Server Error", status_code=self.status_code)
+            self.sent.append(body)
+        return FakeResponse()
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    def make_graph(failures=None, status_code=503):
+        client = FakeGraphClient(failures, status_code)
+        monkeypatch.setattr(outbound_module, "graph_client", client)
+        return client
+
+    return make_graph
+
+
+@pytest.fixture
+def journal(db_path, monkeypatch):
+    outbox = Outbox(db_path, backoff=0.01, max_attempts=5)
+    monkeypatch.setattr(outbound_module, "outbox", outbox)
+    return outbox
+
+
+def sender(**options):
+    options.setdefault("rate", 1000.0)
+    options.setdefault("burst", 1000)
+    options.setdefault("backoff", 0.001)
+    return OutboundSender(**options)
+
+
+def test_failed_part_is_retried_before_the_next_part_is_sent(graph, journal):
+    client = graph(failures={"part 1": 3})
+    outbound = sender(max_retries=1)
+    futures = [outbound.enqueue_text("1", "4917000000001", f"part {n}") for n in (1, 2, 3)]
+
+    assert all(future.result(timeout=5) is not None for future in futures)
+    assert client.sent == ["part 1", "part 2", "part 3"]
+    assert journal.pending() == []
+    # Two in-process attempts fail, the outbox backoff runs once, then one more failure and a retry
+    assert journal.stats()["retried"] == 1
+
+
+def test_part_is_given_up_after_the_outbox_attempts(graph, journal):
+    client = graph(failures={"part 1": 100})
+    outbound = sender(max_retries=0)
+    futures = [outbound.enqueue_text("1", "4917000000001", f"part {n}") for n in (1, 2)]
+
+    assert futures[0].result(timeout=5) is None
+    assert futures[1].result(timeout=5) is not None
+    assert client.attempts.count("part 1") == journal.max_attempts
+    assert client.sent == ["part 2"]
+    assert journal.stats()["dead"] == 1
+
+
+def test_token_bucket_allows_a_burst_then_paces_at_the_rate():
+    bucket = TokenBucket(rate=20.0, burst=2)
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == 0.0
+
+    started = time.monotonic()
+    waited = bucket.acquire()
+    assert waited > 0.0
+    assert 0.03 < time.monotonic() - started < 0.5
+
+
+def test_retryable_error_is_retried_with_exponential_backoff(graph, journal, monkeypatch):
+    client = graph(failures={"hello": 2})
+    sleeps = []
+    monkeypatch.setattr(outbound_module.random, "random", lambda: 0.5)
+    monkeypatch.setattr(outbound_module.time, "sleep", sleeps.append)
+    outbound = sender(max_retries=3, backoff=0.1)
+    payload = {"to": "4917000000001", "type": "text", "text": {"body": "hello"}}
+
+    assert outbound._deliver("1", payload, time.monotonic()) is not None
+    assert client.attempts == ["hello"] * 3
+    assert sleeps == [pytest.approx(0.1), pytest.approx(0.2)]
+    assert outbound.stats.snapshot()["retries"] == 2
+
+
+def test_rejected_message_is_not_retried(graph, journal):
+    client = graph(failures={"part 1": 1}, status_code=400)
+    outbound = sender(max_retries=3)
+    futures = [outbound.enqueue_text("1", "4917000000001", f"part {n}") for n in (1, 2)]
+
+    assert futures[0].result(timeout=5) is None
+    assert futures[1].result(timeout=5) is not None
+    assert client.attempts == ["part 1", "part 2"]
+    assert journal.stats()["dead"] == 1
+    assert journal.pending() == []
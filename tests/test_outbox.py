@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from app.services.outbox import Outbox
+
+
+def make_outbox(db_path, **options):
+    options.setdefault("batch_size", 10)
+    options.setdefault("replay_after", 30.0)
+    outbox = Outbox(db_path, **options)
+    outbox.handed = []
+    outbox._deliver = lambda entry_id, phone_number_id, payload: outbox.handed.append(entry_id)
+    return outbox
+
+
+def payload(n):
+    return {"messaging_product": "whatsapp", "to": f"49170{n:07d}", "type": "text", "text": {"body": str(n)}}
+
+
+def test_backed_off_entries_do_not_starve_due_ones(db_path):
+    outbox = make_outbox(db_path, backoff=3600.0)
+    backed_off = [outbox.append("1", payload(n)) for n in range(25)]
+    for entry_id in backed_off:
+        outbox.release(entry_id, "503")
+    due = [outbox.append("1", payload(n)) for n in range(25, 30)]
+    for entry_id in due:
+        outbox.release(entry_id, "503")
+    # Backoff over for the newer entries only
+    outbox._connection().execute(
+        f"UPDATE outbox SET next_at = 0 WHERE id IN ({','.join('?' * len(due))})", due
+    )
+
+    assert outbox.drain() == len(due)
+    assert outbox.handed == due
+
+
+def test_entry_leased_by_a_live_process_is_not_replayed(db_path):
+    owner = make_outbox(db_path, replay_after=0.2)
+    other = make_outbox(db_path, replay_after=0.2)
+    entry_id = owner.append("1", payload(1))
+
+    for _ in range(3):
+        time.sleep(0.1)
+        owner.renew()
+        assert other.drain() == 0
+
+    # The owner stops renewing (crash): the lease runs out and the entry is taken over once
+    time.sleep(0.25)
+    assert other.drain() == 1
+    assert other.handed == [entry_id]
+    assert make_outbox(db_path).drain() == 0
+
+
+def test_acked_entries_are_not_replayed(db_path):
+    outbox = make_outbox(db_path, replay_after=0.0)
+    outbox.ack(outbox.append("1", payload(1)), 200)
+    assert outbox.drain() == 0
+    assert outbox.pending() == []
+
+
+def test_release_after_losing_the_lease_keeps_the_new_owner(db_path):
+    owner = make_outbox(db_path, replay_after=0.0)
+    other = make_outbox(db_path, replay_after=30.0)
+    entry_id = owner.append("1", payload(1))
+    assert other.drain() == 1
+
+    owner.release(entry_id, "timeout")
+    row = other._connection().execute("SELECT claimed_by, attempts FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+    assert row == (other.owner, 0)
+
+
+def test_deferred_entry_keeps_its_lease_until_given_up(db_path):
+    owner = make_outbox(db_path, replay_after=30.0, backoff=0.01, max_attempts=3)
+    other = make_outbox(db_path, replay_after=30.0)
+    entry_id = owner.append("1", payload(1))
+
+    assert owner.defer(entry_id, "503") == pytest.approx(0.01)
+    assert owner.defer(entry_id, "503") == pytest.approx(0.02)
+    assert other.drain() == 0
+    assert owner.defer(entry_id, "503") is None
+    assert owner.pending() == []
+    assert owner.stats()["dead"] == 1
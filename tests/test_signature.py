@@ -0,0 +1,52 @@
+import hashlib
+import hmac
+
+import pytest
+from flask import Flask
+
+from app.decorators.security import signature_required
+from app.services.ingress import ingress, WebhookIngress
+
+BODY = b'{"object": "whatsapp_business_account", "entry": []}'
+
+
+def sign(secret, body=BODY):
+    return "sha256=" + hmac.new(secret.encode("latin-1"), body, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+
+    @app.route("/webhook", methods=["POST"])
+    @signature_required
+    def webhook():
+        return "ok", 200
+
+    yield app.test_client()
+    ingress.set_secret(None)
+
+
+@pytest.mark.parametrize("secret", [None, ""])
+def test_missing_secret_rejects_every_signature(client, secret):
+    ingress.set_secret(secret)
+    for signature in (sign(""), sign("anything"), ""):
+        response = client.post("/webhook", data=BODY, headers={"X-Hub-Signature-256": signature})
+        assert response.status_code == 403
+
+
+def test_valid_signature_is_accepted(client):
+    ingress.set_secret("app-secret")
+    response = client.post("/webhook", data=BODY, headers={"X-Hub-Signature-256": sign("app-secret")})
+    assert response.status_code == 200
+
+
+def test_wrong_or_missing_signature_is_rejected(client):
+    ingress.set_secret("app-secret")
+    for headers in ({"X-Hub-Signature-256": sign("other-secret")}, {"X-Hub-Signature-256": sign("")}, {}):
+        assert client.post("/webhook", data=BODY, headers=headers).status_code == 403
+
+
+def test_ingress_without_secret_verifies_nothing():
+    assert not WebhookIngress("").verify(BODY, sign(""))
+    assert WebhookIngress("app-secret").verify(BODY, sign("app-secret"))
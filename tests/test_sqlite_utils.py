@@ -0,0 +1,30 @@
+import threading
+
+from app.utils.sqlite_utils import ThreadLocalConnection, connect
+
+
+def test_connect_uses_wal_and_creates_the_directory(tmp_path):
+    connection = connect(str(tmp_path / "state" / "test.sqlite3"))
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert connection.isolation_level is None
+
+
+def test_one_connection_per_thread_set_up_once(tmp_path):
+    setups = []
+    connection = ThreadLocalConnection(str(tmp_path / "test.sqlite3"), setups.append)
+    assert connection() is connection()
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not connection()
+    assert len(setups) == 2
+
+
+def test_changing_the_path_opens_a_new_connection(tmp_path):
+    connection = ThreadLocalConnection(str(tmp_path / "first.sqlite3"))
+    first = connection()
+    connection.path = str(tmp_path / "second.sqlite3")
+    assert connection() is not first
+    assert (tmp_path / "second.sqlite3").exists()
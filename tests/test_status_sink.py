@@ -0,0 +1,52 @@
+import sqlite3
+
+from app.services.status_sink import StatusSink
+
+
+def status(message_id, kind="delivered"):
+    return {"id": message_id, "status": kind, "recipient_id": "4917000000001", "timestamp": "1700000000"}
+
+
+def broken(sink, monkeypatch):
+    def connect():
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(sink, "_connect", connect)
+
+
+def test_failed_write_keeps_the_batch_for_the_next_flush(db_path, monkeypatch):
+    sink = StatusSink(db_path)
+    for n in range(3):
+        sink.add(status(f"wamid.{n}"))
+
+    with monkeypatch.context() as patch:
+        broken(sink, patch)
+        assert sink.flush() == 0
+    sink.add(status("wamid.3"))
+    assert sink.stats()["buffered"] == 4
+
+    assert sink.flush() == 4
+    assert sink.timings("wamid.0")["delivered_at"] == 1700000000
+    assert sink.stats() == {"buffered": 0, "received": 4, "written": 4, "dropped": 0, "write_errors": 1}
+
+
+def test_failed_write_drops_the_oldest_statuses_beyond_max_buffer(db_path, monkeypatch):
+    sink = StatusSink(db_path, max_buffer=3)
+    for n in range(3):
+        sink.add(status(f"wamid.{n}"))
+
+    def connect():
+        # Two newer statuses arrive while the batch is being written
+        sink.add(status("wamid.3"))
+        sink.add(status("wamid.4"))
+        raise sqlite3.OperationalError("database is locked")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(sink, "_connect", connect)
+        assert sink.flush() == 0
+    assert sink.stats()["dropped"] == 2
+
+    assert sink.flush() == 3
+    assert sink.timings("wamid.1") is None
+    assert sink.timings("wamid.2") is not None
+    assert sink.timings("wamid.4") is not None
@@ -0,0 +1,91 @@
+import time
+
+import pytest
+
+from app.services import openai_service, thread_rotation
+from app.services.thread_store import LRUCachedThreadStore, SQLiteThreadStore
+
+
+@pytest.fixture
+def stores(db_path):
+    return LRUCachedThreadStore(SQLiteThreadStore(db_path)), LRUCachedThreadStore(SQLiteThreadStore(db_path))
+
+
+def due(store):
+    return store.due_for_rotation(1, 0, None, time.time() + 1)
+
+
+def test_message_counted_after_selection_aborts_the_rotation(stores):
+    worker, rotator = stores
+    worker.set("491", "thread-old")
+    worker.touch("491", tokens=10, thread_id="thread-old")
+    [(wa_id, thread_id, updated_at)] = due(rotator)
+
+    time.sleep(0.01)
+    assert worker.touch("491", tokens=10, thread_id="thread-old")
+    assert not rotator.replace(wa_id, thread_id, "thread-new", updated_at)
+    assert worker.get("491") == "thread-old"
+
+
+def test_other_workers_follow_a_rotation(stores):
+    worker, rotator = stores
+    worker.set("491", "thread-old")
+    worker.touch("491", tokens=10, thread_id="thread-old")
+    assert worker.get("491") == "thread-old"
+
+    [(wa_id, thread_id, updated_at)] = due(rotator)
+    assert rotator.replace(wa_id, thread_id, "thread-new", updated_at)
+    assert not worker.touch("491", tokens=10, thread_id="thread-old")
+    assert worker.get("491") == "thread-new"
+
+
+def test_user_message_goes_to_the_thread_a_rotation_switched_to(stores, monkeypatch):
+    worker, rotator = stores
+    worker.set("491", "thread-old")
+    worker.touch("491", tokens=10, thread_id="thread-old")
+    assert worker.get("491") == "thread-old"
+    [(wa_id, thread_id, updated_at)] = due(rotator)
+    rotator.replace(wa_id, thread_id, "thread-new", updated_at)
+
+    posted = []
+
+    class Messages:
+        def create(self, thread_id, role, content):
+            posted.append(thread_id)
+
+    class Threads:
+        messages = Messages()
+
+    class Beta:
+        threads = Threads()
+
+    class Client:
+        beta = Beta()
+
+    monkeypatch.setattr(openai_service, "thread_store", worker)
+    monkeypatch.setattr(openai_service, "client", Client())
+    assert openai_service.add_user_message("491", "hello") == "thread-new"
+    assert posted == ["thread-new"]
+
+
+def test_rotator_gives_up_when_the_thread_got_a_message(stores, monkeypatch):
+    worker, rotator = stores
+    worker.set("491", "thread-old")
+    worker.touch("491", tokens=10, thread_id="thread-old")
+    [(wa_id, thread_id, updated_at)] = due(rotator)
+
+    def summarize(summary, transcript):
+        # A message arrives while the old thread is being summarized
+        worker.touch("491", tokens=10, thread_id="thread-old")
+        return "summary"
+
+    monkeypatch.setattr(thread_rotation, "thread_store", rotator)
+    monkeypatch.setattr(openai_service, "thread_transcript", lambda thread_id, limit: [("user", "hi")])
+    monkeypatch.setattr(openai_service, "summarize_conversation", summarize)
+    monkeypatch.setattr(openai_service, "create_thread_with_summary", lambda summary: "thread-new")
+
+    time.sleep(0.01)
+    rotator_service = thread_rotation.ThreadRotator(max_messages=1)
+    assert not rotator_service.rotate(wa_id, thread_id, updated_at)
+    assert rotator_service.stats()["conflicts"] == 1
+    assert worker.get("491") == "thread-old"
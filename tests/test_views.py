@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+from flask import Flask
+
+from app import views
+from app.services.dedup import MessageDeduplicator
+from app.services.job_queue import JobQueue
+from app.utils.whatsapp_utils import WebhookEvent
+
+
+def message(message_id, sender="4917000000001"):
+    return WebhookEvent("message", {}, {"id": message_id, "from": sender, "type": "text"})
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(views, "job_queue", JobQueue(workers=2, maxsize=100))
+    monkeypatch.setattr(views, "deduplicator", MessageDeduplicator())
+    app = Flask(__name__)
+    with app.app_context():
+        yield app
+
+
+def test_failed_message_may_be_redelivered(app, monkeypatch):
+    def process_event(event):
+        if event.item["id"] == "wamid.2":
+            raise RuntimeError("assistant down")
+
+    monkeypatch.setattr(views, "process_event", process_event)
+    events = [message("wamid.1"), message("wamid.2", sender="4917000000002")]
+    for event in events:
+        assert not views.deduplicator.is_duplicate(event.item["id"])
+
+    response, status = views.process_events(events)
+    assert status == 500
+    assert views.deduplicator.is_duplicate("wamid.1")
+    assert not views.deduplicator.is_duplicate("wamid.2")
+
+
+def test_full_queue_rejects_the_webhook_instead_of_answering_inline(app, monkeypatch):
+    processed = []
+    release = threading.Event()
+
+    def process_event(event):
+        release.wait(5)
+        processed.append(event.item["id"])
+
+    monkeypatch.setattr(views, "job_queue", JobQueue(workers=1, maxsize=1))
+    monkeypatch.setattr(views, "process_event", process_event)
+    # The first message is still running when the second one finds the queue full
+    threading.Timer(0.1, release.set).start()
+    events = [message("wamid.1"), message("wamid.2")]
+    for event in events:
+        views.deduplicator.is_duplicate(event.item["id"])
+
+    response, status = views.process_events(events)
+    assert status == 503
+    assert processed == ["wamid.1"]
+    assert views.deduplicator.is_duplicate("wamid.1")
+    assert not views.deduplicator.is_duplicate("wamid.2")